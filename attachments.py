@@ -0,0 +1,146 @@
+import logging
+import mmap
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Attachment:
+    """
+    binary content of a multipart part (eg. Speak or Play audio) held by an AttachmentStore, either in memory or in a
+    memory-mapped temporary file. `release` returns its memory (or disk space) to the store; it must not be used
+    afterwards.
+    """
+    __slots__ = ('_store', '_data', '_map', '_file', '_path', '_size')
+
+    def __init__(self, store, size, data=None, file=None, path=None):
+        self._store = store
+        self._size = size
+        self._data = data
+        self._file = file
+        self._path = path
+        self._map = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) if file is not None and size else None
+
+    @property
+    def spilled(self):
+        """
+        :return: True if the content is held in a temporary file rather than in memory
+        """
+        return self._file is not None
+
+    def view(self):
+        """
+        :return: memoryview of the content, without copying it
+        """
+        if self._map is not None:
+            return memoryview(self._map)
+        return memoryview(self._data or b'')
+
+    def path(self, suffix='.mp3'):
+        """
+        :param suffix: str file name suffix used if the content has to be written out, eg. for the player's benefit
+        :return: str path to a file holding the content. spilled attachments are played from their temporary file;
+            in-memory ones are written out once, to a file deleted on `release`
+        """
+        if self._path is None:
+            fd, self._path = tempfile.mkstemp(suffix, 'avs-', self._store.directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.view())
+        return self._path
+
+    def release(self):
+        """
+        free the content. safe to call more than once
+        """
+        if self._store is None:
+            return
+        store, self._store = self._store, None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                logger.warning("attachment released while views of it are still in use")
+        if self._file is not None:
+            self._file.close()
+        if self._path is not None:
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+        self._data = None
+        store._released(self)
+
+    def __len__(self):
+        return self._size
+
+    def __repr__(self):
+        return '<Attachment {} bytes{}>'.format(self._size, ' spilled' if self.spilled else '')
+
+
+class AttachmentStore:
+    """
+    keeps multipart attachments within a global memory budget.
+
+    attachments smaller than `spill_threshold` are copied into memory while the budget allows; larger ones, and any
+    that would exceed the budget, are written to a memory-mapped temporary file, so the page cache rather than the
+    process heap holds them. attachments are released by their directive (or audio item) once it completes.
+    """
+    def __init__(self, memory_budget=8 * 1024 * 1024, spill_threshold=256 * 1024, directory=None):
+        """
+        :param memory_budget: int bytes of attachment content held in memory at most
+        :param spill_threshold: int size from which attachments always go to disk
+        :param directory: str directory for temporary files. defaults to the system temporary directory
+        """
+        self.memory_budget = memory_budget
+        self.spill_threshold = spill_threshold
+        self.directory = directory
+        self._lock = threading.Lock()
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+        self.peak_memory_bytes = 0
+        self.attachments = 0
+
+    def put(self, data):
+        """
+        :param data: bytes-like content, eg. a memoryview into a response body. it is copied (to memory or disk), so
+            the body can be freed afterwards
+        :return: Attachment
+        """
+        size = len(data)
+        with self._lock:
+            in_memory = size < self.spill_threshold and self.memory_bytes + size <= self.memory_budget
+            if in_memory:
+                self.memory_bytes += size
+                self.peak_memory_bytes = max(self.peak_memory_bytes, self.memory_bytes)
+            else:
+                self.spilled_bytes += size
+            self.attachments += 1
+        if in_memory:
+            return Attachment(self, size, data=bytes(data))
+        # the file keeps its name, so the audio device can play it directly
+        fd, path = tempfile.mkstemp('.mp3', 'avs-', self.directory)
+        f = os.fdopen(fd, 'w+b')
+        f.write(data)
+        f.flush()
+        return Attachment(self, size, file=f, path=path)
+
+    def _released(self, attachment):
+        with self._lock:
+            if attachment.spilled:
+                self.spilled_bytes -= len(attachment)
+            else:
+                self.memory_bytes -= len(attachment)
+            self.attachments -= 1
+
+    def metrics(self):
+        """
+        :return: dict of attachment counts and bytes held
+        """
+        return {
+            "attachments": self.attachments,
+            "memory_bytes": self.memory_bytes,
+            "peak_memory_bytes": self.peak_memory_bytes,
+            "spilled_bytes": self.spilled_bytes
+        }
@@ -0,0 +1,168 @@
+import logging
+import queue
+import threading
+import time
+
+import opuslib
+
+from speech_recognizer import AudioInputDevice, OPUS
+
+logger = logging.getLogger(__name__)
+
+# AVS speech input is 16 bit little-endian PCM, 16 kHz, mono
+_SAMPLE_RATE = 16000
+_SAMPLE_WIDTH = 2
+
+
+class EncoderStatistics:
+    """
+    per-utterance encoder accounting
+    """
+    def __init__(self):
+        self.frames = 0
+        self.pcm_bytes = 0
+        self.encoded_bytes = 0
+        self.encode_seconds = 0.0
+
+    @property
+    def compression_ratio(self):
+        """
+        :return: float PCM bytes per encoded byte, or None before any audio was encoded
+        """
+        if not self.encoded_bytes:
+            return None
+        return self.pcm_bytes / self.encoded_bytes
+
+    def to_dict(self):
+        return {
+            "frames": self.frames,
+            "pcm_bytes": self.pcm_bytes,
+            "encoded_bytes": self.encoded_bytes,
+            "compression_ratio": self.compression_ratio,
+            "encode_ms": self.encode_seconds * 1000
+        }
+
+    def __repr__(self):
+        return '<EncoderStatistics {}>'.format(self.to_dict())
+
+
+class OpusAudioInputDevice(AudioInputDevice):
+    """
+    AudioInputDevice wrapper that encodes the 16 kHz mono L16 stream of another AudioInputDevice to Opus (CBR, 20 ms
+    frames) for Recognize uploads.
+
+    encoding runs on its own thread, which reads from the wrapped device and hands encoded frames to `read` through a
+    bounded queue. when the uploader falls `max_buffered_frames` behind, the encoder thread blocks rather than growing
+    the buffer. statistics for the current or most recent utterance are available as `statistics`.
+    """
+    audio_format = OPUS
+
+    def __init__(self, device, bitrate=32000, frame_ms=20, max_buffered_frames=50):
+        """
+        :param device: AudioInputDevice providing 16 kHz mono L16 audio
+        :param bitrate: int Opus bitrate in bits per second
+        :param frame_ms: int Opus frame duration in milliseconds
+        :param max_buffered_frames: int encoded frames buffered between the encoder thread and `read`
+        """
+        self._device = device
+        self._bitrate = bitrate
+        self._frame_samples = _SAMPLE_RATE * frame_ms // 1000
+        self._frame_bytes = self._frame_samples * _SAMPLE_WIDTH
+        self._max_buffered_frames = max_buffered_frames
+        self._queue = None
+        self._buffer = b''
+        self._eof = True
+        self._thread = None
+        self._stop_event = None
+        self.statistics = None
+
+    def _new_encoder(self):
+        encoder = opuslib.Encoder(_SAMPLE_RATE, 1, opuslib.APPLICATION_VOIP)
+        encoder.bitrate = self._bitrate
+        encoder.vbr = 0
+        return encoder
+
+    def _stop_encoder(self, timeout=1.0):
+        """
+        stop the encoder thread of the previous utterance, so that it doesn't read audio of the next one
+
+        :param timeout: float seconds to wait for the thread to finish
+        """
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._stop_event.set()
+        if thread.is_alive():
+            # unblocks the thread if it is waiting for audio
+            self._device.stop_recording()
+            thread.join(timeout)
+            if thread.is_alive():
+                logger.warning("previous encoder thread did not finish within {}s".format(timeout))
+
+    def start_recording(self):
+        self._stop_encoder()
+        self._queue = queue.Queue(self._max_buffered_frames)
+        self._buffer = b''
+        self._eof = False
+        self._stop_event = threading.Event()
+        self.statistics = EncoderStatistics()
+        self._device.start_recording()
+        self._thread = threading.Thread(target=self._encode,
+                                        args=(self._new_encoder(), self._queue, self.statistics, self._stop_event),
+                                        name='Opus Encoder Thread')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @staticmethod
+    def _put(packets, packet, stop_event):
+        """
+        :param packets: queue.Queue of encoded frames
+        :param packet: bytes encoded frame, or None at the end of the utterance
+        :param stop_event: threading.Event set when the utterance's frames are no longer read
+        :return: True if the frame was queued, False if the encoder was stopped while the queue was full
+        """
+        while not stop_event.is_set():
+            try:
+                packets.put(packet, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _encode(self, encoder, packets, statistics, stop_event):
+        try:
+            while not stop_event.is_set():
+                pcm = self._device.read(self._frame_bytes)
+                if pcm:
+                    start = time.perf_counter()
+                    # opus only encodes whole frames; the last partial frame is padded with silence
+                    packet = encoder.encode(pcm.ljust(self._frame_bytes, b'\x00'), self._frame_samples)
+                    statistics.encode_seconds += time.perf_counter() - start
+                    statistics.frames += 1
+                    statistics.pcm_bytes += len(pcm)
+                    statistics.encoded_bytes += len(packet)
+                    if not self._put(packets, packet, stop_event):
+                        break
+                if len(pcm) < self._frame_bytes:
+                    break
+        except Exception:
+            logger.exception("error while encoding audio")
+        finally:
+            self._put(packets, None, stop_event)
+            logger.info("finished encoding utterance: {}".format(statistics))
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            packet = self._queue.get()
+            if packet is None:
+                self._eof = True
+            else:
+                self._buffer += packet
+        if size < 0:
+            size = len(self._buffer)
+        ret = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return ret
+
+    def stop_recording(self):
+        self._device.stop_recording()
@@ -1,10 +1,14 @@
 import logging
-import uuid
+import threading
+import time
 
-from directives import generate_payload
+import event_templates
 
 logger = logging.getLogger(__name__)
 
+# seconds between `ended` checks when waiting on a playback handle that can't be waited on directly
+_WAIT_POLL_INTERVAL = 0.05
+
 # audio player states
 IDLE = 'IDLE'
 PLAYING = 'PLAYING'
@@ -14,117 +18,6 @@ STOPPED = 'STOPPED'
 PAUSED = 'PAUSED'
 
 
-def generate_playback_started_event(token, offset=0):
-    """
-    https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/audioplayer#playbackstarted
-
-    :param token: str token of the previous content
-    :param offset: int offset in milliseconds of the previous content
-    :return: dict event payload
-    """
-    return {
-        "event": {
-            "header": {
-                "namespace": "AudioPlayer",
-                "name": "PlaybackStarted",
-                "messageId": str(uuid.uuid4()),
-            },
-            "payload": {
-                "token": token,
-                "offsetInMilliseconds": offset
-            }
-        }
-    }
-
-
-def generate_playback_nearly_finished_event(token, offset=0):
-    """
-    https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/audioplayer#playbacknearlyfinished
-
-    :param token: str token of the current content
-    :param offset: int offset in milliseconds of the current content
-    :return: dict event payload
-    """
-    return {
-        "event": {
-            "header": {
-                "namespace": "AudioPlayer",
-                "name": "PlaybackNearlyFinished",
-                "messageId": str(uuid.uuid4()),
-            },
-            "payload": {
-                "token": token,
-                "offsetInMilliseconds": offset
-            }
-        }
-    }
-
-
-def generate_playback_finished_event(token, offset=0):
-    """
-    https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/audioplayer#playbackfinished
-
-    :param token: str token of the previous content
-    :param offset: int offset in milliseconds of the previous content
-    :return: dict event payload
-    """
-    return {
-        "event": {
-            "header": {
-                "namespace": "AudioPlayer",
-                "name": "PlaybackStarted",
-                "messageId": str(uuid.uuid4()),
-            },
-            "payload": {
-                "token": token,
-                "offsetInMilliseconds": offset
-            }
-        }
-    }
-
-
-def generate_playback_stopped_event(token, offset=0):
-    """
-    https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/audioplayer#playbackstopped
-
-    :param token: str token of the previous content
-    :param offset: int offset in milliseconds of the previous content
-    :return: dict event payload
-    """
-    return {
-        "event": {
-            "header": {
-                "namespace": "AudioPlayer",
-                "name": "PlaybackStopped",
-                "messageId": str(uuid.uuid4())
-            },
-            "payload": {
-                "token": token,
-                "offsetInMilliseconds": offset
-            }
-        }
-    }
-
-
-def generate_playback_queue_cleared_event():
-    """
-    https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/audioplayer#playbackqueuecleared
-
-    :return: dict event payload
-    """
-    return {
-        "event": {
-            "header": {
-                "namespace": "AudioPlayer",
-                "name": "PlaybackQueueCleared",
-                "messageId": str(uuid.uuid4())
-            },
-            "payload": {
-            }
-        }
-    }
-
-
 class AudioDevice:
     """
     abstract class for audio device
@@ -156,6 +49,18 @@ class AudioDevice:
         """
         raise NotImplementedError
 
+    def seek(self, p, offset_in_milliseconds, byte_position=None):
+        """
+        move playback of the audio controlled by handle `p` to `offset_in_milliseconds`, eg. right after it was started
+        to resume it part way through
+
+        :param p: handle to audio playback
+        :param offset_in_milliseconds: int offset from the start of the audio
+        :param byte_position: int position in the file or stream corresponding to the offset, if known. seeking
+            to it lets HTTP streams be requested from there with a Range request, without reading up to it first
+        """
+        raise NotImplementedError
+
     def stop(self, p):
         """
         stop playback of the audio controlled by handle `p`
@@ -177,22 +82,83 @@ class AudioDevice:
         """
         raise NotImplementedError
 
+    def set_volume(self, p, volume):
+        """
+        set the volume of the audio controlled by handle `p`, eg. to duck it under speech
+
+        :param p: handle to audio playback
+        :param volume: int volume in percent
+        """
+        raise NotImplementedError
+
     def ended(self, p):
         """
         :return: True if the audio controlled by handle `p` has finished playback, False otherwise
         """
         raise NotImplementedError
 
+    def wait(self, p):
+        """
+        block until the audio controlled by handle `p` has finished playback. waits on `p` directly if it is a
+        process (eg. subprocess.Popen), otherwise polls `ended`.
+
+        :param p: handle to audio playback
+        :return: int exit status of the player process, or None if `p` is not a process
+        """
+        if hasattr(p, 'wait'):
+            return p.wait()
+        while not self.ended(p):
+            time.sleep(_WAIT_POLL_INTERVAL)
+
+    def watch(self, p, on_finished, on_error=None):
+        """
+        call `on_finished(p)` as soon as the audio controlled by handle `p` finishes playback, or `on_error(p, error)`
+        if the player failed. the callback is made from a watcher thread, which waits using `wait`. devices that learn
+        about the end of playback some other way should override this.
+
+        :param p: handle to audio playback
+        :param on_finished: callable taking the handle
+        :param on_error: callable taking the handle and an Exception. if not given, `on_finished` is called instead
+        """
+        def watcher():
+            try:
+                status = self.wait(p)
+                if status:
+                    raise RuntimeError("player exited with status {}".format(status))
+            except Exception as e:
+                if on_error is not None:
+                    on_error(p, e)
+                    return
+            on_finished(p)
+
+        t = threading.Thread(target=watcher, name='Audio Watcher Thread')
+        t.daemon = True
+        t.start()
+
 
 class Player:
     """
     audio player state machine
+
+    the end of playback is reported by the audio device's watch callback, which moves to the Finished state and
+    starts the next queued item straight away. transitions are made under a lock, since they happen both on the
+    callback thread and the main loop. the lock is never held across a network round trip: events are queued on the
+    AVS client's background event sender, in order, and the next item's stream is resolved before the lock is taken.
     """
     def __init__(self, avs):
         self._avs = avs
+        self._lock = threading.RLock()
         self._state = IDLE
         self._currently_playing = None
         self._queue = []
+        # item taken off the queue whose stream is being resolved, or None. cleared to cancel its start
+        self._starting = None
+        self._started_at = None
+        self._start_offset = 0
+        # offset of the most recent item when it finished or was stopped
+        self._final_offset = 0
+        # volume in percent content is played at while ducked, or None
+        self._ducked_volume = None
 
     def get_currently_playing(self):
         return self._currently_playing
@@ -200,80 +166,252 @@ class Player:
     def get_state(self):
         return self._state
 
-    def _play(self, audio_item):
+    def get_offset(self):
+        """
+        :return: int offset in milliseconds into the item being played, counted from the offset it was started at, or
+            where the most recent item ended
+        """
+        if self._state == PLAYING:
+            return self._start_offset + int((time.monotonic() - self._started_at) * 1000)
+        return self._final_offset
+
+    def _set_state(self, state):
+        """
+        move the state machine to `state`, reporting the transition to the AVS tracer
+
+        :param state: str one of the audio player states
+        """
+        self._avs.tracer.instant('player_state', 'player', previous=self._state, state=state,
+                                 token=self._currently_playing.stream.token if self._currently_playing else None)
+        self._state = state
+        self._avs._context_changed()
+
+    def _play(self, audio_item, location):
         """
         start playback of audio specified by `audio_item`. sends PlaybackStartedEvent. if 1 or fewer items are present
-        in the queue, sends PlaybackNearlyFinishedEvent.
+        in the queue, sends PlaybackNearlyFinishedEvent. both are sent in the background.
 
         :param audio_item: directives.AudioItem
+        :param location: tuple of (str path or URL, bool playlist) as returned by `audio_item.get_file_path`
+        :return: True if playback started. otherwise PlaybackFailedEvent is sent and the state is left unchanged
         """
-        payload = generate_payload(generate_playback_started_event(audio_item.stream.token))
-        logging.debug("PLAYBACK STARTED RESPONSE: {}".format(self._avs.send_event_parse_response(payload)))
-        audio_item._process = self._avs.audio_device.play_once(*audio_item.get_file_path())
+        offset = audio_item.stream.offset_in_milliseconds or 0
+        audio_item.process = self._avs.audio_device.play_once(*location)
+        if audio_item.process is None:
+            logger.warning("unable to start playback of {}".format(audio_item.stream.token))
+            current_state = {"token": audio_item.stream.token, "offsetInMilliseconds": offset,
+                             "playerActivity": self._state}
+            self._avs.send_event_async(event_templates.PLAYBACK_FAILED.payload(
+                audio_item.stream.token, current_state,
+                {"type": "MEDIA_ERROR_UNKNOWN", "message": "unable to start playback"}))
+            return False
+        if offset:
+            self._seek(audio_item, offset)
+        if self._ducked_volume is not None:
+            self._set_volume(audio_item, self._ducked_volume)
         self._currently_playing = audio_item
-        self._state = PLAYING
+        self._started_at = time.monotonic()
+        self._start_offset = offset
+        self._set_state(PLAYING)
+        # events are sent in the background, so the lock isn't held across their round trips
+        self._avs.send_event_async(event_templates.PLAYBACK_STARTED.payload(audio_item.stream.token, offset))
         # TODO: this is not really the condition to send nearly_finished according to the docs...
         if len(self._queue) <= 1:
-            payload = generate_payload(generate_playback_nearly_finished_event(self._currently_playing.stream.token))
-            self._avs.handle_parts(self._avs.send_event_parse_response(payload))
+            self._avs.send_event_async(event_templates.PLAYBACK_NEARLY_FINISHED.payload(
+                self._currently_playing.stream.token, self.get_offset()))
+        self._avs.audio_device.watch(audio_item.process,
+                                     lambda p: self._on_finished(audio_item),
+                                     lambda p, error: self._on_error(audio_item, error))
+        return True
+
+    def _seek(self, audio_item, offset):
+        """
+        start playback of `audio_item` at `offset`, by byte position when the stream's bitrate is known
 
-    def _item_finished(self):
+        :param audio_item: directives.AudioItem just started
+        :param offset: int offset in milliseconds
         """
-        helper function to check if an item being played has finished
-        :return: True if an item being played has finished, False otherwise
+        byte_position = audio_item.get_byte_position(self._avs.stream_resolver)
+        logger.info("starting {} at {}ms (byte {})".format(audio_item.stream.token, offset, byte_position))
+        try:
+            self._avs.audio_device.seek(audio_item.process, offset, byte_position)
+        except NotImplementedError:
+            logger.warning("audio device can't seek, playing {} from the start".format(audio_item.stream.token))
+
+    def _set_volume(self, audio_item, volume):
         """
-        return self._state == PLAYING and self._avs.audio_device.ended(self._currently_playing.process)
+        :param audio_item: directives.AudioItem being played
+        :param volume: int volume in percent
+        :return: True if the audio device changed the volume, False if it can't
+        """
+        try:
+            self._avs.audio_device.set_volume(audio_item.process, volume)
+            return True
+        except NotImplementedError:
+            return False
+
+    def _stopped(self, state):
+        """
+        record where the item being played ended and move to `state`
+
+        :param state: str FINISHED or STOPPED
+        """
+        self._final_offset = self.get_offset()
+        self._set_state(state)
 
     def _item_playing(self):
         """
         helper function to check if an item is being played
         :return: True if an item is being played, False otherwise
         """
-        return self._state == PLAYING and not self._avs.audio_device.ended(self._currently_playing.process)
+        return self._state == PLAYING
 
-    def run(self):
+    def _is_current(self, audio_item):
+        """
+        :return: True if `audio_item` is the item being played. callbacks for items that were stopped are ignored
+        """
+        return self._state == PLAYING and self._currently_playing is audio_item
+
+    def _play_next(self):
         """
-        state machine progression:
-            * if an item being played has finished, send PlaybackFinishedEvent and move to the Finished state
-            * if in the Idle, Stopped, or Finished states, play the next item in the queue
+        if in the Idle, Stopped, or Finished states, play the next item in the queue. its stream is resolved without
+        holding the lock; if the queue was cleared or another item started meanwhile, the item is dropped
+        """
+        with self._lock:
+            if self._state not in [IDLE, STOPPED, FINISHED] or not self._queue or self._starting is not None:
+                return
+            audio_item = self._starting = self._queue.pop(0)
+        try:
+            location = audio_item.get_file_path(self._avs.stream_resolver)
+        except Exception:
+            logger.exception("unable to resolve {}".format(audio_item.stream.token))
+            location = None
+        failed = False
+        with self._lock:
+            if self._starting is audio_item:
+                self._starting = None
+                if location is not None and self._state in [IDLE, STOPPED, FINISHED]:
+                    if self._play(audio_item, location):
+                        return
+                    failed = True
+        audio_item.release()
+        if failed:
+            # as after a playback error, the next item is played
+            self._play_next()
+
+    def _on_finished(self, audio_item):
+        """
+        audio device callback: send PlaybackFinishedEvent, move to the Finished state and play the next item
 
-        TODO: check if it encountered errors/buffer underrun
+        :param audio_item: directives.AudioItem that finished playback
         """
-        if self._item_finished():
-            logging.debug("PLAYBACK FINISHED RESPONSE: {}".format(
-                self._avs.send_event_parse_response(
-                    generate_payload(generate_playback_finished_event(self._currently_playing.stream.token)))))
+        with self._lock:
+            if not self._is_current(audio_item):
+                return
             logging.info("audio player state changing to: FINISHED")
+            self._stopped(FINISHED)
+            self._avs.send_event_async(event_templates.PLAYBACK_FINISHED.payload(audio_item.stream.token,
+                                                                                 self._final_offset))
+            self._currently_playing = None
+            audio_item.release()
+        self._play_next()
+
+    def _on_error(self, audio_item, error):
+        """
+        audio device callback: send PlaybackFailedEvent, move to the Stopped state and play the next item
+
+        :param audio_item: directives.AudioItem that failed
+        :param error: Exception reported by the audio device
+        """
+        with self._lock:
+            if not self._is_current(audio_item):
+                return
+            logger.warning("playback of {} failed: {}".format(audio_item.stream.token, error))
+            current_state = {"token": audio_item.stream.token, "offsetInMilliseconds": self.get_offset(),
+                             "playerActivity": self._state}
+            self._stopped(STOPPED)
+            self._avs.send_event_async(event_templates.PLAYBACK_FAILED.payload(
+                audio_item.stream.token, current_state, {"type": "MEDIA_ERROR_UNKNOWN", "message": str(error)}))
             self._currently_playing = None
-            self._state = FINISHED
-        if self._state in [IDLE, STOPPED, FINISHED] and self._queue:
-            self._play(self._queue.pop(0))
+            audio_item.release()
+        self._play_next()
+
+    def run(self):
+        """
+        state machine progression: if in the Idle, Stopped, or Finished states, play the next item in the queue. the
+        end of playback is handled by the audio device callbacks.
 
-    def stop(self):
+        TODO: check if it encountered buffer underrun
+        """
+        self._play_next()
+
+    def stop(self, asynchronous=False):
         """
         stop playback of the audio item being played, send PlaybackStoppedEvent and move to the Stopped state.
+
+        :param asynchronous: bool send PlaybackStoppedEvent in the background rather than waiting for its response,
+            eg. on barge-in where the Recognize that follows shouldn't wait for it
+        :return: True if an item was stopped
+        """
+        with self._lock:
+            if self._item_playing():
+                self._avs.audio_device.stop(self._currently_playing.process)
+                payload = event_templates.PLAYBACK_STOPPED.payload(
+                    self._currently_playing.stream.token if self._currently_playing else '', self.get_offset())
+                self._stopped(STOPPED)
+                self._currently_playing.release()
+            else:
+                logger.warning("called stop() while not playing (state: {})".format(self._state))
+                return False
+        # sent after any event still queued for the item, eg. its PlaybackStarted
+        future = self._avs.send_event_async(payload)
+        if not asynchronous:
+            future.result()
+        return True
+
+    def duck(self, volume):
+        """
+        lower the volume of the item being played, and of any item started, until `unduck` is called
+
+        :param volume: int volume in percent
+        :return: True if the volume was lowered, False if nothing is playing or the audio device has no volume control
+        """
+        with self._lock:
+            if not self._item_playing() or not self._set_volume(self._currently_playing, volume):
+                return False
+            self._ducked_volume = volume
+            return True
+
+    def unduck(self):
+        """
+        restore the full volume after `duck`
         """
-        if self._item_playing():
-            self._avs.audio_device.stop(self._currently_playing.process)
-            self._avs.send_event_parse_response(generate_payload(generate_playback_stopped_event(
-                self._currently_playing.stream.token if self._currently_playing else '')))
-            self._state = STOPPED
-        else:
-            logger.warning("called stop() while not playing (state: {})".format(self._state))
+        with self._lock:
+            if self._ducked_volume is None:
+                return
+            self._ducked_volume = None
+            if self._item_playing():
+                self._set_volume(self._currently_playing, 100)
 
     def enqueue(self, audio_item):
         """
         add an audio stream to the play queue
         :param audio_item: directives.AudioItem
         """
-        self._queue.append(audio_item)
+        with self._lock:
+            self._queue.append(audio_item)
 
     def clear_queue(self):
         """
         clear the play queue. sends PlaybackQueueClearedEvent
         """
-        self._queue.clear()
-        self._avs.send_event_parse_response(generate_payload(generate_playback_queue_cleared_event()))
+        with self._lock:
+            for audio_item in self._queue:
+                audio_item.release()
+            self._queue.clear()
+            # an item being resolved is released by `_play_next`
+            self._starting = None
+        self._avs.send_event_parse_response(event_templates.PLAYBACK_QUEUE_CLEARED.payload())
 
     def pause(self):
         # TODO
@@ -1,31 +1,74 @@
+import concurrent.futures
 import io
 import logging
 import sched
 import threading
+import time
 import ujson as json
 import uuid
 import datetime
 
 from h2.exceptions import StreamClosedError
-from requests_toolbelt import MultipartEncoder
-from requests_toolbelt.multipart.encoder import total_len
 
+import attachments
 import audio_player
+import connection
+import directive_queue
+import event_templates
+import keepalive
+import session_recorder
 import speech_synthesizer
+import stream_resolver
+import tracing
+import transport
 from directives import to_directive, generate_payload
-from hyper import HTTP20Connection as HTTPConnection
-
-from speech_recognizer import SPEECH_CLOUD_ENDPOINTING_PROFILES
-from util import request_new_tokens, is_directive, multipart_parse
+from speech_recognizer import SPEECH_CLOUD_ENDPOINTING_PROFILES, AUDIO_L16_RATE_16000_CHANNELS_1
+from util import request_new_tokens, is_directive, multipart_parse, total_len
 
 logger = logging.getLogger(__name__)
-_PING_RATE = 300
 _RECOGNIZE_METADATA_PART_HEADER = b'Content-Disposition: form-data; name="metadata"\nContent-Type: application/json; ' \
                                   b'charset=UTF-8\r\n\r\n'
 _RECOGNIZE_AUDIO_PART_HEADER = b'Content-Disposition: form-data; name="audio"\nContent-Type: ' \
                                b'application/octet-stream\r\n\r\n'
 
 
+def event_ids(payload):
+    """
+    :param payload: event request body, eg. event_templates.MultipartPayload, or None
+    :return: dict of the messageId and dialogRequestId of the event, to correlate spans with. empty if the payload
+        carries no event header
+    """
+    header = getattr(payload, 'header', None) or {}
+    return {key: header[key] for key in ('messageId', 'dialogRequestId') if key in header}
+
+
+class PreparedRecognize:
+    """
+    a Recognize event serialized ahead of time: the event, its multipart boundary, the multipart preamble (metadata
+    part and audio part header) and epilogue. only the audio remains to be sent.
+    """
+    def __init__(self, event, context_generation):
+        """
+        :param event: dict Recognize event payload
+        :param context_generation: int AVS context generation the event's context was generated at
+        """
+        self.event = event
+        self.context_generation = context_generation
+        self.boundary_term = str(uuid.uuid4())
+        boundary_separator = b'--' + self.boundary_term.encode('utf8') + b'\r\n'
+        self.preamble = b''.join([boundary_separator,
+                                  _RECOGNIZE_METADATA_PART_HEADER,
+                                  json.dumps(event).encode('utf8'),
+                                  b'\r\n\r\n',
+                                  boundary_separator,
+                                  _RECOGNIZE_AUDIO_PART_HEADER])
+        self.epilogue = b'\r\n--' + self.boundary_term.encode('utf8') + b'--\r\n'
+
+    @property
+    def dialog_request_id(self):
+        return self.event['event']['header']['dialogRequestId']
+
+
 class AVS:
     """
     AVS client. creates and maintains a connection to AVS and provides methods to handle directives and send events.
@@ -39,7 +82,14 @@ class AVS:
                  audio_device,
                  audio_input_device,
                  speech_profile,
-                 host='avs-alexa-na.amazon.com'):
+                 host='avs-alexa-na.amazon.com',
+                 tracer=None,
+                 warm_recognize=False,
+                 recorder=None,
+                 connection_settings=None,
+                 attachment_store=None,
+                 resolver=None,
+                 connection_transport=None):
         """
         connects to AVS and synchronizes state
 
@@ -49,8 +99,22 @@ class AVS:
         :param client_id: str
         :param client_secret: str
         :param host: str hostname to connect to (always https on 443). defaults to 'avs-alexa-na.amazon.com'
+        :param tracer: tracing.Tracer to report request and directive pipeline spans to. a tracer without hooks is
+            created if not given, which can have hooks added later via `avs.tracer.add_hook`
+        :param warm_recognize: bool keep a streaming Recognize event prepared from the run loop, refreshed whenever
+            the context changes, so that `recognize_speech` only has to open the stream and pump audio
+        :param recorder: session_recorder.SessionRecorder to record outbound requests, event responses and downchannel
+            pushes to
+        :param connection_settings: connection.ConnectionSettings HTTP/2 settings and flow-control policy. defaults to
+            the protocol defaults
+        :param attachment_store: attachments.AttachmentStore holding Speak and Play audio until it has been played.
+            defaults to a store with an 8 MB memory budget
+        :param resolver: stream_resolver.StreamResolver resolving AudioPlayer stream URLs ahead of playback
+        :param connection_transport: transport.Transport opening the connection's sockets. defaults to one caching DNS
+            results and resuming TLS sessions, without a standby connection
         """
         self.version = version
+        self.tracer = tracer or tracing.Tracer()
         self.host = host
         self._access_token = access_token
         self._refresh_token = refresh_token
@@ -59,10 +123,11 @@ class AVS:
         self._volume = 20
         self._muted = False
         self._alerts = []
-        self._directives = []
+        self._directives = directive_queue.DirectiveQueue()
+        self.attachments = attachment_store or attachments.AttachmentStore()
+        self.stream_resolver = resolver or stream_resolver.StreamResolver()
         self.player = audio_player.Player(self)
-        self._speech_token = None
-        self._speech_state = speech_synthesizer.FINISHED
+        self.speech_synthesizer = speech_synthesizer.SpeechSynthesizer(self)
         # scheduler is threadsafe as of 3.3 (https://docs.python.org/3/library/sched.html)
         self.scheduler = sched.scheduler()
         self.audio_device = audio_device
@@ -72,28 +137,111 @@ class AVS:
         self._stopping = threading.Event()
         self._current_dialog_request_id = None
         self.expect_speech_timeout_event = None
-
-        logger.info("Connecting...")
+        self._warm_recognize = warm_recognize
+        self._prepared_recognize = None
+        # incremented whenever state reported in the context changes, invalidating prepared Recognize events
+        self._context_generation = 0
+        # seconds from the last Recognize trigger to its first byte being handed to the connection
+        self.last_recognize_first_byte_latency = None
+        # (dialogRequestId, token) of the most recently received Speak
+        self._last_speak = (None, None)
+        # (dialogRequestId, token of the Speak it follows) of the ExpectSpeech armed for a speculative Recognize, and
+        # the dialogRequestId of the ExpectSpeech whose speculative Recognize has been started
+        self._expect_speech_lock = threading.Lock()
+        self._expected_speech = None
+        self._speculative_dialog_request_id = None
+        # seconds from the last barge-in trigger until speech and content were silenced
+        self.last_barge_in_latency = None
+        # sends events in the background, one at a time and in order, eg. PlaybackStopped on barge-in
+        self._event_sender = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._recorder = recorder
+        # orders request body chunks by priority class and measures their queueing delay
+        self.send_scheduler = connection.SendScheduler()
+        self.connection_settings = connection_settings or connection.ConnectionSettings()
+        self.flow_control_statistics = connection.FlowControlStatistics()
+        # PINGs the connection, measuring round-trip time, and reconnects when it stops answering
+        self.keepalive = keepalive.KeepAlive(self.scheduler, self.reconnect, tracer=self.tracer)
+        self.transport = connection_transport or transport.Transport(tracer=self.tracer)
+        # transport.ConnectTimings of the most recent (re)connect
+        self.last_connect_timings = None
+        self._connect()
+
+    def _connection_options(self):
+        """
+        :return: dict of hyper.HTTP20Connection keyword arguments for connections to AVS
+        """
         # we have to force protocol to http2 here because the ALPN is failing or something
-        self._connection = HTTPConnection(self.host, 443, enable_push=True, force_proto='h2')
+        return dict(enable_push=True, force_proto='h2',
+                    window_manager=self.connection_settings.window_manager(self.flow_control_statistics))
+
+    def _open(self, http_connection):
+        """
+        make `http_connection` the connection to AVS: connect it if it isn't connected yet, establish the downchannel
+        stream and synchronize state
+
+        :param http_connection: transport.TransportConnection
+        """
+        self._connection = http_connection
+        self.connection_settings.apply(self._connection, self.flow_control_statistics)
         logger.info("Connected")
-        self.scheduler.enter(_PING_RATE, 1, self.send_ping)
+        timings = self._connection.timings
         logger.info("Establishing downchannel stream...")
+        start = time.perf_counter()
         self._downchannel_stream_id, self._dc_resp = self._establish_downstream_directives_channel()
+        timings.add(transport.DOWNCHANNEL, time.perf_counter() - start)
         logger.info("Established downchannel stream")
         logger.info("Synchronizing state with AVS...")
+        start = time.perf_counter()
         self.handle_parts(self.send_event_parse_response(generate_payload(self._generate_synchronize_state_event())))
+        timings.add(transport.SYNCHRONIZE, time.perf_counter() - start)
         logger.info("Synchronized state with AVS")
+        # only a fully opened connection is checked, so a failed reconnect is retried rather than left to PINGs
+        self.keepalive.attach(self._connection)
+
+    def _connect(self):
+        """
+        connects to AVS, establishes the downchannel stream, synchronizes state and starts the downchannel thread. a
+        standby connection is taken over if the transport has one ready
+        """
+        logger.info("Connecting...")
+        start = time.perf_counter()
+        standby = self.transport.take_standby()
+        try:
+            self._open(standby or self.transport.connection(self.host, 443, **self._connection_options()))
+        except Exception:
+            if standby is None:
+                raise
+            logger.warning("standby connection failed, opening a new one", exc_info=True)
+            standby.close()
+            self._open(self.transport.connection(self.host, 443, **self._connection_options()))
+        self.last_connect_timings = self._connection.timings
+        self.last_connect_timings.elapsed = time.perf_counter() - start
+        logger.info("Connected in {:.1f}ms: {}".format(self.last_connect_timings.elapsed * 1000,
+                                                       self.last_connect_timings))
+
+        http_connection = self._connection
 
         def downstream_directives():
-            while not self._stopping.is_set():
+            # a thread serves a single connection; `reconnect` starts a new one
+            while not self._stopping.is_set() and self._connection is http_connection:
                 # check directives
-                for push in self._dc_resp.read_chunked():
-                    logger.info("[{}] DOWNSTREAM DIRECTIVE RECEIVED: {}".format(datetime.datetime.now().isoformat(), push))
-                    parts = multipart_parse(push, self._dc_resp.headers['content-type'][0].decode())
-                    self.handle_parts(parts)
+                try:
+                    for push in self._dc_resp.read_chunked():
+                        logger.info("[{}] DOWNSTREAM DIRECTIVE RECEIVED: {}".format(datetime.datetime.now().isoformat(), push))
+                        content_type = self._dc_resp.headers['content-type'][0].decode()
+                        if self._recorder is not None:
+                            self._recorder.record(session_recorder.DOWNCHANNEL, push, content_type=content_type)
+                        parts = multipart_parse(push, content_type)
+                        self.handle_parts(parts)
+                except Exception:
+                    if self._connection is not http_connection:
+                        logger.info("downstream thread of replaced connection exiting")
+                        return
+                    raise
                 # TODO: reconnect when this happens
                 logger.warning("downstream finished read_chunked!")
+                if self._connection is not http_connection:
+                    return
                 logger.info("Establishing downchannel stream...")
                 self._downchannel_stream_id, self._dc_resp = self._establish_downstream_directives_channel()
                 logger.info("Established downchannel stream")
@@ -102,6 +250,8 @@ class AVS:
         self._ddt = threading.Thread(target=downstream_directives, name='Downstream Directives Thread')
         self._ddt.setDaemon(False)
         self._ddt.start()
+        if self.transport.standby:
+            self.transport.prewarm(self.host, 443, **self._connection_options())
 
     def _get_alert_state(self):
         """
@@ -169,9 +319,9 @@ class AVS:
                 "name": "SpeechState"
             },
             "payload": {
-                "token": self._speech_token or '',
-                "offsetInMilliseconds": self._get_speech_offset(),
-                "playerActivity": self._speech_state
+                "token": self.speech_synthesizer.get_token() or '',
+                "offsetInMilliseconds": self.speech_synthesizer.get_offset(),
+                "playerActivity": self.speech_synthesizer.get_state()
             }
         }
 
@@ -188,7 +338,8 @@ class AVS:
             self._get_speech_state()
         ]
 
-    def _make_request(self, method, endpoint, body=None, headers=None, read=False, close=True, raises=True):
+    def _make_request(self, method, endpoint, body=None, headers=None, read=False, close=True, raises=True,
+                      priority=connection.BACKGROUND):
         """
         request helper function. adds authorization header, wraps body in a chunked iterable, and streams request
         to server chunk by chunk. a chunked send is used so that locks are released between each chunk, allowing
@@ -203,6 +354,8 @@ class AVS:
         :param read: bool whether to read-out response. response content will be lost if True
         :param close: bool whether to close response. response content will be lost if True
         :param raises: bool whether raise an exception if response status code not in [200, 204]
+        :param priority: str connection priority class. body chunks of higher priority requests are sent first, and
+            the stream is given the class's HTTP/2 weight
         :return: tuple of stream ID and http response
         :raises AssertionError: if `raises`, raised when response status code is not in [200, 204]
         """
@@ -211,6 +364,7 @@ class AVS:
         else:
             local_headers = dict(headers)
         local_headers['authorization'] = 'Bearer {}'.format(self._access_token)
+        self.keepalive.note_activity()
         # TODO: not every request needs to be chunked. afaik only the Recognize request with NEAR/FAR_FIELD requires it
         if body and not hasattr(body, '__iter__'):
             class ChunkIterable:
@@ -231,21 +385,38 @@ class AVS:
             iterator = ChunkIterable(body)
         else:
             iterator = body
-        stream_id = self._connection.request_chunked(method,
-                                                     '/{}/{}'.format(self.version, endpoint),
-                                                     iterator,
-                                                     local_headers)
-        # else:
-        #     stream_id = self._connection.request(method, '/{}/{}'.format(self.version, endpoint), body, local_headers)
-        response = self._connection.get_response(stream_id)
-        if raises:
-            assert response.status in [200, 204], "{} {}".format(response.status, response.read().decode())
-            if response.status == 204:
-                logger.warning("Received empty response (204)")
-        if read:
-            response.read()
-        if close:
-            response.close()
+        if self._recorder is not None and iterator is not None:
+            sent = []
+            sent_at = time.time()
+            iterator = session_recorder.tee(iterator, sent)
+        with self.tracer.span('make_request', 'http', method=method, endpoint=endpoint, priority=priority,
+                              **event_ids(body)) as span:
+            # the stream is opened before its body is sent, so the body is scheduled on its own stream ID rather than
+            # whichever stream another thread opened last
+            stream_id = self._connection.putrequest(method, '/{}/{}'.format(self.version, endpoint))
+            for name, value in local_headers.items():
+                self._connection.putheader(name, value, stream_id)
+            if iterator is None:
+                self._connection.endheaders(final=True, stream_id=stream_id)
+            else:
+                self._connection.endheaders(stream_id=stream_id)
+                for chunk in self.send_scheduler.schedule(priority, iterator, self._connection,
+                                                          self.flow_control_statistics, stream_id):
+                    self._connection.send(chunk, stream_id=stream_id)
+                self._connection.send(b'', final=True, stream_id=stream_id)
+            if self._recorder is not None and iterator is not None:
+                self._recorder.record(session_recorder.REQUEST, b''.join(sent), sent_at, method=method,
+                                      endpoint=endpoint, content_type=local_headers.get('Content-Type'))
+            response = self._connection.get_response(stream_id)
+            if raises:
+                assert response.status in [200, 204], "{} {}".format(response.status, response.read().decode())
+                if response.status == 204:
+                    logger.warning("Received empty response (204)")
+            if read:
+                response.read()
+            if close:
+                response.close()
+            span.annotate(stream_id=stream_id, status=response.status)
         return stream_id, response
 
     def _generate_synchronize_state_event(self):
@@ -267,14 +438,14 @@ class AVS:
             }
         }
 
-    def _generate_recognize_speech_event(self, profile):
+    def _generate_recognize_speech_event(self, profile, audio_format=AUDIO_L16_RATE_16000_CHANNELS_1):
         """
         https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/speechrecognizer#recognize
 
         :param profile: str ASR profile to use, eg. CLOSE_TALK or NEAR_FIELD
+        :param audio_format: str format of the uploaded audio, eg. AUDIO_L16_RATE_16000_CHANNELS_1 or OPUS
         :return: dict event payload
         """
-        self._current_dialog_request_id = str(uuid.uuid4())
         return {
             "context": self._generate_context(),
             "event": {
@@ -282,102 +453,202 @@ class AVS:
                     "namespace": "SpeechRecognizer",
                     "name": "Recognize",
                     "messageId": str(uuid.uuid4()),
-                    "dialogRequestId": self._current_dialog_request_id
+                    "dialogRequestId": str(uuid.uuid4())
                 },
                 "payload": {
                     "profile": profile,
-                    "format": "AUDIO_L16_RATE_16000_CHANNELS_1"
+                    "format": audio_format
                 }
             }
         }
 
-    def _generate_alert_started_event(self, alert):
-        """
-        https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/alerts#alertstarted
-
-        :param alert: Alert that was just started
-        :return:
-        """
-        return {
-            "event": {
-                "header": {
-                    "namespace": "Alerts",
-                    "name": "AlertStarted",
-                    "messageId": str(uuid.uuid4())
-                },
-                "payload": {
-                    "token": alert.token
-                }
-            }
-        }
-
-    def send_event_parse_response(self, payload):
+    def send_event_parse_response(self, payload, priority=connection.BACKGROUND):
         """
         wrapper method to make event request with payload as content and parse response into parts (assuming multipart
         response)
 
         :param payload: file-like or iterable
+        :param priority: str connection priority class, eg. connection.DIALOG for events that are part of a dialog
         :return: list of BodyPart elements
         """
         logger.info("Sending event request...")
         logger.info("Context: {}".format(json.dumps(self._generate_context())))
         ret = []
-        try:
-            _, resp = self._make_request('POST', 'events', payload, {'Content-Type': payload.content_type}, close=False)
-            logger.info("Sent event request")
-            logger.info("Retrieving event response...")
-            if 'content-type' in resp.headers:
-                ret = multipart_parse(resp.read(), resp.headers['content-type'][0].decode())
-            logger.info("Retrieved event response")
-            resp.close()
-        except StreamClosedError:
-            logger.exception("Stream closed during event send: {}".format(payload))
+        with self.tracer.span('send_event', 'event', **event_ids(payload)) as span:
+            try:
+                _, resp = self._make_request('POST', 'events', payload, {'Content-Type': payload.content_type},
+                                             close=False, priority=priority)
+                logger.info("Sent event request")
+                logger.info("Retrieving event response...")
+                if 'content-type' in resp.headers:
+                    content_type = resp.headers['content-type'][0].decode()
+                    data = resp.read()
+                    if self._recorder is not None:
+                        self._recorder.record(session_recorder.RESPONSE, data, content_type=content_type)
+                    ret = multipart_parse(data, content_type)
+                logger.info("Retrieved event response")
+                resp.close()
+            except StreamClosedError:
+                logger.exception("Stream closed during event send: {}".format(payload))
+            span.annotate(parts=len(ret))
 
         return ret
 
+    def send_event_async(self, payload, priority=connection.BACKGROUND):
+        """
+        send an event from a background thread, after any event sent this way before it, and handle the directives in
+        its response there
+
+        :param payload: file-like or iterable
+        :param priority: str connection priority class
+        :return: concurrent.futures.Future completing once the response has been handled
+        """
+        return self._event_sender.submit(self._send_event_handle_response, payload, priority)
+
+    def _send_event_handle_response(self, payload, priority):
+        try:
+            self.handle_parts(self.send_event_parse_response(payload, priority))
+        except Exception:
+            logger.exception("error while sending event in the background")
+
     def handle_parts(self, parts):
         """
         Process BodyParts of multipart response as directives and non-directives (or content). associates content
         with corresponding directive (if any), calls on_receive for each directive, and adds the directives to the
         directive list for final processing later.
 
-        :param parts: list of BodyPart
+        :param parts: list of (headers, data) parts as returned by util.multipart_parse
+        """
+        with self.tracer.span('handle_parts', 'directive', parts=len(parts)):
+            self._handle_parts(parts)
+
+    def _to_directive(self, data):
+        """
+        traced wrapper around directives.to_directive
+
+        :param data: dict part JSON object content
+        :return: Directive sub-class or None
+        """
+        with self.tracer.span('to_directive', 'directive') as span:
+            directive = to_directive(data)
+            if directive:
+                span.annotate(directive=directive.name,
+                              messageId=directive.message_id,
+                              dialogRequestId=directive.dialogRequestId)
+        return directive
+
+    def _handle_parts(self, parts):
+        """
+        body of `handle_parts`, run inside its tracing span
+
+        :param parts: list of (headers, data) parts as returned by util.multipart_parse
         """
         logging.debug("directives before before: {}".format(self._directives))
-        directives = [to_directive(data) for headers, data in filter(lambda x: is_directive(x[0], x[1]), parts)]
+        directives = [self._to_directive(data) for headers, data in filter(lambda x: is_directive(x[0], x[1]), parts)]
         non_directives = [(headers, data) for headers, data in filter(lambda x: not is_directive(x[0], x[1]), parts)]
 
         def consume_content(headers, data, _directives):
-            for _directive in (d for d in _directives if d):
-                if _directive.content_handler(headers, data):
-                    break
-            else:
-                return False
-            return True
+            # binary content is moved out of the response body into the attachment store; the directive that takes it
+            # releases it when it completes
+            if isinstance(data, memoryview):
+                data = self.attachments.put(data)
+            try:
+                for _directive in (d for d in _directives if d):
+                    if _directive.content_handler(headers, data):
+                        return True
+            except Exception:
+                logger.exception("error while matching content {} to a directive".format(headers))
+            if isinstance(data, attachments.Attachment):
+                data.release()
+            return False
 
         if not all(consume_content(headers, data, directives) for headers, data in non_directives):
             logger.warning("left over contents")
-        for directive in (d for d in directives if d and d.dialogRequestId in [None, self._current_dialog_request_id]):
-            directive.on_receive(self)
-        # TODO check if extend is thread-safe
-        self._directives.extend(d for d in directives if d and d.dialogRequestId == self._current_dialog_request_id)
-        self._directives[:0] = (d for d in directives if d and d.dialogRequestId is None)
+        for directive in (d for d in directives if d):
+            if directive.dialogRequestId not in [None, self._current_dialog_request_id]:
+                directive.release()
+                continue
+            try:
+                with self.tracer.span('on_receive', 'directive', directive=directive.name,
+                                      messageId=directive.message_id, dialogRequestId=directive.dialogRequestId):
+                    directive.on_receive(self)
+            except Exception:
+                # TODO: send ExceptionEncountered event
+                logger.exception("error while receiving {} directive {}".format(directive.name, directive.message_id))
+                directive.release()
+                continue
+            self._directives.put(directive)
         logging.debug("directives after after: {}".format(self._directives))
 
     def _handle_directives(self):
         """
-        process outstanding directives
+        process outstanding directives. see `directive_queue.DirectiveQueue.metrics` for backlog metrics
         """
+        def handle(directive):
+            with self.tracer.span('handle', 'directive', directive=directive.name, messageId=directive.message_id,
+                                  dialogRequestId=directive.dialogRequestId):
+                return directive.handle(self)
+
         if self._directives:
             logging.debug("directives before: {}".format(self._directives))
-            for directive in list(self._directives):
-                if not directive:
-                    self._directives.remove(directive)
-                if directive.handle(self):
-                    self._directives.remove(directive)
+            self._directives.process(handle)
             logging.debug("directives after: {}".format(self._directives))
 
-    def _generate_recognize_payload(self, audio):
+    def _context_changed(self):
+        """
+        called when state reported in the context (speech, playback, alerts, volume) changes
+        """
+        self._context_generation += 1
+
+    def _context_is_playing(self):
+        """
+        :return: True if speech or audio is playing, in which case the context's offsets change without
+            `_context_changed` being called
+        """
+        return self.speech_synthesizer.get_state() == speech_synthesizer.PLAYING or \
+            self.player.get_state() == audio_player.PLAYING
+
+    def _start_dialog(self, dialog_request_id):
+        """
+        make `dialog_request_id` the current dialog. directives for earlier dialogs are ignored from now on.
+
+        :param dialog_request_id: str
+        """
+        self._current_dialog_request_id = dialog_request_id
+        self._directives.set_dialog_request_id(dialog_request_id)
+
+    def _prepare_recognize(self):
+        """
+        :return: PreparedRecognize streaming the audio input device, with the current context
+        """
+        context_generation = self._context_generation
+        event = self._generate_recognize_speech_event(self.speech_profile,
+                                                      getattr(self._audio_input_device, 'audio_format',
+                                                              AUDIO_L16_RATE_16000_CHANNELS_1))
+        return PreparedRecognize(event, context_generation)
+
+    def _refresh_prepared_recognize(self):
+        """
+        prepare a Recognize event if none is prepared or the context changed since it was prepared
+        """
+        prepared = self._prepared_recognize
+        if self._context_is_playing():
+            # a prepared event would carry stale offsets
+            self._prepared_recognize = None
+        elif prepared is None or prepared.context_generation != self._context_generation:
+            self._prepared_recognize = self._prepare_recognize()
+
+    def _take_prepared_recognize(self):
+        """
+        :return: the prepared Recognize event if it is still current, otherwise a newly prepared one. a prepared event
+            is only ever used once
+        """
+        prepared, self._prepared_recognize = self._prepared_recognize, None
+        if prepared is None or prepared.context_generation != self._context_generation or self._context_is_playing():
+            prepared = self._prepare_recognize()
+        return prepared
+
+    def _generate_recognize_payload(self, audio, triggered_at=None):
         """
         prepare event payload for speech Recognize event. if the audio file-like does not specify a total length via
         __len__, len, or similar, it is assumed that audio is a continuous stream. in this case the NEAR_FIELD profile
@@ -385,29 +656,36 @@ class AVS:
         length of the audio can be determined, the CLOSE_TALK profile will be used.
 
         :param audio: file-like containing audio for request.
+        :param triggered_at: float time.monotonic() at which the request was triggered. used to record
+            `last_recognize_first_byte_latency` for streaming requests
         :return: file-like containing the payload for the http request
         """
-        event = self._generate_recognize_speech_event(self.speech_profile)
         if total_len(audio) is None:
-            boundary_term = str(uuid.uuid4())
-            boundary_separator = b'--' + boundary_term.encode('utf8') + b'\r\n'
-            body = b''.join([boundary_separator,
-                             _RECOGNIZE_METADATA_PART_HEADER,
-                             json.dumps(event).encode('utf8'),
-                             b'\r\n\r\n',
-                             boundary_separator,
-                             _RECOGNIZE_AUDIO_PART_HEADER])
-            epilogue = b'\r\n--' + boundary_term.encode('utf8') + b'--\r\n'
+            prepared = self._take_prepared_recognize()
+            self._start_dialog(prepared.dialog_request_id)
+            body = prepared.preamble
+            epilogue = prepared.epilogue
+            avs = self
 
             class MultiPartAudioFileLike:
                 def __init__(self):
                     self._audio_closed = False
-                    self.content_type = 'multipart/form-data; boundary={}'.format(boundary_term)
+                    self.content_type = 'multipart/form-data; boundary={}'.format(prepared.boundary_term)
+                    self.header = prepared.event['event']['header']
                     self._audio_buffer = b''
 
                 def read(self, size=-1):
                     nonlocal body
                     nonlocal epilogue
+                    nonlocal triggered_at
+                    if triggered_at is not None:
+                        avs.last_recognize_first_byte_latency = time.monotonic() - triggered_at
+                        avs.tracer.instant('recognize_first_byte', 'dialog',
+                                           dialogRequestId=prepared.dialog_request_id,
+                                           latency=avs.last_recognize_first_byte_latency)
+                        logger.info("Recognize trigger to first byte: {:.1f}ms".format(
+                            avs.last_recognize_first_byte_latency * 1000))
+                        triggered_at = None
                     ret = b''
                     if len(body):
                         ret = body[:size]
@@ -433,10 +711,17 @@ class AVS:
 
             return MultiPartAudioFileLike()
         else:
+            event = self._generate_recognize_speech_event(self.speech_profile,
+                                                          getattr(audio, 'audio_format',
+                                                                  AUDIO_L16_RATE_16000_CHANNELS_1))
+            self._start_dialog(event['event']['header']['dialogRequestId'])
+            # only needed for audio of known length; streaming Recognize events are encoded without it
+            from requests_toolbelt import MultipartEncoder
             payload = MultipartEncoder({
                 'metadata': (None, io.BytesIO(json.dumps(event).encode()), 'application/json'),
                 'audio': (None, audio, 'application/octet-stream')
             })
+            payload.header = event['event']['header']
         return payload
 
     def _establish_downstream_directives_channel(self):
@@ -463,10 +748,12 @@ class AVS:
         else:
             return ds_id, resp
 
-    def recognize_speech(self):
+    def recognize_speech(self, triggered_at=None):
         """
         send recognize speech event and process the response
 
+        :param triggered_at: float time.monotonic() of the trigger (eg. hotword detection). defaults to now
+
         :param speech: file-like containing speech for request
         :param mic_stop_event: threading.Event when speech is an infinite stream, to monitor for signal from
                                downchannel stream to end the recognize request.
@@ -474,34 +761,39 @@ class AVS:
         if self.speech_profile not in SPEECH_CLOUD_ENDPOINTING_PROFILES:
             if self.expect_speech_timeout_event:
                 self.scheduler.cancel(self.expect_speech_timeout_event)
-        self._audio_input_device.start_recording()
-        self.handle_parts(self.send_event_parse_response(self._generate_recognize_payload(self._audio_input_device)))
+        if triggered_at is None:
+            triggered_at = time.monotonic()
+        with self.tracer.span('recognize_speech', 'dialog') as span:
+            self._audio_input_device.start_recording()
+            payload = self._generate_recognize_payload(self._audio_input_device, triggered_at)
+            span.annotate(dialogRequestId=self._current_dialog_request_id)
+            self.handle_parts(self.send_event_parse_response(payload, connection.RECOGNIZE))
+        # content ducked by `barge_in` is played at full volume again once the response has been handled
+        self.player.unduck()
         logger.debug("Recognize dialog ID: {}".format(self._current_dialog_request_id))
 
     def _get_playback_offset(self):
         """
-        TODO: method to get playback offset from AudioPlayer interface
-
-        :return: int offset in milliseconds
-        """
-        return 0
-
-    def _get_speech_offset(self):
-        """
-        TODO: method to get playback offset from SpeechSynthesizer interface
-
-        :return: int offset in milliseconds
+        :return: int offset in milliseconds of the AudioPlayer
         """
-        return 0
+        return self.player.get_offset()
 
-    def send_ping(self):
+    def reconnect(self):
         """
-        self-scheduling task to send http2 PING every _PING_RATE seconds
+        drop the current connection and connect again. called by the keepalive when the connection stops answering
+        PINGs
         """
-        logger.debug("PINGING AVS")
-        self._connection.ping(b'\x00' * 8)
-        logger.info("PINGED AVS")
-        self.scheduler.enter(_PING_RATE, 1, self.send_ping)
+        logger.warning("Reconnecting (RTT metrics: {})".format(self.keepalive.metrics()))
+        # the TLS session of the dead connection is resumed by the next handshake
+        self.transport.save_session()
+        # replace the connection before closing it, so its downchannel thread sees it was replaced and exits quietly
+        http_connection, self._connection = self._connection, None
+        if http_connection is not None:
+            try:
+                http_connection.close()
+            except Exception:
+                logger.exception("error while closing connection")
+        self._connect()
 
     def run(self):
         """
@@ -510,12 +802,15 @@ class AVS:
         1. checks for any expired scheduled tasks that need to run
         2. handles outstanding directives
         3. runs one iteration of audio player state-machine loop
+        4. refreshes the prepared Recognize event, if warm_recognize is enabled
 
         :return:
         """
         self.scheduler.run(blocking=False)
         self._handle_directives()
         self.player.run()
+        if self._warm_recognize:
+            self._refresh_prepared_recognize()
 
     def play_alert(self, alert):
         """
@@ -526,12 +821,116 @@ class AVS:
 
         :param alert: Alert to start
         """
-        self.handle_parts(self.send_event_parse_response(generate_payload(self._generate_alert_started_event(alert))))
+        self.handle_parts(self.send_event_parse_response(event_templates.ALERT_STARTED.payload(alert.token)))
         alert.set_active(True)
+        self._context_changed()
         logger.info("PLAYING {}: {}".format(alert.type, alert.token))
         audio_filename = 'alarm.wav' if alert.type == 'ALARM' else 'timer.wav' if alert.type == 'TIMER' else None
         alert.set_process(self.audio_device.play_infinite(audio_filename))
 
+    def speak_received(self, directive):
+        """
+        called when a Speak directive is received, so that an ExpectSpeech following it knows which speech to wait for
+
+        :param directive: Speak directive
+        """
+        self._last_speak = (directive.dialogRequestId, directive.token)
+
+    def expect_speech(self, directive):
+        """
+        called when an ExpectSpeech directive is received with cloud endpointing. arms a speculative Recognize that is
+        started from the speech synthesizer's callback the moment the Speak before it in the same dialog finishes, or
+        straight away if there is no such Speak or it has already finished. the directive claims it with
+        `claim_expected_speech` when it is handled.
+
+        :param directive: ExpectSpeech directive
+        """
+        dialog_request_id, token = self._last_speak
+        if dialog_request_id != directive.dialogRequestId:
+            token = None
+        with self._expect_speech_lock:
+            self._expected_speech = (directive.dialogRequestId, token)
+            self._speculative_dialog_request_id = None
+        # find a dead connection while the speech is still playing, rather than after the Recognize has been sent
+        self.keepalive.check()
+        if token is None or (self.speech_synthesizer.get_token() == token and
+                             self.speech_synthesizer.get_state() == speech_synthesizer.FINISHED):
+            self._speech_finished(token)
+
+    def _speech_finished(self, token):
+        """
+        called by the speech synthesizer when the speech for `token` has finished playing, before SpeechFinished is
+        sent. starts the armed speculative Recognize if it was waiting for this speech and its dialog is still current.
+
+        :param token: str Speak directive token, or None if the ExpectSpeech follows no speech
+        """
+        with self._expect_speech_lock:
+            expected = self._expected_speech
+            if expected is None or expected[1] != token or expected[0] != self._current_dialog_request_id:
+                return
+            self._expected_speech = None
+            self._speculative_dialog_request_id = expected[0]
+        self.tracer.instant('speculative_recognize', 'dialog', dialogRequestId=expected[0], token=token)
+        # the Recognize is sent at RECOGNIZE priority, overtaking the SpeechFinished event sent after this returns
+        thread = threading.Thread(target=self._speculative_recognize, name='Speculative Recognize Thread')
+        thread.daemon = True
+        thread.start()
+
+    def _speculative_recognize(self):
+        try:
+            self.recognize_speech()
+        except Exception:
+            logger.exception("speculative Recognize failed")
+
+    def claim_expected_speech(self, directive):
+        """
+        :param directive: ExpectSpeech directive being handled
+        :return: True if a speculative Recognize has already been started for `directive`. otherwise it is disarmed,
+            and the caller sends the Recognize itself
+        """
+        with self._expect_speech_lock:
+            if self._speculative_dialog_request_id == directive.dialogRequestId:
+                self._speculative_dialog_request_id = None
+                return True
+            self._expected_speech = None
+            return False
+
+    def barge_in(self, triggered_at=None, duck_volume=None):
+        """
+        interrupt Alexa, eg. when the hotword is detected while speech or content is playing. safe to call from the
+        hotword detection thread, ahead of `recognize_speech`.
+
+        speech is stopped and content is stopped too, or ducked to `duck_volume` until the response to the next
+        Recognize has been handled. the current dialog ends, so its directives still queued (eg. the rest of a
+        multi-Speak answer, or an ExpectSpeech) are dropped. PlaybackStopped is sent in the background; speech that was
+        cut off is reported by the context of the next Recognize, without a SpeechFinished.
+
+        :param triggered_at: float time.monotonic() of the trigger. defaults to now
+        :param duck_volume: int volume in percent to keep content playing at, if the audio device can change volume.
+            content is stopped if not given
+        :return: float seconds from `triggered_at` until speech and content were silenced
+        """
+        if triggered_at is None:
+            triggered_at = time.monotonic()
+        with self.tracer.span('barge_in', 'dialog', dialogRequestId=self._current_dialog_request_id) as span:
+            with self._expect_speech_lock:
+                self._expected_speech = None
+                self._speculative_dialog_request_id = None
+            self._start_dialog(None)
+            speech = self.speech_synthesizer.stop()
+            content = None
+            if self.player.get_state() == audio_player.PLAYING:
+                if duck_volume is not None and self.player.duck(duck_volume):
+                    content = 'ducked'
+                elif self.player.stop(asynchronous=True):
+                    content = 'stopped'
+            self.last_barge_in_latency = time.monotonic() - triggered_at
+            span.annotate(speech=speech, content=content)
+        self.tracer.instant('barge_in_silenced', 'dialog', latency=self.last_barge_in_latency)
+        logger.info("barge-in silenced output in {:.1f}ms (speech stopped: {}, content: {})".format(
+            self.last_barge_in_latency * 1000, speech, content))
+        return self.last_barge_in_latency
+
     def stop_capture(self):
         """
         called by downchannel directive stream when handling StopCapture directive. signals mic input capturing thread
@@ -547,6 +946,7 @@ class AVS:
         """
         # TODO: make atomic (may already be on CPython but still)
         self._alerts.append(alert)
+        self._context_changed()
 
     def get_alert(self, token):
         """
@@ -565,6 +965,7 @@ class AVS:
         :param alert: Alert to remove
         """
         self._alerts.remove(alert)
+        self._context_changed()
 
     def close(self):
         logging.info("CLOSING AVS")
@@ -574,3 +975,6 @@ class AVS:
             self._dc_resp.close()
             self._ddt.join()
             logging.info("DDT DEAD")
+        self._event_sender.shutdown(wait=False)
+        self.transport.close()
+        self.stream_resolver.close()
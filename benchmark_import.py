@@ -0,0 +1,59 @@
+import argparse
+import ast
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# third-party modules that should only be imported when they are first needed
+_DEFERRED = ['requests', 'requests_toolbelt', 'dateutil', 'pytz']
+
+# run in a fresh interpreter for every sample, so nothing is already imported or cached in memory
+_PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(repr((elapsed, len(sys.modules), sorted(m for m in {deferred!r} if m in sys.modules))))
+"""
+
+
+def sample(module):
+    """
+    :param module: str module to import
+    :return: tuple of (float seconds to import, int modules loaded, list of deferred modules that were loaded)
+    """
+    out = subprocess.check_output([sys.executable, '-c', _PROBE.format(module=module, deferred=_DEFERRED)],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+    return ast.literal_eval(out.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="measure the cold import time of the AVS client modules")
+    parser.add_argument('modules', nargs='*', default=['avs'], help="modules to import")
+    parser.add_argument('--runs', type=int, default=10, help="fresh interpreters per module")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+    results = {}
+    for module in args.modules:
+        samples = [sample(module) for _ in range(args.runs)]
+        times = sorted(s[0] * 1000 for s in samples)
+        results[module] = {
+            "median_ms": statistics.median(times),
+            "min_ms": times[0],
+            "max_ms": times[-1],
+            "modules_loaded": samples[-1][1],
+            "deferred_loaded": samples[-1][2]
+        }
+        r = results[module]
+        print("{}: median {:.1f}ms (min {:.1f}, max {:.1f}) over {} runs, {} modules loaded{}".format(
+            module, r["median_ms"], r["min_ms"], r["max_ms"], args.runs, r["modules_loaded"],
+            ", eagerly imported: {}".format(', '.join(r["deferred_loaded"])) if r["deferred_loaded"] else ""))
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import time
+
+import numpy
+
+from resampler import Resampler
+
+# native formats of common microphones: (sample rate, channels)
+_FORMATS = [(48000, 1), (48000, 2), (44100, 1), (44100, 2), (32000, 4), (22050, 1), (8000, 1)]
+
+
+def _tone(rate, channels, frequency, seconds):
+    t = numpy.arange(int(rate * seconds)) / rate
+    samples = 10000 * numpy.sin(2 * numpy.pi * frequency * t)
+    return numpy.repeat(samples[:, None], channels, axis=1).astype('<i2').tobytes()
+
+
+def _run(resampler, pcm, block_bytes):
+    resampler.reset()
+    blocks = [pcm[i:i + block_bytes] for i in range(0, len(pcm), block_bytes)]
+    start = time.perf_counter()
+    out = b''.join(resampler.process(block) for block in blocks)
+    return numpy.frombuffer(out, dtype='<i2').astype(numpy.float64), time.perf_counter() - start, len(blocks)
+
+
+def benchmark(rate, channels, seconds, block_ms):
+    """
+    :return: dict of throughput and quality figures for converting `rate` x `channels` to 16 kHz mono
+    """
+    resampler = Resampler(rate, 16000, channels)
+    block_bytes = rate * block_ms // 1000 * channels * 2
+    out, elapsed, blocks = _run(resampler, _tone(rate, channels, 1000, seconds), block_bytes)
+    # compare a 1 kHz tone with the ideal output, delayed by the filter
+    t = numpy.arange(len(out)) / 16000.0 - resampler.delay_ms / 1000
+    settled = slice(int(0.1 * 16000), len(out) - 160)
+    error = out[settled] - 10000 * numpy.sin(2 * numpy.pi * 1000 * t[settled])
+    result = {
+        "format": "{} Hz x{}".format(rate, channels),
+        "taps": resampler._taps,
+        "delay_ms": resampler.delay_ms,
+        "block_us": elapsed / blocks * 1e6,
+        "realtime": seconds / elapsed,
+        "snr_db": 10 * numpy.log10(numpy.mean(out[settled] ** 2) / max(numpy.mean(error ** 2), 1e-12))
+    }
+    if rate > 16000:
+        # a tone above the output Nyquist frequency must not alias into the output
+        alias, _, _ = _run(resampler, _tone(rate, channels, min(11000, rate * 0.45), 1.0), block_bytes)
+        result["alias_db"] = 10 * numpy.log10(max(numpy.mean(alias[settled.start:] ** 2), 1e-12) / 10000 ** 2 * 2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark conversion of microphone audio to 16 kHz mono")
+    parser.add_argument('--seconds', type=float, default=10.0, help="audio converted per format")
+    parser.add_argument('--block-ms', type=int, default=10, help="block size")
+    args = parser.parse_args()
+    print("{:>14} {:>5} {:>9} {:>9} {:>10} {:>8} {:>9}".format(
+        "format", "taps", "delay ms", "block us", "x realtime", "SNR dB", "alias dB"))
+    for rate, channels in _FORMATS:
+        r = benchmark(rate, channels, args.seconds, args.block_ms)
+        print("{:>14} {:>5} {:>9.2f} {:>9.1f} {:>10.0f} {:>8.1f} {:>9}".format(
+            r["format"], r["taps"], r["delay_ms"], r["block_us"], r["realtime"], r["snr_db"],
+            "{:.1f}".format(r["alias_db"]) if "alias_db" in r else "-"))
+
+
+if __name__ == '__main__':
+    main()
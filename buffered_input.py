@@ -0,0 +1,177 @@
+import collections
+import logging
+import threading
+import time
+
+from speech_recognizer import AudioInputDevice
+
+logger = logging.getLogger(__name__)
+
+# overflow policies, applied when the uploader falls `max_buffered_ms` behind capture
+DROP_OLDEST = 'DROP_OLDEST'
+DROP_NEWEST = 'DROP_NEWEST'
+BLOCK = 'BLOCK'
+
+
+class CaptureStatistics:
+    """
+    per-utterance capture/upload accounting
+    """
+    def __init__(self):
+        self.captured_frames = 0
+        self.dropped_frames = 0
+        self.max_depth = 0
+        self.send_stalls = 0
+        self.stall_seconds = 0.0
+
+    def to_dict(self):
+        return {
+            "captured_frames": self.captured_frames,
+            "dropped_frames": self.dropped_frames,
+            "max_depth": self.max_depth,
+            "send_stalls": self.send_stalls,
+            "stall_ms": self.stall_seconds * 1000
+        }
+
+    def __repr__(self):
+        return '<CaptureStatistics {}>'.format(self.to_dict())
+
+
+class BufferedAudioInputDevice(AudioInputDevice):
+    """
+    AudioInputDevice wrapper that reads another 16 kHz mono L16 AudioInputDevice on a dedicated capture thread into a
+    bounded frame queue, which `read` drains.
+
+    microphone reads therefore keep their pace when the uploader is held up (eg. by the HTTP/2 send window) instead
+    of being skipped. when the queue is full, `overflow_policy` decides what happens:
+        - DROP_OLDEST: the oldest buffered frame is discarded
+        - DROP_NEWEST: the newly captured frame is discarded
+        - BLOCK: the capture thread waits for room, leaving overflow handling to the wrapped device
+    dropped frames, queue depth and upload stalls (gaps between `read` calls longer than `stall_threshold_ms`) are
+    counted in `statistics`.
+    """
+    def __init__(self, device, frame_ms=20, max_buffered_ms=2000, overflow_policy=DROP_OLDEST, stall_threshold_ms=100):
+        """
+        :param device: AudioInputDevice providing 16 kHz mono L16 audio
+        :param frame_ms: int amount of audio read from the device at a time
+        :param max_buffered_ms: int amount of audio the queue holds
+        :param overflow_policy: str one of DROP_OLDEST, DROP_NEWEST or BLOCK
+        :param stall_threshold_ms: int gap between reads counted as an upload stall
+        """
+        assert overflow_policy in [DROP_OLDEST, DROP_NEWEST, BLOCK]
+        self._device = device
+        # 16 kHz, 16 bit mono is 32 bytes per millisecond
+        self._frame_bytes = 32 * frame_ms
+        self._max_frames = max(1, max_buffered_ms // frame_ms)
+        self._overflow_policy = overflow_policy
+        self._stall_threshold = stall_threshold_ms / 1000.0
+        self._frames = collections.deque()
+        self._condition = threading.Condition()
+        self._buffer = b''
+        self._eof = True
+        self._last_read = None
+        self._thread = None
+        self._stop_event = None
+        self.statistics = None
+
+    def depth(self):
+        """
+        :return: int number of frames waiting to be read
+        """
+        return len(self._frames)
+
+    def _stop_capture(self, timeout=1.0):
+        """
+        stop the capture thread of the previous utterance, so that it doesn't read audio of the next one
+
+        :param timeout: float seconds to wait for the thread to finish
+        """
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        with self._condition:
+            self._stop_event.set()
+            self._condition.notify_all()
+        if thread.is_alive():
+            # unblocks the thread if it is waiting for audio
+            self._device.stop_recording()
+            thread.join(timeout)
+            if thread.is_alive():
+                logger.warning("previous capture thread did not finish within {}s".format(timeout))
+
+    def start_recording(self):
+        self._stop_capture()
+        self._frames = collections.deque()
+        self._buffer = b''
+        self._eof = False
+        self._last_read = None
+        self._stop_event = threading.Event()
+        self.statistics = CaptureStatistics()
+        self._device.start_recording()
+        self._thread = threading.Thread(target=self._capture, args=(self._frames, self.statistics, self._stop_event),
+                                        name='Buffered Capture Thread')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _enqueue(self, frames, statistics, data, stop_event):
+        """
+        add a captured frame to `frames`, applying the overflow policy. called with the condition held.
+        """
+        statistics.captured_frames += 1
+        if len(frames) >= self._max_frames:
+            if self._overflow_policy == DROP_OLDEST:
+                frames.popleft()
+                statistics.dropped_frames += 1
+            elif self._overflow_policy == DROP_NEWEST:
+                statistics.dropped_frames += 1
+                return
+            else:
+                # stop waiting if a new recording replaced this one
+                while len(frames) >= self._max_frames and not stop_event.is_set():
+                    self._condition.wait(0.1)
+        frames.append(data)
+        statistics.max_depth = max(statistics.max_depth, len(frames))
+
+    def _capture(self, frames, statistics, stop_event):
+        try:
+            while not stop_event.is_set():
+                data = self._device.read(self._frame_bytes)
+                with self._condition:
+                    if data and not stop_event.is_set():
+                        self._enqueue(frames, statistics, data, stop_event)
+                    self._condition.notify_all()
+                if len(data) < self._frame_bytes:
+                    break
+        except Exception:
+            logger.exception("error while capturing audio")
+        finally:
+            with self._condition:
+                # end of stream marker
+                frames.append(None)
+                self._condition.notify_all()
+            logger.info("capture finished: {}".format(statistics))
+
+    def read(self, size=-1):
+        now = time.monotonic()
+        if self._last_read is not None and now - self._last_read > self._stall_threshold:
+            self.statistics.send_stalls += 1
+            self.statistics.stall_seconds += now - self._last_read
+        with self._condition:
+            while not self._eof and (size < 0 or len(self._buffer) < size):
+                while not self._frames:
+                    self._condition.wait()
+                frame = self._frames.popleft()
+                if frame is None:
+                    self._eof = True
+                else:
+                    self._buffer += frame
+                self._condition.notify_all()
+        if size < 0:
+            size = len(self._buffer)
+        ret = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        self._last_read = time.monotonic()
+        return ret
+
+    def stop_recording(self):
+        self._device.stop_recording()
@@ -0,0 +1,187 @@
+import logging
+import threading
+
+from speech_recognizer import AudioInputDevice
+
+logger = logging.getLogger(__name__)
+
+
+class CaptureHub:
+    """
+    long-lived capture from a single AudioInputDevice, fanned out to any number of readers (eg. hotword detection,
+    Recognize, metering).
+
+    the wrapped device is started once and read continuously on a capture thread into a ring buffer holding the last
+    `buffer_ms` of audio. readers keep their own position in the stream, so starting a reader never re-opens the
+    device and may begin up to `buffer_ms` in the past.
+    """
+    def __init__(self, device, buffer_ms=3000, chunk_ms=20, sample_rate=16000, sample_width=2, channels=1):
+        """
+        :param device: AudioInputDevice to capture from
+        :param buffer_ms: int amount of audio retained for readers
+        :param chunk_ms: int amount of audio read from the device at a time
+        :param sample_rate: int sample rate of the device audio
+        :param sample_width: int bytes per sample of the device audio
+        :param channels: int channels of the device audio
+        """
+        self._device = device
+        self._frame_bytes = sample_width * channels
+        self._bytes_per_ms = sample_rate * self._frame_bytes / 1000.0
+        self._chunk_bytes = self.ms_to_bytes(chunk_ms)
+        self._capacity = self.ms_to_bytes(buffer_ms)
+        self._ring = bytearray(self._capacity)
+        self._position = 0
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def ms_to_bytes(self, ms):
+        """
+        :param ms: float duration in milliseconds
+        :return: int number of bytes of audio in `ms`, rounded down to a whole sample frame
+        """
+        return int(ms * self._bytes_per_ms) // self._frame_bytes * self._frame_bytes
+
+    @property
+    def position(self):
+        """
+        :return: int total number of bytes captured since `start`
+        """
+        return self._position
+
+    @property
+    def oldest_position(self):
+        """
+        :return: int position of the oldest byte still held in the ring buffer
+        """
+        return max(0, self._position - self._capacity)
+
+    def is_running(self):
+        return self._running
+
+    def start(self):
+        """
+        start the device and the capture thread
+        """
+        if self._running:
+            return
+        self._running = True
+        self._device.start_recording()
+        self._thread = threading.Thread(target=self._capture, name='Capture Hub Thread')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        stop the device. readers blocked in `read` return what they have.
+        """
+        self._running = False
+        self._device.stop_recording()
+        self.wake()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def wake(self):
+        """
+        wake up readers waiting for audio, eg. so that they notice they were stopped
+        """
+        with self._condition:
+            self._condition.notify_all()
+
+    def _write(self, data):
+        start = self._position % self._capacity
+        first = min(len(data), self._capacity - start)
+        self._ring[start:start + first] = data[:first]
+        if first < len(data):
+            self._ring[:len(data) - first] = data[first:]
+
+    def _capture(self):
+        while self._running:
+            data = self._device.read(self._chunk_bytes)
+            if data:
+                # keep only the newest `capacity` bytes of an oversized read
+                data = data[-self._capacity:]
+                with self._condition:
+                    self._write(data)
+                    self._position += len(data)
+                    self._condition.notify_all()
+            if len(data) < self._chunk_bytes:
+                logger.warning("capture device stopped delivering audio")
+                self._running = False
+                self.wake()
+
+    def read_at(self, position, size, should_stop=None):
+        """
+        read up to `size` bytes starting at stream position `position`. blocks until at least one byte is available,
+        the hub stops, or `should_stop` returns True.
+
+        :param position: int stream position to read from
+        :param size: int maximum number of bytes to return
+        :param should_stop: callable returning True to abandon waiting
+        :return: tuple of bytes read, stream position following the returned bytes, and number of bytes skipped
+            because `position` had already been overwritten
+        """
+        with self._condition:
+            while position >= self._position and self._running and not (should_stop and should_stop()):
+                self._condition.wait(0.1)
+            skipped = 0
+            oldest = self.oldest_position
+            if position < oldest:
+                skipped = oldest - position
+                position = oldest
+            n = min(size, self._position - position)
+            if n <= 0:
+                return b'', position, skipped
+            start = position % self._capacity
+            first = min(n, self._capacity - start)
+            data = bytes(self._ring[start:start + first])
+            if first < n:
+                data += bytes(self._ring[:n - first])
+        return data, position + n, skipped
+
+    def reader(self, preroll_ms=0):
+        """
+        :param preroll_ms: int audio captured before `start_recording` that the reader starts with
+        :return: CaptureHubReader
+        """
+        return CaptureHubReader(self, preroll_ms)
+
+
+class CaptureHubReader(AudioInputDevice):
+    """
+    AudioInputDevice reading from a CaptureHub. `start_recording` positions the reader `preroll_ms` before the most
+    recently captured audio; the hub (and its device) is started if it isn't already running.
+    """
+    def __init__(self, hub, preroll_ms=0):
+        """
+        :param hub: CaptureHub
+        :param preroll_ms: int audio captured before `start_recording` that the reader starts with
+        """
+        self._hub = hub
+        self.preroll_ms = preroll_ms
+        self._position = hub.position
+        self._stopped = True
+        # bytes lost because this reader fell more than the hub's buffer behind
+        self.overrun_bytes = 0
+
+    def start_recording(self):
+        self._hub.start()
+        self._position = max(self._hub.oldest_position, self._hub.position - self._hub.ms_to_bytes(self.preroll_ms))
+        self._stopped = False
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self._hub.ms_to_bytes(20)
+        ret = b''
+        while len(ret) < size and not self._stopped and self._hub.is_running():
+            data, self._position, skipped = self._hub.read_at(self._position, size - len(ret),
+                                                              lambda: self._stopped)
+            if skipped:
+                self.overrun_bytes += skipped
+                logger.warning("capture hub reader overrun, skipped {} bytes".format(skipped))
+            ret += data
+        return ret
+
+    def stop_recording(self):
+        self._stopped = True
+        self._hub.wake()
@@ -0,0 +1,277 @@
+import collections
+import logging
+import threading
+import time
+
+import h2.settings
+from hyper.http20.window import BaseFlowControlManager
+
+logger = logging.getLogger(__name__)
+
+# request priority classes, highest first
+RECOGNIZE = 'recognize'
+DIALOG = 'dialog'
+BACKGROUND = 'background'
+
+PRIORITIES = [RECOGNIZE, DIALOG, BACKGROUND]
+
+# HTTP/2 stream weights (1-256) advertised for each priority class
+WEIGHTS = {
+    RECOGNIZE: 256,
+    DIALOG: 128,
+    BACKGROUND: 16
+}
+
+# the HTTP/2 default for all windows and the initial connection window
+DEFAULT_WINDOW_SIZE = 65535
+
+
+class ConnectionSettings:
+    """
+    HTTP/2 settings and flow-control policy for the AVS connection.
+
+    the defaults are the protocol defaults. on links with a large bandwidth-delay product (eg. long Speak attachments
+    over a slow or distant network) larger windows keep the server from stalling between WINDOW_UPDATEs.
+    """
+    def __init__(self,
+                 initial_window_size=DEFAULT_WINDOW_SIZE,
+                 connection_window_size=DEFAULT_WINDOW_SIZE,
+                 max_frame_size=16384,
+                 header_table_size=4096,
+                 window_update_threshold=0.25):
+        """
+        :param initial_window_size: int receive window of each stream, advertised as SETTINGS_INITIAL_WINDOW_SIZE
+        :param connection_window_size: int receive window of the connection as a whole
+        :param max_frame_size: int largest frame payload accepted, advertised as SETTINGS_MAX_FRAME_SIZE
+            (16384-16777215)
+        :param header_table_size: int HPACK dynamic table size, advertised as SETTINGS_HEADER_TABLE_SIZE
+        :param window_update_threshold: float fraction of a window that is consumed before a WINDOW_UPDATE restoring
+            it is sent. higher values batch more data into each update
+        """
+        assert 16384 <= max_frame_size <= 16777215
+        assert 0 < window_update_threshold <= 1
+        assert connection_window_size >= DEFAULT_WINDOW_SIZE
+        self.initial_window_size = initial_window_size
+        self.connection_window_size = connection_window_size
+        self.max_frame_size = max_frame_size
+        self.header_table_size = header_table_size
+        self.window_update_threshold = window_update_threshold
+
+    def window_manager(self, statistics):
+        """
+        :param statistics: FlowControlStatistics to count window updates in
+        :return: callable creating the stream flow control managers for hyper.HTTP20Connection's `window_manager`
+        """
+        def create(initial_window_size):
+            # hyper creates every manager for the protocol default window; streams use the advertised one instead
+            return BatchingWindowManager(self.initial_window_size, self.window_update_threshold, statistics)
+        return create
+
+    def apply(self, connection, statistics):
+        """
+        connect `connection` if it isn't connected yet, advertise these settings and open up the connection window.
+        call once per connection, after it was created with `window_manager`.
+
+        :param connection: hyper.HTTP20Connection
+        :param statistics: FlowControlStatistics
+        """
+        connection.connect()
+        with connection._write_lock:
+            with connection._conn as conn:
+                conn.update_settings({
+                    h2.settings.INITIAL_WINDOW_SIZE: self.initial_window_size,
+                    h2.settings.MAX_FRAME_SIZE: self.max_frame_size,
+                    h2.settings.HEADER_TABLE_SIZE: self.header_table_size
+                })
+                if self.connection_window_size > DEFAULT_WINDOW_SIZE:
+                    conn.increment_flow_control_window(self.connection_window_size - DEFAULT_WINDOW_SIZE)
+            connection.window_manager = BatchingWindowManager(self.connection_window_size,
+                                                              self.window_update_threshold, statistics)
+            connection._send_outstanding_data()
+
+    def to_dict(self):
+        return {
+            "initial_window_size": self.initial_window_size,
+            "connection_window_size": self.connection_window_size,
+            "max_frame_size": self.max_frame_size,
+            "header_table_size": self.header_table_size,
+            "window_update_threshold": self.window_update_threshold
+        }
+
+    def __repr__(self):
+        return '<ConnectionSettings {}>'.format(self.to_dict())
+
+
+class FlowControlStatistics:
+    """
+    flow-control accounting for a connection: WINDOW_UPDATEs sent for received data, and time request bodies spent
+    waiting for the server to open up the send window
+    """
+    def __init__(self):
+        self.window_updates = 0
+        self.window_update_bytes = 0
+        self.send_blocked_chunks = 0
+        self.send_blocked_seconds = 0.0
+
+    def to_dict(self):
+        return {
+            "window_updates": self.window_updates,
+            "window_update_bytes": self.window_update_bytes,
+            "send_blocked_chunks": self.send_blocked_chunks,
+            "send_blocked_ms": self.send_blocked_seconds * 1000
+        }
+
+    def __repr__(self):
+        return '<FlowControlStatistics {}>'.format(self.to_dict())
+
+
+class BatchingWindowManager(BaseFlowControlManager):
+    """
+    restores the receive window to its full size in a single WINDOW_UPDATE once `threshold` of it has been consumed
+    """
+    def __init__(self, initial_window_size, threshold, statistics, document_size=None):
+        super().__init__(initial_window_size, document_size)
+        self._low_water_mark = initial_window_size * (1 - threshold)
+        self._statistics = statistics
+
+    def _restore(self, future_window_size):
+        increment = self.initial_window_size - future_window_size
+        self._statistics.window_updates += 1
+        self._statistics.window_update_bytes += increment
+        return increment
+
+    def increase_window_size(self, frame_size):
+        future_window_size = self.window_size - frame_size
+        if future_window_size <= self._low_water_mark:
+            return self._restore(future_window_size)
+        return 0
+
+    def blocked(self):
+        return self._restore(self.window_size)
+
+
+def send_window(connection, stream_id):
+    """
+    :param connection: hyper.HTTP20Connection
+    :param stream_id: int
+    :return: int bytes that may be sent on the stream before the server has to open up its window
+    """
+    with connection._conn as conn:
+        return conn.local_flow_control_window(stream_id)
+
+
+class QueueingStatistics:
+    """
+    time request body chunks of a priority class spent waiting for their turn to be sent
+    """
+    def __init__(self):
+        self.chunks = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds):
+        self.chunks += 1
+        self.total_seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+
+    def to_dict(self):
+        return {
+            "chunks": self.chunks,
+            "mean_ms": self.total_seconds * 1000 / self.chunks if self.chunks else 0.0,
+            "max_ms": self.max_seconds * 1000
+        }
+
+    def __repr__(self):
+        return '<QueueingStatistics {}>'.format(self.to_dict())
+
+
+def prioritize(connection, stream_id, priority):
+    """
+    send a PRIORITY frame giving stream `stream_id` the weight of `priority`. best effort: hyper doesn't take a
+    priority when the stream is opened, and older h2 versions can't send PRIORITY frames at all.
+
+    :param connection: hyper.HTTP20Connection
+    :param stream_id: int
+    :param priority: str priority class
+    """
+    try:
+        with connection._write_lock:
+            with connection._conn as conn:
+                conn.prioritize(stream_id, weight=WEIGHTS[priority])
+            connection._send_outstanding_data()
+    except Exception:
+        logger.debug("unable to prioritize stream {}".format(stream_id), exc_info=True)
+
+
+class SendScheduler:
+    """
+    strict-priority scheduling of request body chunks sent on a shared HTTP/2 connection.
+
+    the connection sends chunks of concurrent requests in whichever order their threads happen to take its locks.
+    requests sent through `schedule` instead hand over one chunk at a time, and a chunk is only released to the
+    connection when no chunk of a higher priority class is waiting. a Recognize stream that is waiting on the
+    microphone has no chunk waiting, so it holds nothing up, and neither does a chunk waiting for its stream's send
+    window to open. the time each chunk waited is recorded per class.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._waiting = {priority: 0 for priority in PRIORITIES}
+        self._sending = False
+        self.statistics = {priority: QueueingStatistics() for priority in PRIORITIES}
+
+    def _acquire(self, priority):
+        higher = PRIORITIES[:PRIORITIES.index(priority)]
+        start = time.monotonic()
+        with self._condition:
+            self._waiting[priority] += 1
+            while self._sending or any(self._waiting[p] for p in higher):
+                self._condition.wait()
+            self._waiting[priority] -= 1
+            self._sending = True
+        self.statistics[priority].add(time.monotonic() - start)
+
+    def _release(self):
+        with self._condition:
+            self._sending = False
+            self._condition.notify_all()
+
+    def schedule(self, priority, iterable, connection=None, flow_statistics=None, stream_id=None):
+        """
+        :param priority: str priority class
+        :param iterable: iterable of bytes request body chunks
+        :param connection: hyper.HTTP20Connection the chunks are sent on
+        :param flow_statistics: FlowControlStatistics to add chunks held up by the stream's send window to. requires
+            `connection` and `stream_id`
+        :param stream_id: int ID of the stream the chunks are sent on. if given with `connection`, the stream is
+            prioritized before the first chunk
+        :return: generator yielding the chunks of `iterable` as their turn comes
+        """
+        assert priority in PRIORITIES
+        if connection is not None and stream_id is not None and priority != BACKGROUND:
+            prioritize(connection, stream_id, priority)
+        for chunk in iterable:
+            self._acquire(priority)
+            blocked = False
+            try:
+                blocked = connection is not None and stream_id is not None and \
+                    send_window(connection, stream_id) < len(chunk)
+                if blocked:
+                    # the chunk waits for the server to open up the stream's window, which can take a while. chunks
+                    # of other streams may be sent meanwhile
+                    self._release()
+                start = time.monotonic()
+                yield chunk
+                if blocked and flow_statistics is not None:
+                    flow_statistics.send_blocked_chunks += 1
+                    flow_statistics.send_blocked_seconds += time.monotonic() - start
+            finally:
+                # the connection has sent the chunk once it asks for the next one
+                if not blocked:
+                    self._release()
+
+    def metrics(self):
+        """
+        :return: dict of priority class to queueing statistics
+        """
+        return collections.OrderedDict((priority, self.statistics[priority].to_dict()) for priority in PRIORITIES)
@@ -2,21 +2,41 @@ import sys
 
 import pyaudio
 import wave
-from requests_toolbelt import MultipartDecoder
+
+import session_recorder
+from util import multipart_parse
+
+
+def write_wav(filename, audio):
+    paudio = pyaudio.PyAudio()
+    waveFile = wave.open(filename, 'wb')
+    waveFile.setnchannels(1)
+    waveFile.setsampwidth(paudio.get_sample_size(pyaudio.paInt16))
+    waveFile.setframerate(16000)
+    waveFile.writeframes(audio)
+    waveFile.close()
+
+
+def dump(data, content_type, filename):
+    parts = multipart_parse(data, content_type)
+    print(len(parts))
+    print(parts[0][1] if isinstance(parts[0][1], dict) else bytes(parts[0][1]))
+    if len(parts) > 1:
+        audio = bytes(parts[1][1])
+        print(audio[:100])
+        write_wav(filename, audio)
 
 
 filename = sys.argv[1]
-boundary = open(filename, 'rb').readline()[2:-2].decode()
-decoder = MultipartDecoder(open(filename, 'rb').read(), 'multipart/form-data; boundary={}'.format(boundary), 'latin1')
-parts = [part for part in decoder.parts]
-print(len(parts))
-print(parts[0].content)
-print(parts[1].content[:100])
-paudio = pyaudio.PyAudio()
-
-waveFile = wave.open('{}.wav'.format(filename), 'wb')
-waveFile.setnchannels(1)
-waveFile.setsampwidth(paudio.get_sample_size(pyaudio.paInt16))
-waveFile.setframerate(16000)
-waveFile.writeframes(parts[1].content)
-waveFile.close()
+try:
+    recording = session_recorder.SessionRecording(filename)
+except ValueError:
+    # a single saved multipart request body
+    data = open(filename, 'rb').read()
+    boundary = data[2:data.index(b'\r\n')].decode()
+    dump(data, 'multipart/form-data; boundary={}'.format(boundary), '{}.wav'.format(filename))
+else:
+    # every request with an audio part in a session recording
+    with recording:
+        for i, record in enumerate(r for r in recording if r.kind == session_recorder.REQUEST):
+            dump(bytes(record.data), record.meta['content_type'], '{}.{}.wav'.format(filename, i))
@@ -0,0 +1,119 @@
+import collections
+
+# directive lanes, in the order they are processed by the run loop
+ALERTS = 'alerts'
+CONTENT = 'content'
+DIALOG = 'dialog'
+
+LANES = [ALERTS, CONTENT, DIALOG]
+# lanes in which a directive is not handled until the directives before it have completed, eg. so that an
+# ExpectSpeech waits for the Speak before it to finish playing
+SEQUENTIAL_LANES = [DIALOG]
+
+
+def lane_for(directive):
+    """
+    :param directive: directives.Directive
+    :return: str lane the directive is queued on
+    """
+    if directive.dialogRequestId is not None:
+        return DIALOG
+    if directive._namespace == 'Alerts':
+        return ALERTS
+    return CONTENT
+
+
+class DirectiveQueue:
+    """
+    multi-producer/single-consumer directive queue handing directives from the downchannel and event-response
+    threads to the run loop.
+
+    producers only ever append to a per-lane `collections.deque` and the run loop only ever pops from its left end;
+    both operations are atomic in CPython, so no lock is taken on either side. each lane has a second deque owned by
+    the run loop which holds directives that have been taken off the shared deque but have not completed yet.
+
+    directives in the dialog lane are tagged with their dialogRequestId; when a new dialog starts, entries belonging
+    to an older dialog are dropped as they are reached, at O(1) each.
+    """
+    def __init__(self):
+        self._incoming = {lane: collections.deque() for lane in LANES}
+        self._pending = {lane: collections.deque() for lane in LANES}
+        self._dialog_request_id = None
+        self.handled = 0
+        self.dropped = 0
+        self.max_backlog = 0
+
+    def set_dialog_request_id(self, dialog_request_id):
+        """
+        mark `dialog_request_id` as the current dialog. queued dialog directives for any other dialog become stale.
+
+        :param dialog_request_id: str
+        """
+        self._dialog_request_id = dialog_request_id
+
+    def put(self, directive):
+        """
+        queue a directive. safe to call from any thread.
+
+        :param directive: directives.Directive
+        """
+        self._incoming[lane_for(directive)].append(directive)
+
+    def _is_stale(self, lane, directive):
+        return lane == DIALOG and directive.dialogRequestId != self._dialog_request_id
+
+    def process(self, handler):
+        """
+        take newly queued directives off the shared lanes and call `handler` on every outstanding directive, lane by
+        lane. directives for which `handler` returns a falsy value stay queued, in order, for the next call; in a
+        sequential lane the directives after them are not handled until they complete. only call from the run loop
+        thread.
+
+        :param handler: callable taking a directive and returning True when it completed
+        """
+        for lane in LANES:
+            incoming = self._incoming[lane]
+            pending = self._pending[lane]
+            while incoming:
+                pending.append(incoming.popleft())
+        backlog = sum(len(pending) for pending in self._pending.values())
+        if backlog > self.max_backlog:
+            self.max_backlog = backlog
+        for lane in LANES:
+            pending = self._pending[lane]
+            blocked = False
+            for _ in range(len(pending)):
+                directive = pending.popleft()
+                if self._is_stale(lane, directive):
+                    self.dropped += 1
+                    directive.release()
+                elif not blocked and handler(directive):
+                    self.handled += 1
+                else:
+                    pending.append(directive)
+                    blocked = lane in SEQUENTIAL_LANES
+
+    def backlog(self):
+        """
+        :return: dict of lane name to number of outstanding directives
+        """
+        return {lane: len(self._incoming[lane]) + len(self._pending[lane]) for lane in LANES}
+
+    def metrics(self):
+        """
+        :return: dict of backlog per lane and handled/dropped/max_backlog counters. counters are only updated by the
+            run loop, so max_backlog is sampled once per `process` call
+        """
+        return {
+            "backlog": self.backlog(),
+            "handled": self.handled,
+            "dropped": self.dropped,
+            "max_backlog": self.max_backlog
+        }
+
+    def __len__(self):
+        return sum(len(self._incoming[lane]) + len(self._pending[lane]) for lane in LANES)
+
+    def __repr__(self):
+        # only lengths are read here; iterating a deque while another thread appends to it raises RuntimeError
+        return '<DirectiveQueue {}>'.format(self.backlog())
@@ -1,16 +1,12 @@
-import base64
 import datetime
-import io
 import logging
+import time
 import ujson as json
-import uuid
 
-import dateutil.parser
-import pytz
-import requests
-from requests_toolbelt import MultipartEncoder
-
-import speech_synthesizer
+import connection
+import event_templates
+import mpeg_audio
+import util
 from speech_recognizer import SPEECH_CLOUD_ENDPOINTING_PROFILES
 
 logger = logging.getLogger(__name__)
@@ -38,27 +34,74 @@ def to_directive(data):
 
 def generate_payload(event):
     """
-    returns a file-like MultipartEncoder instance that can be used to write-out the multi-part request headers and body
-
+    returns the multi-part request body for an event. events without context should use the pre-encoded templates in
+    `event_templates` instead.
 
     :param event: dict payload to send as "metadata" part in multi-part request
-    :return: MultipartEncoder
+    :return: event_templates.MultipartPayload
+    """
+    return event_templates.MultipartPayload(json.dumps(event).encode(), event['event']['header'])
+
+
+def _has_field(payload, path):
+    """
+    :param payload: dict directive payload
+    :param path: str key, or dotted path of keys into nested objects, eg. 'audioItem.stream'
+    :return: True if `payload` has a value at `path`
+    """
+    for key in path.split('.'):
+        if not isinstance(payload, dict) or key not in payload:
+            return False
+        payload = payload[key]
+    return True
+
+
+def _payload_field(key):
+    """
+    :param key: str key in the directive payload
+    :return: read-only property looking up `key` in the directive payload on access
     """
-    return MultipartEncoder({"metadata": (None, io.BytesIO(json.dumps(event).encode()), 'application/json')})
+    return property(lambda self: self._payload[key])
 
 
 class Directive:
     """
     Base-class for directives.
+
+    header fields are parsed when the directive is constructed; payload fields are looked up on access, but the
+    presence of those listed in `_required_fields` is checked up front, so that a malformed directive fails in
+    `to_directive` rather than when it is received or handled. sub-classes must declare __slots__ (empty if they add
+    no attributes) so that directives don't carry a __dict__.
     """
+    __slots__ = ('_debug', '_received_at', '_namespace', 'name', 'message_id', 'dialogRequestId', '_payload')
+
+    # payload keys (or dotted paths, see `_has_field`) the directive can't be handled without
+    _required_fields = ()
+
     def __init__(self, data):
         assert 'directive' in data, "Invalid directive payload, 'directive' key not present"
-        self._debug = data
-        self._received_at = datetime.datetime.now()
-        self._namespace = data['directive']['header']['namespace']
-        self.name = data['directive']['header']['name']
-        self.message_id = data['directive']['header']['messageId']
-        self.dialogRequestId = data['directive']['header'].get('dialogRequestId')
+        header = data['directive']['header']
+        # the full directive is only retained for debug logging
+        self._debug = data if logger.isEnabledFor(logging.DEBUG) else None
+        self._received_at = time.monotonic()
+        self._namespace = header['namespace']
+        self.name = header['name']
+        self.message_id = header['messageId']
+        self.dialogRequestId = header.get('dialogRequestId')
+        self._payload = data['directive'].get('payload', {})
+        missing = [path for path in self._required_fields if not _has_field(self._payload, path)]
+        if missing:
+            raise ValueError("{}.{} directive payload is missing {}".format(self._namespace, self.name,
+                                                                           ', '.join(missing)))
+
+    def _log_handling(self, description):
+        """
+        log the full directive at debug level, if it was retained
+
+        :param description: str prefix for the log message
+        """
+        if self._debug is not None:
+            logger.debug("{}: {}".format(description, json.dumps(self._debug, indent=4)))
 
     def on_receive(self, avs):
         """
@@ -71,7 +114,7 @@ class Directive:
         check and retain reference to headers and content, if this directive is responsible for this content
 
         :param headers: dict of part (of multi-part http response) headers (from network, bytes keys/values)
-        :param content: bytes of part (of multi-part http response) content
+        :param content: attachments.Attachment holding the part (of multi-part http response) content
         :return: True if responsible for content, False otherwise
         """
         return False
@@ -86,8 +129,14 @@ class Directive:
         """
         return True
 
+    def release(self):
+        """
+        free content retained by `content_handler`. called when the directive is dropped without completing
+        """
+        pass
+
     def __repr__(self):
-        return '<{} @ {}>'.format(self.__class__.__name__, self._received_at)
+        return '<{} @ {:.3f}>'.format(self.__class__.__name__, self._received_at)
 
 
 class SpeechSynthesizer:
@@ -98,53 +147,26 @@ class SpeechSynthesizer:
         """
         https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/speechsynthesizer#speak
         """
+        __slots__ = ('_content_id', '_audio', '_started')
+        _required_fields = ('url', 'format', 'token')
+
+        format = _payload_field('format')
+        token = _payload_field('token')
+
         def __init__(self, data):
             super().__init__(data)
-            url = data['directive']['payload']['url']
-            content_id_identifier = 'cid:'
-            assert url.startswith(content_id_identifier)
-            self.content_id = url[len(content_id_identifier):]
-            self.format = data['directive']['payload']['format']
-            self.token = data['directive']['payload']['token']
+            self._content_id = None
             self._audio = None
+            self._started = False
 
-        def _generate_speech_started_event(self):
-            """
-            https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/speechsynthesizer#speechstarted
-
-            :return: dict event payload
-            """
-            return {
-                "event": {
-                    "header": {
-                        "namespace": "SpeechSynthesizer",
-                        "name": "SpeechStarted",
-                        "messageId": str(uuid.uuid4()),
-                    },
-                    "payload": {
-                        "token": self.token
-                    }
-                }
-            }
-
-        def _generate_speech_finished_event(self):
-            """
-            https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/speechsynthesizer#speechfinished
-
-            :return: dict event payload
-            """
-            return {
-                "event": {
-                    "header": {
-                        "namespace": "SpeechSynthesizer",
-                        "name": "SpeechFinished",
-                        "messageId": str(uuid.uuid4()),
-                    },
-                    "payload": {
-                        "token": self.token
-                    }
-                }
-            }
+        @property
+        def content_id(self):
+            if self._content_id is None:
+                url = self._payload['url']
+                content_id_identifier = 'cid:'
+                assert url.startswith(content_id_identifier)
+                self._content_id = url[len(content_id_identifier):]
+            return self._content_id
 
         def content_handler(self, headers, content):
             if self.content_id.encode() in headers.get(b'Content-ID', b''):
@@ -152,26 +174,31 @@ class SpeechSynthesizer:
                 return True
             return False
 
+        def on_receive(self, avs):
+            avs.speak_received(self)
+
+        def release(self):
+            if self._audio is not None:
+                self._audio.release()
+                self._audio = None
+
         def handle(self, avs):
+            # the directive completes once the speech synthesizer has finished playing it
+            if self._started:
+                if avs.speech_synthesizer.is_speaking(self.token):
+                    return False
+                self.release()
+                return True
             if self._audio:
-                logger.debug("handling Speak directive: {}".format(json.dumps(self._debug, indent=4)))
-                # send SpeechStarted event
-                logger.debug("Sending speech started_event")
-                avs.send_event_parse_response(generate_payload(self._generate_speech_started_event()))
-                # play speech
+                self._log_handling("handling Speak directive")
                 # TODO: handle channel interactions
-                avs._speech_token = self.token
-                avs._speech_state = speech_synthesizer.PLAYING
-                open('/tmp/response.mp3', 'wb').write(self._audio.encode('latin1'))
-                avs.audio_device.play_once("/tmp/response.mp3")
-                avs._speech_state = speech_synthesizer.FINISHED
-                # send SpeechEnded event
-                logger.debug("Sending speech finished event")
-                avs.send_event_parse_response(generate_payload(self._generate_speech_finished_event()))
-                return True
+                avs.speech_synthesizer.speak(self.token, self._audio.path())
+                self._started = True
+                return False
             else:
+                # completed without playing, so the dialog directives after it aren't held up
                 logger.warning("unable to handle Speak directive, no audio content")
-                return False
+                return True
 
 
 class SpeechRecognizer:
@@ -183,6 +210,7 @@ class SpeechRecognizer:
         """
         https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/speechrecognizer#stopcapture
         """
+        __slots__ = ()
 
         def on_receive(self, avs):
             avs.stop_capture()
@@ -192,36 +220,28 @@ class SpeechRecognizer:
         https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/speechrecognizer#expectspeech
         """
 
-        def __init__(self, data):
-            super().__init__(data)
-            self.timeout_in_milliseconds = data['directive']['payload']['timeoutInMilliseconds']
-
-        def _generate_expect_speect_timed_out_event(self):
-            """
-            https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/speechrecognizer#expectspeechtimedout
-
-            :return: dict event payload
-            """
-            return {
-                "event": {
-                    "header": {
-                        "namespace": "SpeechRecognizer",
-                        "name": "ExpectSpeechTimedOut",
-                        "messageId": str(uuid.uuid4()),
-                    },
-                    "payload": {
-                    }
-                }
-            }
+        __slots__ = ()
+        _required_fields = ('timeoutInMilliseconds',)
+
+        timeout_in_milliseconds = _payload_field('timeoutInMilliseconds')
 
         def _expect_speect_timed_out(self, avs):
-            avs.send_event_parse_response(generate_payload(self._generate_expect_speect_timed_out_event()))
+            avs.send_event_parse_response(event_templates.EXPECT_SPEECH_TIMED_OUT.payload(), connection.DIALOG)
+
+        def on_receive(self, avs):
+            # with cloud endpointing the follow-up Recognize starts the moment the preceding speech ends, rather than
+            # when the run loop gets to this directive
+            if avs.speech_profile in SPEECH_CLOUD_ENDPOINTING_PROFILES:
+                avs.expect_speech(self)
 
         def handle(self, avs):
             if avs.speech_profile in SPEECH_CLOUD_ENDPOINTING_PROFILES:
-                avs.recognize_speech()
+                if not avs.claim_expected_speech(self):
+                    avs.recognize_speech()
+                return True
             else:
                 avs.expect_speech_timeout_event = avs.scheduler.enter(self.timeout_in_milliseconds / 1000.0, 1, self._expect_speect_timed_out, [avs])
+                return True
 
 
 class Alert:
@@ -231,8 +251,11 @@ class Alert:
     The member names of this class are chosen so that JSON de-serialization via the `ujson` module yields the desired
     results (https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/context#alertsstate).
     `ujson` handles de-serialization of arbitrary classes by either calling the instance's toDict method if it exists,
-    otherwise it creates a JSON object of the unprotected class and instance variables that it can serialize.
+    otherwise it creates a JSON object of the unprotected class and instance variables that it can serialize. as this
+    class uses __slots__, toDict is provided.
     """
+    __slots__ = ('token', 'type', 'scheduledTime', '_active', '_process', '_event')
+
     def __init__(self, token, alert_type, scheduled_time):
         self.token = token
         self.type = alert_type
@@ -259,6 +282,13 @@ class Alert:
     def set_event(self, event):
         self._event = event
 
+    def toDict(self):
+        return {
+            "token": self.token,
+            "type": self.type,
+            "scheduledTime": self.scheduledTime
+        }
+
 
 class Alerts:
     """
@@ -268,97 +298,51 @@ class Alerts:
         """
         https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/alerts#setalert
         """
+        __slots__ = ('_scheduled_time',)
+        _required_fields = ('token', 'type', 'scheduledTime')
+
+        token = _payload_field('token')
+        type = _payload_field('type')
+
         def __init__(self, data):
             super().__init__(data)
-            self.token = data['directive']['payload']['token']
-            self.type = data['directive']['payload']['type']
-            self.scheduledTime = dateutil.parser.parse(data['directive']['payload']['scheduledTime'])
-            self._alert = Alert(self.token, self.type, data['directive']['payload']['scheduledTime'])
-
-        def _generate_set_alert_succeeded_event(self):
-            """
-            https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/alerts#setalertsucceeded
-
-            :return: dict event payload
-            """
-            return {
-                "event": {
-                    "header": {
-                        "namespace": "Alerts",
-                        "name": "SetAlertSucceeded",
-                        "messageId": str(uuid.uuid4()),
-                    },
-                    "payload": {
-                        "token": self.token
-                    }
-                }
-            }
+            self._scheduled_time = None
+
+        @property
+        def scheduledTime(self):
+            if self._scheduled_time is None:
+                self._scheduled_time = util.parse_iso8601(self._payload['scheduledTime'])
+            return self._scheduled_time
 
         def content_handler(self, headers, content):
             return False
 
         def handle(self, avs):
-            logger.debug("handling AddAlert directive: {}".format(json.dumps(self._debug, indent=4)))
-            avs.add_alert(self._alert)
+            self._log_handling("handling AddAlert directive")
+            alert = Alert(self.token, self.type, self._payload['scheduledTime'])
+            avs.add_alert(alert)
             # scheduler.enter takes the delay in time units from now
-            # AVS alerts have an ISO8601 scheduledTime which we assume has a timezone
-            delay = (self.scheduledTime - datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)).total_seconds() + 1
-            self._alert.set_event(avs.scheduler.enter(delay, 1, avs.play_alert, [self._alert]))
+            # AVS alerts have an ISO8601 scheduledTime, taken to be UTC if it has no timezone
+            delay = (self.scheduledTime - datetime.datetime.now(datetime.timezone.utc)).total_seconds() + 1
+            alert.set_event(avs.scheduler.enter(delay, 1, avs.play_alert, [alert]))
             logger.debug("Sending set alert succeeded event")
-            avs.send_event_parse_response(generate_payload(self._generate_set_alert_succeeded_event()))
+            avs.send_event_parse_response(event_templates.SET_ALERT_SUCCEEDED.payload(self.token))
             return True
 
     class DeleteAlert(Directive):
         """
         https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/alerts#deletealert
         """
-        def __init__(self, data):
-            super().__init__(data)
-            self.token = data['directive']['payload']['token']
-
-        def _generate_delete_alert_succeeded_event(self):
-            """
-            https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/alerts#deletealertsucceeded
-
-            :return: dict event payload
-            """
-            return {
-                "event": {
-                    "header": {
-                        "namespace": "Alerts",
-                        "name": "DeleteAlertSucceeded",
-                        "messageId": str(uuid.uuid4()),
-                    },
-                    "payload": {
-                        "token": self.token
-                    }
-                }
-            }
-
-        def _generate_alert_stopped_event(self):
-            """
-            https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/alerts#alertstopped
-
-            :return: dict event payload
-            """
-            return {
-                "event": {
-                    "header": {
-                        "namespace": "Alerts",
-                        "name": "AlertStopped",
-                        "messageId": str(uuid.uuid4()),
-                    },
-                    "payload": {
-                        "token": self.token
-                    }
-                }
-            }
+        __slots__ = ()
+        _required_fields = ('token',)
+
+        token = _payload_field('token')
 
         def content_handler(self, headers, content):
             return False
 
         def handle(self, avs):
-            logger.debug("handling DeleteAlert directive: {}".format(json.dumps(self._debug, indent=4)))
+            self._log_handling("handling DeleteAlert directive")
             try:
                 alert = avs.get_alert(self.token)
             except StopIteration:
@@ -371,10 +355,10 @@ class Alerts:
             if alert.get_process():
                 avs.audio_device.stop(alert.get_process())
             logger.debug("Sending alert stopped event")
-            avs.send_event_parse_response(generate_payload(self._generate_alert_stopped_event()))
+            avs.send_event_parse_response(event_templates.ALERT_STOPPED.payload(self.token))
             avs.remove_alert(alert)
             logger.debug("Sending delete alert succeeded event")
-            avs.send_event_parse_response(generate_payload(self._generate_delete_alert_succeeded_event()))
+            avs.send_event_parse_response(event_templates.DELETE_ALERT_SUCCEEDED.payload(self.token))
             return True
 
 
@@ -383,10 +367,16 @@ class AudioItem:
     Audio Item data-structure
 
     """
+    __slots__ = ('_id', 'stream', '_audio', '_process')
+
     class Stream:
         """
         Audio Item Stream data-structure
         """
+        __slots__ = ('url', 'content_id', 'stream_format', 'offset_in_milliseconds', 'expiry_time',
+                     'progress_report_delay_in_milliseconds', 'progress_report_interval_in_milliseconds', 'token',
+                     'expected_previous_token')
+
         def __init__(self,
                      url,
                      stream_format,
@@ -435,37 +425,52 @@ class AudioItem:
     def process(self, p):
         self._process = p
 
-    def get_file_path(self):
+    def release(self):
+        """
+        free the audio content, once the item has been played or dropped
+        """
+        if self._audio is not None:
+            self._audio.release()
+            self._audio = None
+
+    def prefetch(self, resolver):
         """
-        Stores the content to a temporary file in /tmp, named by base64 encoding either the content_id or a uniquely
-        generated ID, and return the path to the file.
-        :return: str path to audio file
+        start resolving the stream URL ahead of playback
+
+        :param resolver: stream_resolver.StreamResolver
+        """
+        if not self.stream.content_id and self.stream.url:
+            resolver.prefetch(self.stream.url, self.stream.expiry_time)
+
+    def get_file_path(self, resolver):
+        """
+        Returns the path to the attachment's file for attached content, or the playable URL the stream URL resolves to
+        (following M3U/PLS playlists), which the audio device streams from.
+        :param resolver: stream_resolver.StreamResolver
+        :return: tuple of str path or URL of the audio, and bool True if it is a playlist for the device to load
         """
         if self.stream.content_id:
             if self._audio:
-                filename = '/tmp/{}.mp3'.format(base64.urlsafe_b64encode(self.stream.content_id.encode()))
-                open(filename, 'wb').write(self._audio.encode('latin1'))
-            else:
-                logger.warning("unable to retrieve filename, no audio content")
-                return None
-        else:
-            filename = '/tmp/{}.mp3'.format(base64.urlsafe_b64encode(str(uuid.uuid4()).encode()))
-            s = requests.session()
-            r = s.get(self.stream.url)
-            if 'audio/x-mpegurl' in r.headers.get('Content-Type', ''):
-                url = next(r.iter_lines())
-                logger.info("audio stream x-mpegurl: {}".format(url))
-                try:
-                    r = s.head(url)
-                    logger.debug(r.headers)
-                    if 'audio/x-scpls' in r.headers.get('Content-Type', ''):
-                        return url, True
-                except requests.exceptions.ConnectionError:
-                    logger.exception("HEAD on {} failed".format(url))
-                    pass
-                return url, False
-            open(filename, 'wb').write(r.content)
-        return filename, False
+                return self._audio.path(), False
+            logger.warning("unable to retrieve filename, no audio content")
+            return None
+        resolution = resolver.resolve(self.stream.url, self.stream.expiry_time)
+        return resolution.url, resolution.playlist
+
+    def get_byte_position(self, resolver):
+        """
+        map the stream's offsetInMilliseconds to a byte position in the audio, from its MP3 frame header
+        :param resolver: stream_resolver.StreamResolver
+        :return: int byte position to start playback from, or None if the offset is 0 or can't be mapped
+        """
+        if not self.stream.offset_in_milliseconds:
+            return None
+        if self.stream.content_id:
+            header = mpeg_audio.parse_header(self._audio.view()) if self._audio else None
+            return header.byte_position(self.stream.offset_in_milliseconds) if header else None
+        # resolved (and cached) when the file path was looked up
+        resolution = resolver.resolve(self.stream.url, self.stream.expiry_time)
+        return resolution.byte_position(self.stream.offset_in_milliseconds)
 
 
 class AudioPlayer:
@@ -476,20 +481,37 @@ class AudioPlayer:
         """
         https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/audioplayer#play
         """
+        __slots__ = ('_audio_item',)
+        _required_fields = ('playBehavior', 'audioItem.audioItemId', 'audioItem.stream')
+
+        play_behavior = _payload_field('playBehavior')
+
         def __init__(self, data):
             super().__init__(data)
-            self.play_behavior = data['directive']['payload']['playBehavior']
-            ai = data['directive']['payload']['audioItem']
-            s = ai['stream']
-            self.audio_item = AudioItem(ai['audioItemId'],
-                                        s.get('url'),
-                                        s.get('streamFormat'),
-                                        s.get('offsetInMilliseconds'),
-                                        s.get('expiryTime'),
-                                        s.get('progressReport', {}).get('progressReportDelayInMilliseconds'),
-                                        s.get('progressReport', {}).get('progressReportIntervalInMilliseconds'),
-                                        s.get('token'),
-                                        s.get('expectedPreviousToken'))
+            self._audio_item = None
+
+        @property
+        def audio_item(self):
+            if self._audio_item is None:
+                ai = self._payload['audioItem']
+                s = ai['stream']
+                self._audio_item = AudioItem(ai['audioItemId'],
+                                             s.get('url'),
+                                             s.get('streamFormat'),
+                                             s.get('offsetInMilliseconds'),
+                                             s.get('expiryTime'),
+                                             s.get('progressReport', {}).get('progressReportDelayInMilliseconds'),
+                                             s.get('progressReport', {}).get('progressReportIntervalInMilliseconds'),
+                                             s.get('token'),
+                                             s.get('expectedPreviousToken'))
+            return self._audio_item
+
+        def on_receive(self, avs):
+            self.audio_item.prefetch(avs.stream_resolver)
+
+        def release(self):
+            if self._audio_item is not None:
+                self._audio_item.release()
 
         def content_handler(self, headers, content):
             if self.audio_item.stream.content_id:
@@ -499,7 +521,7 @@ class AudioPlayer:
             return False
 
         def handle(self, avs):
-            logger.debug("handling AudioPlayer Play directive: {}".format(json.dumps(self._debug, indent=4)))
+            self._log_handling("handling AudioPlayer Play directive")
             if self.play_behavior == 'REPLACE_ALL':
                 avs.player.stop()
                 avs.player.clear_queue()
@@ -511,14 +533,17 @@ class AudioPlayer:
                 avs.player.enqueue(self.audio_item)
             else:
                 logger.warning("Unknown play behavior received: {}".format(self.play_behavior))
+                self.release()
             return True
 
     class Stop(Directive):
         """
         https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/audioplayer#stopdirective
         """
+        __slots__ = ()
+
         def handle(self, avs):
-            logger.debug("handling AudioPlayer Stop directive: {}".format(json.dumps(self._debug, indent=4)))
+            self._log_handling("handling AudioPlayer Stop directive")
             avs.player.stop()
             return True
 
@@ -526,12 +551,13 @@ class AudioPlayer:
         """
         https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/audioplayer#clearqueue
         """
-        def __init__(self, data):
-            super().__init__(data)
-            self.clear_behavior = data['directive']['payload']['clearBehavior']
+        __slots__ = ()
+        _required_fields = ('clearBehavior',)
+
+        clear_behavior = _payload_field('clearBehavior')
 
         def handle(self, avs):
-            logger.debug("handling ClearQueue directive: {}".format(json.dumps(self._debug, indent=4)))
+            self._log_handling("handling ClearQueue directive")
             if self.clear_behavior == 'CLEAR_ALL':
                 avs.player.stop()
             avs.player.clear_queue()
@@ -0,0 +1,115 @@
+import uuid
+
+import ujson as json
+
+# a single boundary is used for all template payloads. the metadata part is JSON, in which the boundary (32 hex digits
+# preceded by '--') does not occur unless a payload value happens to contain it
+_BOUNDARY = uuid.uuid4().hex
+_CONTENT_TYPE = 'multipart/form-data; boundary={}'.format(_BOUNDARY)
+_PREAMBLE = b'--' + _BOUNDARY.encode() + b'\r\nContent-Disposition: form-data; name="metadata"\r\n' \
+                                         b'Content-Type: application/json; charset=UTF-8\r\n\r\n'
+_EPILOGUE = b'\r\n--' + _BOUNDARY.encode() + b'--\r\n'
+
+
+class MultipartPayload:
+    """
+    multipart/form-data request body with a single JSON "metadata" part, held as one bytes object of known length.
+    iterating yields the whole body as a single chunk, so it is sent without further copying or re-chunking.
+    """
+    def __init__(self, metadata, header=None):
+        """
+        :param metadata: bytes JSON-encoded event
+        :param header: dict header of the event, eg. for its messageId
+        """
+        self.content_type = _CONTENT_TYPE
+        self.header = header
+        self.body = b''.join([_PREAMBLE, metadata, _EPILOGUE])
+
+    def __len__(self):
+        return len(self.body)
+
+    def __iter__(self):
+        yield self.body
+
+    def __repr__(self):
+        return '<MultipartPayload {}>'.format(self.body)
+
+
+class EventTemplate:
+    """
+    pre-encoded event without context.
+
+    the event JSON is encoded once, split around the messageId and payload values, so rendering an event only encodes
+    those values and joins bytes.
+    """
+    def __init__(self, namespace, name, payload_keys=()):
+        """
+        :param namespace: str event namespace, eg. 'AudioPlayer'
+        :param name: str event name, eg. 'PlaybackStarted'
+        :param payload_keys: list of str payload keys, in the order the values are passed to `render`
+        """
+        self.namespace = namespace
+        self.name = name
+        self._payload_keys = tuple(payload_keys)
+        self._header = '{{"event":{{"header":{{"namespace":{},"name":{},"messageId":"'.format(
+            json.dumps(namespace), json.dumps(name)).encode()
+        self._payload_prefixes = [('"},"payload":{' if i == 0 else ',').encode() + json.dumps(key).encode() + b':'
+                                  for i, key in enumerate(self._payload_keys)]
+        self._trailer = (b'' if self._payload_keys else b'"},"payload":{') + b'}}}'
+
+    def render(self, *values):
+        """
+        :param values: payload values, in the order of the template's payload keys
+        :return: bytes JSON-encoded event with a new messageId
+        """
+        return self._render(str(uuid.uuid4()), values)
+
+    def _render(self, message_id, values):
+        assert len(values) == len(self._payload_keys), "{}.{} takes payload values for {}".format(
+            self.namespace, self.name, self._payload_keys)
+        parts = [self._header, message_id.encode()]
+        for prefix, value in zip(self._payload_prefixes, values):
+            parts.append(prefix)
+            parts.append(json.dumps(value).encode())
+        parts.append(self._trailer)
+        return b''.join(parts)
+
+    def payload(self, *values):
+        """
+        :param values: payload values, in the order of the template's payload keys
+        :return: MultipartPayload containing the rendered event
+        """
+        message_id = str(uuid.uuid4())
+        return MultipartPayload(self._render(message_id, values),
+                                {'namespace': self.namespace, 'name': self.name, 'messageId': message_id})
+
+
+# https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/speechsynthesizer#speechstarted
+SPEECH_STARTED = EventTemplate('SpeechSynthesizer', 'SpeechStarted', ['token'])
+# https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/speechsynthesizer#speechfinished
+SPEECH_FINISHED = EventTemplate('SpeechSynthesizer', 'SpeechFinished', ['token'])
+
+# https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/speechrecognizer#expectspeechtimedout
+EXPECT_SPEECH_TIMED_OUT = EventTemplate('SpeechRecognizer', 'ExpectSpeechTimedOut')
+
+# https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/alerts#setalertsucceeded
+SET_ALERT_SUCCEEDED = EventTemplate('Alerts', 'SetAlertSucceeded', ['token'])
+# https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/alerts#deletealertsucceeded
+DELETE_ALERT_SUCCEEDED = EventTemplate('Alerts', 'DeleteAlertSucceeded', ['token'])
+# https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/alerts#alertstarted
+ALERT_STARTED = EventTemplate('Alerts', 'AlertStarted', ['token'])
+# https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/alerts#alertstopped
+ALERT_STOPPED = EventTemplate('Alerts', 'AlertStopped', ['token'])
+
+# https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/audioplayer#playbackstarted
+PLAYBACK_STARTED = EventTemplate('AudioPlayer', 'PlaybackStarted', ['token', 'offsetInMilliseconds'])
+# https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/audioplayer#playbacknearlyfinished
+PLAYBACK_NEARLY_FINISHED = EventTemplate('AudioPlayer', 'PlaybackNearlyFinished', ['token', 'offsetInMilliseconds'])
+# https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/audioplayer#playbackfinished
+PLAYBACK_FINISHED = EventTemplate('AudioPlayer', 'PlaybackFinished', ['token', 'offsetInMilliseconds'])
+# https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/audioplayer#playbackstopped
+PLAYBACK_STOPPED = EventTemplate('AudioPlayer', 'PlaybackStopped', ['token', 'offsetInMilliseconds'])
+# https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/audioplayer#playbackfailed
+PLAYBACK_FAILED = EventTemplate('AudioPlayer', 'PlaybackFailed', ['token', 'currentPlaybackState', 'error'])
+# https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/audioplayer#playbackqueuecleared
+PLAYBACK_QUEUE_CLEARED = EventTemplate('AudioPlayer', 'PlaybackQueueCleared')
@@ -0,0 +1,242 @@
+import collections
+import itertools
+import logging
+import random
+import struct
+import time
+
+import h2.events
+
+logger = logging.getLogger(__name__)
+
+# h2 renamed the PING ACK event in 3.1
+_PING_ACK_EVENTS = tuple(getattr(h2.events, name) for name in ['PingAcknowledged', 'PingAckReceived']
+                         if hasattr(h2.events, name))
+
+
+def install_ping_ack_hook(connection, callback):
+    """
+    have `callback(opaque_data)` called for every PING ACK received on `connection`. hyper discards PING ACKs, so the
+    h2 connection's `receive_data` is wrapped to look at the events it returns. the callback is made from whichever
+    thread is reading the connection, with its locks held, so it must be quick.
+
+    :param connection: hyper.HTTP20Connection
+    :param callback: callable taking the 8 bytes of opaque PING data
+    """
+    with connection._conn as conn:
+        receive_data = conn.receive_data
+
+        def hooked_receive_data(data):
+            events = receive_data(data)
+            for event in events:
+                if isinstance(event, _PING_ACK_EVENTS):
+                    callback(event.ping_data)
+            return events
+
+        conn.receive_data = hooked_receive_data
+
+
+class KeepAlive:
+    """
+    PING-based liveness checking for the AVS connection, run from the AVS scheduler.
+
+    every PING is numbered and its ACK timed, giving a history of round-trip times. the ping interval follows idle
+    time: shortly after the connection was last used it is `min_interval`, growing with idle time up to
+    `max_interval`. a PING that isn't acknowledged within the ACK timeout (four RTT deviations above the smoothed RTT,
+    bounded by `min_timeout` and `max_timeout`) is retried straight away; after `max_failures` consecutive misses the
+    connection is declared dead and `on_dead` is called. a dead connection is therefore noticed at most
+    `max_interval + max_failures * max_timeout` seconds after it stopped answering.
+
+    if `on_dead` raises, eg. because the network is still down, it is retried with jittered exponential backoff from
+    `min_reconnect_delay` up to `max_reconnect_delay`, until it succeeds and a new connection is attached.
+    """
+    def __init__(self, scheduler, on_dead, min_interval=30, max_interval=300, min_timeout=2.0, max_timeout=10.0,
+                 max_failures=2, history=100, tracer=None, min_reconnect_delay=1.0, max_reconnect_delay=60.0):
+        """
+        :param scheduler: sched.scheduler to run pings and ACK timeouts from
+        :param on_dead: callable called (from the scheduler) when the connection is declared dead
+        :param min_interval: float seconds between pings on a recently used connection
+        :param max_interval: float seconds between pings on an idle connection
+        :param min_timeout: float lower bound of the ACK timeout
+        :param max_timeout: float upper bound of the ACK timeout
+        :param max_failures: int consecutive unacknowledged PINGs after which the connection is dead
+        :param history: int number of RTT samples kept
+        :param tracer: tracing.Tracer to report RTT samples and dead connections to
+        :param min_reconnect_delay: float seconds before the first retry of a failed `on_dead`
+        :param max_reconnect_delay: float upper bound of the delay between retries
+        """
+        self._scheduler = scheduler
+        self._on_dead = on_dead
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.max_failures = max_failures
+        self._tracer = tracer
+        self._sequence = itertools.count()
+        self._connection = None
+        # incremented per attached connection so that events scheduled for an earlier connection are ignored
+        self._generation = 0
+        self._outstanding = {}
+        self._next_ping = None
+        self._rtts = collections.deque(maxlen=history)
+        self.smoothed_rtt = None
+        self.rtt_deviation = None
+        self.min_reconnect_delay = min_reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.failures = 0
+        self.dead_connections = 0
+        self.reconnect_failures = 0
+        self._last_activity = time.monotonic()
+        self._last_ack = None
+
+    def attach(self, connection):
+        """
+        start checking `connection`, replacing any connection checked before
+
+        :param connection: hyper.HTTP20Connection
+        """
+        self._generation += 1
+        self._connection = connection
+        self._outstanding = {}
+        self.failures = 0
+        self._last_activity = time.monotonic()
+        self._last_ack = None
+        generation = self._generation
+        install_ping_ack_hook(connection, lambda data: self._acknowledged(generation, data))
+        self._schedule_ping(self.interval())
+
+    def note_activity(self):
+        """
+        record that the connection is in use, eg. a request was sent
+        """
+        self._last_activity = time.monotonic()
+
+    def interval(self):
+        """
+        :return: float seconds until the next regular PING, based on how long the connection has been idle
+        """
+        idle = time.monotonic() - self._last_activity
+        return min(self.max_interval, max(self.min_interval, idle))
+
+    def timeout(self):
+        """
+        :return: float seconds a PING may go unacknowledged before it counts as a failure
+        """
+        if self.smoothed_rtt is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, self.smoothed_rtt + 4 * self.rtt_deviation))
+
+    def _schedule_ping(self, delay):
+        if self._next_ping is not None:
+            try:
+                self._scheduler.cancel(self._next_ping)
+            except ValueError:
+                # already run
+                pass
+        self._next_ping = self._scheduler.enter(delay, 1, self._ping, [self._generation])
+
+    def check(self):
+        """
+        send a PING now, eg. before a Recognize after a long idle period. does not wait for the ACK.
+        """
+        self._schedule_ping(0)
+
+    def _ping(self, generation):
+        if generation != self._generation:
+            return
+        sequence = next(self._sequence)
+        self._outstanding[sequence] = time.monotonic()
+        try:
+            self._connection.ping(struct.pack('>Q', sequence))
+        except Exception:
+            logger.exception("unable to send PING")
+        self._scheduler.enter(self.timeout(), 1, self._timed_out, [generation, sequence])
+        self._schedule_ping(self.interval())
+
+    def _acknowledged(self, generation, data):
+        """
+        PING ACK hook. called from the connection's reading thread
+        """
+        sent_at = self._outstanding.pop(struct.unpack('>Q', data)[0], None)
+        if generation != self._generation or sent_at is None:
+            return
+        now = time.monotonic()
+        rtt = now - sent_at
+        self._rtts.append((time.time(), rtt))
+        # smoothed RTT and deviation as in TCP (RFC 6298)
+        if self.smoothed_rtt is None:
+            self.smoothed_rtt = rtt
+            self.rtt_deviation = rtt / 2
+        else:
+            self.rtt_deviation = 0.75 * self.rtt_deviation + 0.25 * abs(self.smoothed_rtt - rtt)
+            self.smoothed_rtt = 0.875 * self.smoothed_rtt + 0.125 * rtt
+        self.failures = 0
+        self._last_ack = now
+        logger.debug("PING RTT {:.1f}ms".format(rtt * 1000))
+        if self._tracer is not None:
+            self._tracer.instant('ping_ack', 'connection', rtt_ms=rtt * 1000)
+
+    def _timed_out(self, generation, sequence):
+        if generation != self._generation or self._outstanding.pop(sequence, None) is None:
+            return
+        self.failures += 1
+        logger.warning("PING {} not acknowledged within {:.0f}ms ({} of {})".format(
+            sequence, self.timeout() * 1000, self.failures, self.max_failures))
+        if self.failures < self.max_failures:
+            self._schedule_ping(0)
+            return
+        self.dead_connections += 1
+        # stop checking this connection until a new one is attached
+        self._generation += 1
+        if self._tracer is not None:
+            self._tracer.instant('connection_dead', 'connection', failures=self.failures)
+        logger.error("connection declared dead after {} unacknowledged PINGs".format(self.failures))
+        self._reconnect(self._generation, 0)
+
+    def _reconnect(self, generation, attempt):
+        # a connection attached since, by something other than a failed `on_dead`, ends the retries
+        if generation != self._generation:
+            return
+        try:
+            self._on_dead()
+        except Exception:
+            self.reconnect_failures += 1
+            # the failed attempt may have attached a connection before failing. it is not checked, so it can't be
+            # declared dead as well, and the retry isn't mistaken for having been superseded by it
+            self._generation += 1
+            # jitter spreads out the reconnects of many clients that lost the network at the same time
+            delay = min(self.max_reconnect_delay, self.min_reconnect_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            logger.exception("reconnect attempt {} failed, retrying in {:.1f}s".format(attempt + 1, delay))
+            if self._tracer is not None:
+                self._tracer.instant('reconnect_failed', 'connection', attempt=attempt + 1, retry_in_s=delay)
+            self._scheduler.enter(delay, 1, self._reconnect, [self._generation, attempt + 1])
+
+    def is_healthy(self):
+        """
+        :return: False if the most recent PING went unacknowledged
+        """
+        return self.failures == 0
+
+    def rtt_history(self):
+        """
+        :return: list of (time.time(), rtt seconds) samples, oldest first
+        """
+        return list(self._rtts)
+
+    def metrics(self):
+        """
+        :return: dict of RTT statistics and failure counters
+        """
+        rtts = [rtt for _, rtt in self._rtts]
+        return {
+            "samples": len(rtts),
+            "last_rtt_ms": rtts[-1] * 1000 if rtts else None,
+            "smoothed_rtt_ms": self.smoothed_rtt * 1000 if self.smoothed_rtt is not None else None,
+            "rtt_deviation_ms": self.rtt_deviation * 1000 if self.rtt_deviation is not None else None,
+            "max_rtt_ms": max(rtts) * 1000 if rtts else None,
+            "seconds_since_ack": time.monotonic() - self._last_ack if self._last_ack is not None else None,
+            "failures": self.failures,
+            "dead_connections": self.dead_connections,
+            "reconnect_failures": self.reconnect_failures
+        }
@@ -0,0 +1,298 @@
+import argparse
+import glob
+import itertools
+import logging
+import math
+import random
+import threading
+import time
+import wave
+
+import ujson as json
+
+import tracing
+from avs import AVS
+from resampler import Resampler
+from session_replay import NullAudioDevice
+from speech_recognizer import AudioInputDevice
+
+logger = logging.getLogger(__name__)
+
+# AVS speech input is 16 bit little-endian PCM, 16 kHz, mono
+_SAMPLE_RATE = 16000
+_SAMPLE_WIDTH = 2
+_BYTES_PER_SECOND = _SAMPLE_RATE * _SAMPLE_WIDTH
+
+# seconds between AVS main loop iterations while a session thinks
+_RUN_INTERVAL = 0.01
+
+PERCENTILES = [50, 90, 99]
+
+
+def load_wav(path):
+    """
+    :param path: str 16 bit WAV file, converted to 16 kHz mono if it is in any other format
+    :return: bytes of 16 kHz mono L16 audio
+    """
+    with wave.open(path, 'rb') as w:
+        assert w.getsampwidth() == _SAMPLE_WIDTH, "{} is not 16 bit".format(path)
+        rate = w.getframerate()
+        channels = w.getnchannels()
+        pcm = w.readframes(w.getnframes())
+    if rate == _SAMPLE_RATE and channels == 1:
+        return pcm
+    return Resampler(rate, _SAMPLE_RATE, channels).process(pcm)
+
+
+class WavAudioInputDevice(AudioInputDevice):
+    """
+    AudioInputDevice replaying a WAV file like a microphone: the audio is handed out no faster than `speed` times real
+    time, followed by up to `trailing_silence_ms` of silence, as a microphone would keep capturing until AVS sends
+    StopCapture. `stop_recording` ends the stream immediately.
+    """
+    def __init__(self, speed=1.0, trailing_silence_ms=5000):
+        """
+        :param speed: float playback speed relative to real time, 0 for as fast as possible
+        :param trailing_silence_ms: int silence after the end of the audio at most
+        """
+        self.speed = speed
+        self._trailing_bytes = _BYTES_PER_SECOND * trailing_silence_ms // 1000
+        self._pcm = b''
+        self._position = 0
+        self._started_at = None
+        self._stopped = threading.Event()
+        self.audio_ended_at = None
+        self.stopped_at = None
+
+    def load(self, pcm):
+        """
+        :param pcm: bytes of 16 kHz mono L16 audio replayed by the next recording
+        """
+        self._pcm = pcm
+
+    def start_recording(self):
+        self._position = 0
+        self._started_at = time.monotonic()
+        self._stopped.clear()
+        self.audio_ended_at = None
+        self.stopped_at = None
+
+    def read(self, size=-1):
+        end = len(self._pcm) + self._trailing_bytes
+        if size < 0:
+            size = end - self._position
+        size = min(size, end - self._position)
+        if size <= 0 or self._stopped.is_set():
+            return b''
+        if self.speed > 0:
+            due = self._started_at + (self._position + size) / _BYTES_PER_SECOND / self.speed
+            if self._stopped.wait(max(0.0, due - time.monotonic())):
+                return b''
+        ret = self._pcm[self._position:self._position + size]
+        self._position += size
+        if self._position >= len(self._pcm) and self.audio_ended_at is None:
+            self.audio_ended_at = time.monotonic()
+        return ret + b'\x00' * (size - len(ret))
+
+    def stop_recording(self):
+        if not self._stopped.is_set():
+            self.stopped_at = time.monotonic()
+            self._stopped.set()
+
+
+def percentile(values, p):
+    """
+    :param values: sorted list of float
+    :param p: float percentile, 0-100
+    :return: float nearest-rank percentile of `values`
+    """
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+class LatencyRecorder(tracing.TraceHook):
+    """
+    collects the durations of spans by name, and the `latency` of instants that carry one (eg. recognize_first_byte),
+    from any number of sessions sharing a tracer. stages measured by the load generator itself are added with `add`.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._samples.setdefault(stage, []).append(seconds)
+
+    def span_finished(self, span):
+        if not span.is_instant():
+            self.add(span.name, span.duration)
+        elif 'latency' in span.args:
+            self.add(span.name, span.args['latency'])
+
+    def summary(self):
+        """
+        :return: dict of stage to count, percentiles and max in milliseconds
+        """
+        with self._lock:
+            samples = {stage: sorted(values) for stage, values in self._samples.items()}
+        summary = {}
+        for stage, values in sorted(samples.items()):
+            summary[stage] = dict([("count", len(values))] +
+                                  [("p{}_ms".format(p), percentile(values, p) * 1000) for p in PERCENTILES] +
+                                  [("max_ms", values[-1] * 1000)])
+        return summary
+
+
+class LoadSession(threading.Thread):
+    """
+    one AVS client sending Recognize events for utterances from the corpus, pausing for a think time before each
+    """
+    def __init__(self, index, options, credentials, corpus, tracer, recorder, stop):
+        """
+        :param index: int session number, which also offsets the session's position in the corpus
+        :param options: argparse.Namespace of load generator options
+        :param credentials: dict with access_token, refresh_token, client_id and client_secret
+        :param corpus: list of (str name, bytes 16 kHz mono L16 audio)
+        :param tracer: tracing.Tracer shared by all sessions
+        :param recorder: LatencyRecorder for the stages measured by the session
+        :param stop: threading.Event set when the run should end
+        """
+        super().__init__(name='Load Session {}'.format(index))
+        self.daemon = True
+        self._index = index
+        self._options = options
+        self._credentials = credentials
+        self._corpus = corpus
+        self._tracer = tracer
+        self._recorder = recorder
+        self._stopping = stop
+        self.completed = 0
+        self.errors = 0
+        self.audio_seconds = 0.0
+
+    def _think(self, avs, seconds):
+        # the main loop keeps handling directives (and sending their events) while the session thinks
+        deadline = time.monotonic() + seconds
+        while not self._stopping.is_set():
+            avs.run()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._stopping.wait(min(_RUN_INTERVAL, remaining))
+
+    def run(self):
+        options = self._options
+        device = WavAudioInputDevice(options.speed, options.trailing_silence_ms)
+        try:
+            avs = AVS(options.version, self._credentials['access_token'], self._credentials['refresh_token'],
+                      self._credentials['client_id'], self._credentials['client_secret'], NullAudioDevice(), device,
+                      options.profile, host=options.host, tracer=self._tracer)
+        except Exception:
+            logger.exception("session {} unable to connect".format(self._index))
+            self.errors += 1
+            return
+        try:
+            for i in itertools.count():
+                if self._stopping.is_set() or (options.utterances and i >= options.utterances):
+                    break
+                self._think(avs, random.uniform(options.think_min, options.think_max))
+                if self._stopping.is_set():
+                    break
+                name, pcm = self._corpus[(self._index + i) % len(self._corpus)]
+                device.load(pcm)
+                start = time.monotonic()
+                try:
+                    avs.recognize_speech(start)
+                except Exception:
+                    logger.exception("session {} Recognize of {} failed".format(self._index, name))
+                    self.errors += 1
+                    continue
+                end = time.monotonic()
+                self.completed += 1
+                self.audio_seconds += len(pcm) / _BYTES_PER_SECOND
+                self._recorder.add('loadgen_recognize', end - start)
+                if device.stopped_at is not None:
+                    if device.audio_ended_at is not None:
+                        # negative if AVS endpointed before the end of the recorded audio
+                        self._recorder.add('loadgen_end_of_audio_to_stop_capture',
+                                           device.stopped_at - device.audio_ended_at)
+                    self._recorder.add('loadgen_stop_capture_to_response', end - device.stopped_at)
+                else:
+                    logger.warning("session {}: no StopCapture for {}".format(self._index, name))
+        finally:
+            avs.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="drive concurrent AVS sessions with Recognize events replayed from "
+                                                 "a corpus of WAV files, and report latency percentiles")
+    parser.add_argument('corpus', nargs='+', help="WAV files, or glob patterns of WAV files")
+    parser.add_argument('--sessions', type=int, default=1, help="concurrent AVS sessions")
+    parser.add_argument('--utterances', type=int, default=10, help="utterances per session, 0 for no limit")
+    parser.add_argument('--duration', type=float, default=0, help="seconds to run for, 0 for no limit")
+    parser.add_argument('--speed', type=float, default=1.0, help="audio speed, 0 for as fast as possible")
+    parser.add_argument('--think-min', type=float, default=1.0, help="shortest pause before an utterance, seconds")
+    parser.add_argument('--think-max', type=float, default=3.0, help="longest pause before an utterance, seconds")
+    parser.add_argument('--ramp-up', type=float, default=0, help="seconds over which the sessions are started")
+    parser.add_argument('--trailing-silence-ms', type=int, default=5000,
+                        help="silence streamed after each utterance while waiting for StopCapture")
+    parser.add_argument('--host', default='avs-alexa-na.amazon.com', help="AVS host or proxy")
+    parser.add_argument('--version', default='v20160207', help="AVS API version")
+    parser.add_argument('--profile', default='NEAR_FIELD', choices=['CLOSE_TALK', 'NEAR_FIELD', 'FAR_FIELD'])
+    parser.add_argument('--tokens', default='tokens.txt', help="JSON file with access_token and refresh_token")
+    parser.add_argument('--secrets', default='secrets.txt', help="JSON file with client_id and client_secret")
+    parser.add_argument('--json', help="also write the report to this file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    paths = sorted(set(itertools.chain.from_iterable(glob.glob(pattern) or [pattern] for pattern in args.corpus)))
+    corpus = [(path, load_wav(path)) for path in paths]
+    credentials = dict(json.load(open(args.tokens)), **json.load(open(args.secrets)))
+    tracer = tracing.Tracer()
+    recorder = LatencyRecorder()
+    tracer.add_hook(recorder)
+    stop = threading.Event()
+
+    start = time.monotonic()
+    sessions = []
+    for i in range(args.sessions):
+        session = LoadSession(i, args, credentials, corpus, tracer, recorder, stop)
+        session.start()
+        sessions.append(session)
+        if args.ramp_up and i < args.sessions - 1:
+            time.sleep(args.ramp_up / max(1, args.sessions - 1))
+    try:
+        for session in sessions:
+            remaining = None if not args.duration else max(0.0, start + args.duration - time.monotonic())
+            session.join(remaining)
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    for session in sessions:
+        session.join()
+    elapsed = time.monotonic() - start
+
+    completed = sum(s.completed for s in sessions)
+    report = {
+        "sessions": args.sessions,
+        "corpus": len(corpus),
+        "elapsed_s": elapsed,
+        "utterances": completed,
+        "errors": sum(s.errors for s in sessions),
+        "utterances_per_s": completed / elapsed,
+        "audio_seconds_per_s": sum(s.audio_seconds for s in sessions) / elapsed,
+        "stages": recorder.summary()
+    }
+    print("{} sessions, {} utterances, {} errors in {:.1f}s: {:.2f} utterances/s, {:.2f}x real time audio".format(
+        report["sessions"], report["utterances"], report["errors"], elapsed, report["utterances_per_s"],
+        report["audio_seconds_per_s"]))
+    print("{:<40} {:>6} {:>9} {:>9} {:>9} {:>9}".format("stage", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for stage, s in report["stages"].items():
+        print("{:<40} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            stage, s["count"], s["p50_ms"], s["p90_ms"], s["p99_ms"], s["max_ms"]))
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()
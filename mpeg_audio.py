@@ -0,0 +1,151 @@
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+# kbps by bitrate index, for layer III
+_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+}
+_SAMPLE_RATES = [44100, 48000, 32000]
+# bytes of side information between the frame header and a Xing/Info header, by (mpeg 1, mono)
+_SIDE_INFO = {(True, False): 32, (True, True): 17, (False, False): 17, (False, True): 9}
+# bytes scanned for the first frame header at most, past any ID3v2 tag
+_SCAN_LIMIT = 65536
+
+
+def id3v2_size(data):
+    """
+    :param data: bytes-like start of an audio file
+    :return: int size of the ID3v2 tag at the start of `data`, including its header, or 0 if there is none
+    """
+    data = bytes(data[:10])
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+    size = (data[6] & 0x7f) << 21 | (data[7] & 0x7f) << 14 | (data[8] & 0x7f) << 7 | (data[9] & 0x7f)
+    # a footer repeats the header at the end of the tag
+    return 10 + size + (10 if data[5] & 0x10 else 0)
+
+
+class FrameHeader:
+    """
+    first MPEG audio (layer III) frame of a stream, and the Xing/Info header it may carry, used to map playback
+    offsets to byte positions
+    """
+    __slots__ = ('start', 'bitrate', 'sample_rate', 'samples_per_frame', 'frames', 'bytes', 'toc')
+
+    def __init__(self, start, bitrate, sample_rate, samples_per_frame, frames=None, total_bytes=None, toc=None):
+        """
+        :param start: int byte position of the first frame
+        :param bitrate: int bits per second of the first frame
+        :param sample_rate: int
+        :param samples_per_frame: int
+        :param frames: int frames in the stream, from the Xing/Info header
+        :param total_bytes: int bytes of audio in the stream, from the Xing/Info header
+        :param toc: bytes 100 entry seek table from the Xing header
+        """
+        self.start = start
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.samples_per_frame = samples_per_frame
+        self.frames = frames
+        self.bytes = total_bytes
+        self.toc = toc
+
+    def duration(self):
+        """
+        :return: float seconds of audio, or None if the stream doesn't say
+        """
+        if self.frames is None:
+            return None
+        return self.frames * self.samples_per_frame / self.sample_rate
+
+    def byte_position(self, offset_in_milliseconds):
+        """
+        :param offset_in_milliseconds: int playback offset
+        :return: int byte position of the frame playing at that offset. exact for constant bitrate streams,
+            interpolated from the seek table (or average bitrate) for variable bitrate ones
+        """
+        seconds = offset_in_milliseconds / 1000
+        duration = self.duration()
+        if duration and self.bytes:
+            fraction = min(seconds / duration, 1.0)
+            if self.toc is not None:
+                percent = min(fraction * 100, 99.999)
+                i = int(percent)
+                lower = self.toc[i]
+                upper = self.toc[i + 1] if i < 99 else 256
+                fraction = (lower + (upper - lower) * (percent - i)) / 256
+            return self.start + int(fraction * self.bytes)
+        return self.start + int(seconds * self.bitrate / 8)
+
+    def __repr__(self):
+        return '<FrameHeader at {} {}bps {}Hz frames={}>'.format(self.start, self.bitrate, self.sample_rate,
+                                                                 self.frames)
+
+
+def _decode(header):
+    """
+    :param header: int 32 bit frame header
+    :return: tuple of (mpeg 1, mono, bitrate, sample rate, samples per frame, frame length), or None if it isn't a
+        valid layer III header
+    """
+    if header >> 21 != 0x7ff:
+        return None
+    version = header >> 19 & 3
+    layer = header >> 17 & 3
+    bitrate_index = header >> 12 & 0xf
+    sample_rate_index = header >> 10 & 3
+    if version == 1 or layer != 1 or bitrate_index in [0, 15] or sample_rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = _BITRATES[1 if mpeg1 else 2][bitrate_index] * 1000
+    # mpeg 2 halves the sample rates of mpeg 1, mpeg 2.5 quarters them
+    sample_rate = _SAMPLE_RATES[sample_rate_index] >> {3: 0, 2: 1, 0: 2}[version]
+    samples_per_frame = 1152 if mpeg1 else 576
+    padding = header >> 9 & 1
+    frame_length = samples_per_frame // 8 * bitrate // sample_rate + padding
+    return mpeg1, header >> 6 & 3 == 3, bitrate, sample_rate, samples_per_frame, frame_length
+
+
+def parse_header(data, base=0):
+    """
+    find the first layer III frame in `data`. a frame is only accepted if the frame after it, when it is in `data`,
+    starts with a header too.
+
+    :param data: bytes-like start of the stream, from byte `base` on. an ID3v2 tag at the start of the stream is
+        skipped
+    :param base: int byte position of `data` in the stream, eg. when it was fetched past an ID3v2 tag
+    :return: FrameHeader, or None if `data` doesn't hold a layer III frame
+    """
+    skip = id3v2_size(data) if base == 0 else 0
+    data = bytes(data[skip:skip + _SCAN_LIMIT])
+    base += skip
+    position = 0
+    while True:
+        position = data.find(b'\xff', position)
+        if position < 0 or position + 4 > len(data):
+            return None
+        decoded = _decode(struct.unpack('>I', data[position:position + 4])[0])
+        if decoded is not None:
+            mpeg1, mono, bitrate, sample_rate, samples_per_frame, frame_length = decoded
+            following = position + frame_length
+            if following + 4 > len(data) or _decode(struct.unpack('>I', data[following:following + 4])[0]):
+                break
+        position += 1
+    header = FrameHeader(base + position, bitrate, sample_rate, samples_per_frame)
+    xing = position + 4 + _SIDE_INFO[(mpeg1, mono)]
+    if data[xing:xing + 4] in [b'Xing', b'Info'] and len(data) >= xing + 8:
+        flags = struct.unpack('>I', data[xing + 4:xing + 8])[0]
+        field = xing + 8
+        if flags & 1:
+            header.frames = struct.unpack('>I', data[field:field + 4])[0]
+            field += 4
+        if flags & 2:
+            header.bytes = struct.unpack('>I', data[field:field + 4])[0]
+            field += 4
+        if flags & 4 and len(data) >= field + 100:
+            header.toc = data[field:field + 100]
+    logger.debug("MPEG audio header: {}".format(header))
+    return header
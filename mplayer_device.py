@@ -0,0 +1,299 @@
+import logging
+import shutil
+import subprocess
+import threading
+
+from audio_player import AudioDevice
+
+logger = logging.getLogger(__name__)
+
+# mplayer reports why playback of a file ended as "EOF code: N" at message level global=6
+_EOF_PREFIX = 'EOF code:'
+_EOF_FINISHED = 1
+_TIME_POSITION_PREFIX = 'ANS_TIME_POSITION='
+
+
+class Playback:
+    """
+    handle to a file or stream being played by a SlavePlayer. `position` is the last position in seconds reported by
+    the player, updated asynchronously after `SlaveMplayerAudioDevice.position` is called.
+    """
+    def __init__(self, file, playlist=False, loop=False):
+        self.file = file
+        self.playlist = playlist
+        self.loop = loop
+        self.paused = False
+        self.ended = False
+        self.position = 0.0
+        self.player = None
+        self._lock = threading.Lock()
+        self._callbacks = None
+        self._error = None
+        self._notified = False
+
+    def watch(self, on_finished, on_error):
+        with self._lock:
+            self._callbacks = (on_finished, on_error)
+        if self.ended:
+            self.notify(self._error)
+
+    def notify(self, error=None):
+        """
+        mark playback ended and call the watch callback, once
+
+        :param error: Exception if the player failed
+        """
+        self.ended = True
+        with self._lock:
+            self._error = self._error or error
+            if self._callbacks is None or self._notified:
+                return
+            self._notified = True
+            on_finished, on_error = self._callbacks
+        if self._error is not None and on_error is not None:
+            on_error(self, self._error)
+        else:
+            on_finished(self)
+
+    def __repr__(self):
+        return '<Playback {} ended={} position={}>'.format(self.file, self.ended, self.position)
+
+
+class SlavePlayer:
+    """
+    one long-lived mplayer process in idle slave mode. files are loaded with `loadfile` and commands are written to its
+    stdin without waiting for a reply; a reader thread follows its output for end-of-file and position reports.
+    """
+    def __init__(self, device, binary_path, options):
+        """
+        :param device: SlaveMplayerAudioDevice the player belongs to, notified when it becomes idle or dies
+        :param binary_path: str mplayer binary
+        :param options: list of str extra mplayer options, eg. ['-ao', 'alsa']
+        """
+        self._device = device
+        self._lock = threading.Lock()
+        self._process = subprocess.Popen([binary_path, '-idle', '-slave', '-quiet', '-noconsolecontrols',
+                                          '-msglevel', 'global=6'] + options,
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.playback = None
+        # volume in percent last set with `set_volume`, which mplayer keeps across files
+        self.volume = 100
+        self._reader = threading.Thread(target=self._read_output, name='Mplayer Reader Thread')
+        self._reader.daemon = True
+        self._reader.start()
+
+    def is_alive(self):
+        return self._process.poll() is None
+
+    def command(self, command):
+        """
+        send a slave mode command. does not wait for mplayer to act on it.
+
+        :param command: str slave mode command, eg. 'pause'
+        :return: True if the command was written, False if the player has died
+        """
+        try:
+            with self._lock:
+                self._process.stdin.write(command.encode() + b'\n')
+                self._process.stdin.flush()
+            return True
+        except (BrokenPipeError, ValueError):
+            logger.warning("mplayer exited, dropping command {}".format(command))
+            return False
+
+    def load(self, playback):
+        """
+        :param playback: Playback to start on this player
+        """
+        self.playback = playback
+        playback.player = self
+        self.command('{} "{}"'.format('loadlist' if playback.playlist else 'loadfile',
+                                      playback.file.replace('\\', '\\\\').replace('"', '\\"')))
+        if self.volume != 100:
+            # eg. the previous file was ducked when it ended
+            self.set_volume(100)
+
+    def set_volume(self, volume):
+        """
+        :param volume: int volume in percent
+        """
+        self.volume = volume
+        self.command('pausing_keep volume {} 1'.format(volume))
+
+    def _read_output(self):
+        for line in self._process.stdout:
+            line = line.decode('utf8', 'replace').strip()
+            playback = self.playback
+            if line.startswith(_TIME_POSITION_PREFIX):
+                if playback is not None:
+                    try:
+                        playback.position = float(line[len(_TIME_POSITION_PREFIX):])
+                    except ValueError:
+                        pass
+            elif line.startswith(_EOF_PREFIX):
+                self._file_ended(playback, line[len(_EOF_PREFIX):].strip())
+        logger.warning("mplayer exited with {}".format(self._process.wait()))
+        self._device._player_died(self)
+        if self.playback is not None:
+            self.playback.notify(RuntimeError("mplayer exited"))
+
+    def _file_ended(self, playback, code):
+        if playback is None:
+            return
+        if playback.loop and not playback.ended and code == str(_EOF_FINISHED):
+            self.load(playback)
+            return
+        self.playback = None
+        self._device._player_idle(self)
+        playback.notify()
+
+    def quit(self):
+        self.command('quit')
+
+
+class SlaveMplayerAudioDevice(AudioDevice):
+    """
+    AudioDevice playing through a pool of persistent mplayer processes in slave mode, so starting playback costs a
+    `loadfile` command instead of a process spawn, and stop/pause/volume never wait for mplayer.
+
+    a process is taken from the pool for each playback (spawning one only if all are busy, eg. an alert playing under
+    speech) and returned to it at end-of-file. end-of-file and position are tracked by a reader thread per process.
+    """
+    def __init__(self, binary_path='mplayer', options=None):
+        """
+        :param binary_path: str mplayer binary
+        :param options: list of str extra mplayer options, eg. ['-ao', 'alsa']
+        """
+        self._binary_path = binary_path
+        self._options = options or []
+        self._lock = threading.Lock()
+        self._idle = []
+        self._players = []
+
+    def check_exists(self):
+        return shutil.which(self._binary_path)
+
+    def warm_up(self, count=1):
+        """
+        start `count` idle players ahead of the first playback
+
+        :param count: int
+        """
+        with self._lock:
+            while len(self._idle) < count:
+                self._idle.append(self._spawn())
+
+    def _spawn(self):
+        player = SlavePlayer(self, self._binary_path, self._options)
+        self._players.append(player)
+        return player
+
+    def _acquire(self):
+        with self._lock:
+            while self._idle:
+                player = self._idle.pop()
+                if player.is_alive():
+                    return player
+            return self._spawn()
+
+    def _player_idle(self, player):
+        with self._lock:
+            if player.is_alive() and player not in self._idle:
+                self._idle.append(player)
+
+    def _player_died(self, player):
+        with self._lock:
+            if player in self._idle:
+                self._idle.remove(player)
+            if player in self._players:
+                self._players.remove(player)
+
+    def _start(self, playback):
+        """
+        :param playback: Playback to start
+        :return: `playback`. if it couldn't be started it has already ended with the error, which is reported to the
+            `on_error` callback once it is watched
+        """
+        try:
+            self._acquire().load(playback)
+        except Exception as e:
+            logger.exception("Couldn't play audio")
+            playback.notify(e)
+        return playback
+
+    def play_once(self, file, playlist=False):
+        return self._start(Playback(file, playlist))
+
+    def play_infinite(self, file):
+        return self._start(Playback(file, loop=True))
+
+    def _command(self, p, command):
+        # the player may already have moved on to another playback after `p` ended
+        player = p.player
+        if not p.ended and player is not None and player.playback is p:
+            player.command(command)
+
+    def seek(self, p, offset_in_milliseconds, byte_position=None):
+        """
+        seeks by byte position if it is known, which mplayer serves from HTTP streams with a Range request, and by time
+        otherwise
+        """
+        if byte_position is not None:
+            self._command(p, 'pausing_keep_force set_property stream_pos {}'.format(byte_position))
+        else:
+            self._command(p, 'pausing_keep_force seek {:.3f} 2'.format(offset_in_milliseconds / 1000))
+        p.position = offset_in_milliseconds / 1000
+
+    def stop(self, p):
+        """
+        stop playback. the player is returned to the pool once mplayer reports the end of the file.
+        """
+        p.loop = False
+        self._command(p, 'stop')
+        p.ended = True
+
+    def pause(self, p):
+        if not p.paused:
+            self._command(p, 'pause')
+            p.paused = True
+
+    def resume(self, p):
+        if p.paused:
+            self._command(p, 'pause')
+            p.paused = False
+
+    def set_volume(self, p, volume):
+        """
+        :param p: Playback
+        :param volume: int volume in percent
+        """
+        player = p.player
+        if not p.ended and player is not None and player.playback is p:
+            player.set_volume(volume)
+
+    def position(self, p):
+        """
+        :param p: Playback
+        :return: float last reported position in seconds. a fresh report is requested, which updates `p.position` once
+            mplayer answers
+        """
+        self._command(p, 'pausing_keep_force get_time_pos')
+        return p.position
+
+    def ended(self, p):
+        return p.ended
+
+    def watch(self, p, on_finished, on_error=None):
+        """
+        callbacks are made from the reader thread of the player as soon as it reports the end of the file
+        """
+        p.watch(on_finished, on_error)
+
+    def close(self):
+        """
+        quit all players
+        """
+        with self._lock:
+            players = list(self._players)
+        for player in players:
+            player.quit()
@@ -0,0 +1,203 @@
+import fractions
+import logging
+import math
+import time
+
+import numpy
+
+from speech_recognizer import AudioInputDevice
+
+logger = logging.getLogger(__name__)
+
+# AVS speech input is 16 bit little-endian PCM, 16 kHz, mono
+_SAMPLE_RATE = 16000
+_SAMPLE_WIDTH = 2
+
+
+def design_filter(up, down, transition=0.1, attenuation_db=80.0):
+    """
+    Kaiser-windowed sinc low-pass filter for resampling by `up`/`down`, split into its `up` polyphase components.
+
+    the cutoff is the lower of the input and output Nyquist frequencies. the transition band extends `transition` of
+    that frequency either side of it, so only the top of the passband can receive aliases.
+
+    :param up: int interpolation factor
+    :param down: int decimation factor
+    :param transition: float half-width of the transition band, as a fraction of the cutoff
+    :param attenuation_db: float stopband attenuation
+    :return: numpy.ndarray of float32 with shape (up, taps per phase). row p holds the taps applied to input samples
+        x[n], x[n - 1], ... for outputs falling p/up of an input sample after x[n]
+    """
+    cutoff = 0.5 / max(up, down)
+    # Kaiser's estimates of the length and shape parameter for the attenuation and transition width
+    width = 2 * transition * cutoff
+    length = int(math.ceil((attenuation_db - 7.95) / (2.285 * 2 * math.pi * width))) + 1
+    beta = 0.1102 * (attenuation_db - 8.7) if attenuation_db > 50 else 0.5842 * (attenuation_db - 21) ** 0.4 + \
+        0.07886 * (attenuation_db - 21)
+    taps = int(math.ceil(length / up))
+    t = numpy.arange(taps * up) - (taps * up - 1) / 2.0
+    prototype = 2 * cutoff * numpy.sinc(2 * cutoff * t) * numpy.kaiser(taps * up, beta) * up
+    return prototype.reshape(taps, up).T.astype(numpy.float32).copy()
+
+
+class Resampler:
+    """
+    streaming conversion of interleaved L16 audio at any sample rate and channel count to mono at another rate.
+
+    channels are mixed down with `weights`, then the mono signal is resampled by the rational factor between the two
+    rates with a polyphase filter. each call to `process` converts one block: the filter taps of all the block's
+    output samples are gathered and applied as a single matrix product, and only the last taps' worth of input is
+    carried over to the next block, so there are no per-sample loops and the latency is the filter's group delay.
+    """
+    def __init__(self, input_rate, output_rate=_SAMPLE_RATE, channels=1, weights=None, transition=0.1,
+                 attenuation_db=80.0):
+        """
+        :param input_rate: int sample rate of the input
+        :param output_rate: int sample rate of the output
+        :param channels: int interleaved channels of the input
+        :param weights: list of float mixing weight of each channel. defaults to their average
+        :param transition: float see `design_filter`
+        :param attenuation_db: float see `design_filter`
+        """
+        ratio = fractions.Fraction(output_rate, input_rate)
+        self.input_rate = input_rate
+        self.output_rate = output_rate
+        self.channels = channels
+        self.up = ratio.numerator
+        self.down = ratio.denominator
+        if weights is None:
+            weights = [1.0 / channels] * channels
+        assert len(weights) == channels
+        self._weights = numpy.array(weights, dtype=numpy.float32)
+        self._passthrough = self.up == self.down == 1 and channels == 1
+        self._filter = design_filter(self.up, self.down, transition, attenuation_db)
+        self._taps = self._filter.shape[1]
+        # signal index of x[n - j] relative to that of x[n], given the taps - 1 samples of history before the block
+        self._offsets = self._taps - 1 - numpy.arange(self._taps)
+        self.reset()
+
+    @property
+    def delay_ms(self):
+        """
+        :return: float group delay of the filter in milliseconds
+        """
+        if self._passthrough:
+            return 0.0
+        return (self._taps * self.up - 1) / 2.0 / self.up / self.input_rate * 1000
+
+    def reset(self):
+        """
+        forget the audio of the previous stream
+        """
+        self._history = numpy.zeros(self._taps - 1, dtype=numpy.float32)
+        # position of the next output sample, in 1/up input samples from the start of the next block
+        self._position = 0
+        self._remainder = b''
+
+    def process(self, pcm):
+        """
+        :param pcm: bytes of interleaved 16 bit little-endian samples. a trailing partial frame is kept for the next
+            call
+        :return: bytes of 16 bit little-endian mono samples at the output rate
+        """
+        frame_bytes = _SAMPLE_WIDTH * self.channels
+        if self._remainder:
+            pcm = self._remainder + pcm
+        usable = len(pcm) // frame_bytes * frame_bytes
+        self._remainder = pcm[usable:]
+        if self._passthrough:
+            return pcm[:usable]
+        frames = numpy.frombuffer(pcm, dtype='<i2', count=usable // _SAMPLE_WIDTH).reshape(-1, self.channels)
+        mono = frames.astype(numpy.float32).dot(self._weights) if self.channels > 1 else \
+            frames[:, 0].astype(numpy.float32)
+        n = len(mono)
+        signal = numpy.concatenate((self._history, mono))
+        count = max(0, -(-(n * self.up - self._position) // self.down))
+        positions = self._position + numpy.arange(count) * self.down
+        # row i holds x[n], x[n - 1], ... for the input sample n at or before output i
+        windows = signal[(positions // self.up)[:, None] + self._offsets[None, :]]
+        out = numpy.einsum('ij,ij->i', windows, self._filter[positions % self.up])
+        self._position += count * self.down - n * self.up
+        self._history = signal[len(signal) - (self._taps - 1):]
+        return numpy.clip(numpy.rint(out), -32768, 32767).astype('<i2').tobytes()
+
+
+class ResamplerStatistics:
+    """
+    per-utterance resampling accounting
+    """
+    def __init__(self):
+        self.blocks = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.process_seconds = 0.0
+
+    def to_dict(self):
+        return {
+            "blocks": self.blocks,
+            "input_bytes": self.input_bytes,
+            "output_bytes": self.output_bytes,
+            "process_ms": self.process_seconds * 1000
+        }
+
+    def __repr__(self):
+        return '<ResamplerStatistics {}>'.format(self.to_dict())
+
+
+class ResamplingAudioInputDevice(AudioInputDevice):
+    """
+    AudioInputDevice wrapper that converts L16 audio captured at a device's native rate and channel count (eg. 48 kHz
+    stereo from a USB microphone) to the 16 kHz mono AVS format.
+
+    the wrapped device is read in fixed blocks of `block_ms`, each resampled as soon as it is read, so the conversion
+    adds one block plus the filter delay of latency. statistics for the current or most recent utterance are available
+    as `statistics`.
+    """
+    def __init__(self, device, input_rate, channels=1, block_ms=10, weights=None):
+        """
+        :param device: AudioInputDevice providing 16 bit little-endian audio at `input_rate` with `channels`
+            interleaved channels
+        :param input_rate: int native sample rate of the device
+        :param channels: int native channel count of the device
+        :param block_ms: int audio read from the device and resampled at a time
+        :param weights: list of float mixing weight of each channel, eg. [1, 0] to use the left channel only. defaults
+            to their average
+        """
+        self._device = device
+        self._resampler = Resampler(input_rate, _SAMPLE_RATE, channels, weights)
+        self._block_bytes = input_rate * block_ms // 1000 * channels * _SAMPLE_WIDTH
+        self._buffer = b''
+        self._eof = True
+        self.statistics = None
+        logger.info("resampling {} Hz x{} to {} Hz mono ({} taps per phase, {:.2f}ms delay)".format(
+            input_rate, channels, _SAMPLE_RATE, self._resampler._taps, self._resampler.delay_ms))
+
+    def start_recording(self):
+        self._resampler.reset()
+        self._buffer = b''
+        self._eof = False
+        self.statistics = ResamplerStatistics()
+        self._device.start_recording()
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            pcm = self._device.read(self._block_bytes)
+            if pcm:
+                start = time.perf_counter()
+                out = self._resampler.process(pcm)
+                self.statistics.process_seconds += time.perf_counter() - start
+                self.statistics.blocks += 1
+                self.statistics.input_bytes += len(pcm)
+                self.statistics.output_bytes += len(out)
+                self._buffer += out
+            if len(pcm) < self._block_bytes:
+                self._eof = True
+                logger.info("finished resampling utterance: {}".format(self.statistics))
+        if size < 0:
+            size = len(self._buffer)
+        ret = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return ret
+
+    def stop_recording(self):
+        self._device.stop_recording()
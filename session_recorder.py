@@ -0,0 +1,137 @@
+import mmap
+import struct
+import threading
+import time
+
+import ujson as json
+
+# recordings start with this header, followed by records of:
+#   kind (B), timestamp (d, seconds since the epoch), metadata length (I), data length (I), JSON metadata, data
+_MAGIC = b'AVSREC1\n'
+_RECORD_HEADER = struct.Struct('<BdII')
+
+# record kinds
+REQUEST = 1
+RESPONSE = 2
+DOWNCHANNEL = 3
+
+KIND_NAMES = {
+    REQUEST: 'REQUEST',
+    RESPONSE: 'RESPONSE',
+    DOWNCHANNEL: 'DOWNCHANNEL'
+}
+
+
+def tee(iterable, chunks):
+    """
+    :param iterable: iterable of bytes request body chunks
+    :param chunks: list each chunk is appended to as it is yielded
+    :return: generator yielding the chunks of `iterable`
+    """
+    for chunk in iterable:
+        chunks.append(chunk)
+        yield chunk
+
+
+class SessionRecorder:
+    """
+    append-only recording of the traffic of an AVS session: outbound requests (events and audio uploads), event
+    responses and downchannel pushes, each with the time it happened.
+
+    records are length-prefixed and written in a single write, so a recording cut short by a crash is readable up to
+    its last complete record. `record` may be called from any thread.
+    """
+    def __init__(self, path):
+        """
+        :param path: str file to append the recording to. a new file is created if it doesn't exist
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(_MAGIC)
+            self._file.flush()
+
+    def record(self, kind, data, timestamp=None, **meta):
+        """
+        :param kind: int one of REQUEST, RESPONSE or DOWNCHANNEL
+        :param data: bytes raw body
+        :param timestamp: float seconds since the epoch the traffic happened at. defaults to now
+        :param meta: JSON-serializable details, eg. content_type
+        """
+        encoded_meta = json.dumps(meta).encode()
+        header = _RECORD_HEADER.pack(kind, time.time() if timestamp is None else timestamp, len(encoded_meta),
+                                     len(data))
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(b''.join([header, encoded_meta, data]))
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Record:
+    """
+    a single recorded request, response or push. `data` is a memoryview into the recording's memory map and is only
+    valid until the recording is closed.
+    """
+    __slots__ = ['kind', 'timestamp', 'meta', 'data']
+
+    def __init__(self, kind, timestamp, meta, data):
+        self.kind = kind
+        self.timestamp = timestamp
+        self.meta = meta
+        self.data = data
+
+    def __repr__(self):
+        return '<Record {} {} {} {} bytes>'.format(KIND_NAMES.get(self.kind, self.kind), self.timestamp, self.meta,
+                                                  len(self.data))
+
+
+class SessionRecording:
+    """
+    read-only view of a recording made by SessionRecorder. the file is memory-mapped, so record data is not copied
+    until it is used; iterating yields Records in the order they were recorded.
+    """
+    def __init__(self, path):
+        """
+        :param path: str recording file
+        :raises ValueError: if the file is not a recording
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(_MAGIC)] != _MAGIC:
+            self.close()
+            raise ValueError("{} is not an AVS session recording".format(path))
+
+    def __iter__(self):
+        view = memoryview(self._map)
+        offset = len(_MAGIC)
+        while offset + _RECORD_HEADER.size <= len(view):
+            kind, timestamp, meta_len, data_len = _RECORD_HEADER.unpack_from(view, offset)
+            offset += _RECORD_HEADER.size
+            if offset + meta_len + data_len > len(view):
+                # truncated final record
+                break
+            meta = json.loads(bytes(view[offset:offset + meta_len]).decode())
+            offset += meta_len
+            yield Record(kind, timestamp, meta, view[offset:offset + data_len])
+            offset += data_len
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # records still reference the map; it is unmapped once they are garbage collected
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
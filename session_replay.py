@@ -0,0 +1,218 @@
+import argparse
+import concurrent.futures
+import logging
+import sys
+import time
+
+import ujson as json
+
+import connection
+import session_recorder
+from audio_player import AudioDevice
+from avs import AVS
+from util import multipart_parse, is_directive
+
+logger = logging.getLogger(__name__)
+
+
+class NullAudioDevice(AudioDevice):
+    """
+    AudioDevice that plays nothing. playback ends as soon as it starts, so replays are not held up by audio. the files
+    it was asked to play are kept in `played`.
+    """
+    class _Process:
+        def poll(self):
+            return 0
+
+    def __init__(self):
+        self.played = []
+
+    def check_exists(self):
+        return True
+
+    def play_once(self, file, playlist=False):
+        self.played.append(file)
+        return self._Process()
+
+    def play_infinite(self, file):
+        return self._Process()
+
+    def seek(self, p, offset_in_milliseconds, byte_position=None):
+        pass
+
+    def stop(self, p):
+        pass
+
+    def pause(self, p):
+        pass
+
+    def resume(self, p):
+        pass
+
+    def set_volume(self, p, volume):
+        pass
+
+    def ended(self, p):
+        return True
+
+    def watch(self, p, on_finished, on_error=None):
+        # complete on the calling thread, so replays stay deterministic
+        on_finished(p)
+
+
+class ReplayAVS(AVS):
+    """
+    AVS client that never connects. events it sends are kept in `sent_events` instead, and get no response; the
+    responses and downchannel pushes of a recording are fed to it by SessionReplayer.
+    """
+    def __init__(self, audio_device=None, speech_profile='NEAR_FIELD', **kwargs):
+        """
+        :param audio_device: AudioDevice to play replayed audio with. defaults to NullAudioDevice
+        :param speech_profile: str speech profile
+        :param kwargs: passed to AVS, eg. tracer
+        """
+        self.sent_events = []
+        super().__init__('v20160207', None, None, None, None, audio_device or NullAudioDevice(), None, speech_profile,
+                         **kwargs)
+
+    def _connect(self):
+        self._ddt = None
+
+    def send_event_parse_response(self, payload, priority=connection.BACKGROUND):
+        self.sent_events.append(payload)
+        return []
+
+    def send_event_async(self, payload, priority=connection.BACKGROUND):
+        # sent on the calling thread, so replays stay deterministic
+        future = concurrent.futures.Future()
+        self._send_event_handle_response(payload, priority)
+        future.set_result(None)
+        return future
+
+    def close(self):
+        pass
+
+
+def event_header(body, content_type):
+    """
+    :param body: bytes multipart event request body
+    :param content_type: str request content-type
+    :return: dict header of the event
+    """
+    metadata = multipart_parse(body, content_type)[0][1]
+    if not isinstance(metadata, dict):
+        # the metadata part of a streamed Recognize separates its headers with a bare newline, so its content type
+        # isn't recognised
+        metadata = json.loads(bytes(metadata).decode())
+    return metadata['event']['header']
+
+
+def event_name(body, content_type):
+    """
+    :param body: bytes multipart event request body
+    :param content_type: str request content-type
+    :return: str 'Namespace.Name' of the event
+    """
+    header = event_header(body, content_type)
+    return '{}.{}'.format(header['namespace'], header['name'])
+
+
+class SessionReplayer:
+    """
+    feeds the event responses and downchannel pushes of a SessionRecording through `handle_parts` of an AVS client,
+    running its main loop (and with it the directive queue and audio player) in between.
+
+    records are delivered at the pace they were recorded, scaled by `speed`. a speed of 0 delivers them back to back,
+    running the main loop once between each, which makes replays deterministic and fast enough for regression tests.
+    """
+    def __init__(self, recording, avs, speed=1.0, poll_interval=0.01):
+        """
+        :param recording: SessionRecording
+        :param avs: AVS client to replay into, usually a ReplayAVS
+        :param speed: float playback speed, eg. 2.0 for twice as fast. 0 for as fast as possible
+        :param poll_interval: float seconds slept between main loop iterations while waiting for the next record
+        """
+        assert speed >= 0
+        self._recording = recording
+        self._avs = avs
+        self._speed = speed
+        self._poll_interval = poll_interval
+        # 'Namespace.Name' of the events the recorded client sent, in order
+        self.recorded_events = []
+        self.replayed_records = 0
+        # Speak directives in the replayed responses and pushes, which should all reach the audio device
+        self.replayed_speaks = 0
+
+    def _wait_until(self, deadline):
+        while True:
+            self._avs.run()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, self._poll_interval))
+
+    def replay(self, drain_seconds=0.0):
+        """
+        replay the whole recording
+
+        :param drain_seconds: float seconds to keep running the main loop after the last record, eg. to let playback
+            finish
+        """
+        start = None
+        first_timestamp = None
+        for record in self._recording:
+            if first_timestamp is None:
+                first_timestamp = record.timestamp
+                start = time.monotonic()
+            if record.kind == session_recorder.REQUEST:
+                header = event_header(bytes(record.data), record.meta['content_type'])
+                self.recorded_events.append('{}.{}'.format(header['namespace'], header['name']))
+                if 'dialogRequestId' in header:
+                    # a recorded Recognize starts a dialog, so the directives of its response are not dropped as stale
+                    self._avs._start_dialog(header['dialogRequestId'])
+                continue
+            if self._speed:
+                self._wait_until(start + (record.timestamp - first_timestamp) / self._speed)
+            else:
+                self._avs.run()
+            logger.info("replaying {}".format(record))
+            parts = multipart_parse(bytes(record.data), record.meta['content_type'])
+            self.replayed_speaks += sum(1 for headers, data in parts if is_directive(headers, data) and
+                                        data['directive']['header']['name'] == 'Speak')
+            self._avs.handle_parts(parts)
+            self.replayed_records += 1
+        self._wait_until(time.monotonic() + drain_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay a recorded AVS session without connecting to AVS")
+    parser.add_argument('recording', help="file recorded with session_recorder.SessionRecorder")
+    parser.add_argument('--speed', type=float, default=1.0, help="playback speed, 0 for as fast as possible")
+    parser.add_argument('--drain', type=float, default=1.0, help="seconds to keep running after the last record")
+    parser.add_argument('--check', action='store_true', help="exit with status 1 if a replayed Speak wasn't played")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    avs = ReplayAVS()
+    with session_recorder.SessionRecording(args.recording) as recording:
+        replayer = SessionReplayer(recording, avs, args.speed)
+        replayer.replay(args.drain)
+    # streamed Recognize payloads are not read, so only events with a pre-encoded body are named
+    sent = [event_name(payload.body, payload.content_type) if hasattr(payload, 'body') else None
+            for payload in avs.sent_events]
+    print(json.dumps({
+        "replayed_records": replayer.replayed_records,
+        "recorded_events": replayer.recorded_events,
+        "replayed_events": sent,
+        "directives": avs._directives.metrics(),
+        "speaks": replayer.replayed_speaks,
+        "played": len(avs.audio_device.played)
+    }, indent=4))
+    if args.check and len(avs.audio_device.played) < replayer.replayed_speaks:
+        logger.error("{} Speak directives replayed, {} played".format(replayer.replayed_speaks,
+                                                                     len(avs.audio_device.played)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
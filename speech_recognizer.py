@@ -4,8 +4,15 @@ FAR_FIELD = 'FAR_FIELD'
 
 SPEECH_CLOUD_ENDPOINTING_PROFILES = [NEAR_FIELD, FAR_FIELD]
 
+# Recognize audio formats
+AUDIO_L16_RATE_16000_CHANNELS_1 = 'AUDIO_L16_RATE_16000_CHANNELS_1'
+OPUS = 'OPUS'
+
 
 class AudioInputDevice:
+    # format of the audio returned by `read`, sent as the Recognize event's payload format
+    audio_format = AUDIO_L16_RATE_16000_CHANNELS_1
+
     def start_recording(self):
         raise NotImplementedError
 
@@ -14,5 +21,3 @@ class AudioInputDevice:
 
     def stop_recording(self):
         raise NotImplementedError
-
-
@@ -1,5 +1,127 @@
+import logging
+import threading
+import time
+
+import connection
+import event_templates
+
+logger = logging.getLogger(__name__)
+
 # speech synthesizer states
 PLAYING = 'PLAYING'
 FINISHED = 'FINISHED'
 
-# TODO: move speech synthesizer state machine here?
+
+class SpeechSynthesizer:
+    """
+    speech synthesizer state machine
+
+    `speak` starts playback and returns straight away; the speech completes when the audio device's watch callback
+    reports the end of playback. the offset reported in the context is measured with a monotonic clock from the
+    moment playback was started.
+    """
+    def __init__(self, avs):
+        self._avs = avs
+        self._lock = threading.RLock()
+        self._state = FINISHED
+        self._token = None
+        self._process = None
+        self._started_at = None
+        # offset of the most recent speech when it finished or was stopped
+        self._final_offset = 0
+
+    def get_state(self):
+        return self._state
+
+    def get_token(self):
+        return self._token
+
+    def get_offset(self):
+        """
+        :return: int offset in milliseconds into the current speech, or where the most recent speech ended
+        """
+        if self._state == PLAYING:
+            return int((time.monotonic() - self._started_at) * 1000)
+        return self._final_offset
+
+    def is_speaking(self, token):
+        """
+        :param token: str Speak directive token
+        :return: True if the speech for `token` has been started and has not completed yet
+        """
+        return self._state == PLAYING and self._token == token
+
+    def _set_state(self, state):
+        """
+        move the state machine to `state`, reporting the transition to the AVS tracer
+
+        :param state: str one of the speech synthesizer states
+        """
+        self._avs.tracer.instant('speech_state', 'speech', previous=self._state, state=state, token=self._token)
+        self._state = state
+        self._avs._context_changed()
+
+    def speak(self, token, file):
+        """
+        start playback of the speech audio file at path `file` and send SpeechStarted. speech in progress is stopped
+        first. SpeechStarted is sent in the background, so the lock is never held across a network round trip and
+        `stop` takes effect straight away. if the audio device can't start playback, the speech finishes at once.
+
+        :param token: str Speak directive token
+        :param file: str path to the speech audio
+        """
+        with self._lock:
+            if self._state == PLAYING:
+                self.stop()
+            self._token = token
+            self._process = self._avs.audio_device.play_once(file)
+            self._started_at = time.monotonic()
+            self._set_state(PLAYING)
+            self._avs.send_event_async(event_templates.SPEECH_STARTED.payload(token), connection.DIALOG)
+            if self._process is not None:
+                self._avs.audio_device.watch(self._process, self._on_finished)
+                return
+            logger.warning("unable to start playback of speech {}".format(token))
+            self._finish()
+        # the speech is finished straight away, so the dialog goes on without it
+        self._avs._speech_finished(token)
+        self._avs.send_event_async(event_templates.SPEECH_FINISHED.payload(token), connection.DIALOG)
+
+    def _finish(self):
+        """
+        record the final offset and move to the Finished state
+        """
+        self._final_offset = self.get_offset()
+        self._process = None
+        self._set_state(FINISHED)
+
+    def _on_finished(self, p):
+        """
+        audio device callback: send SpeechFinished and move to the Finished state, unless the speech was stopped
+
+        :param p: handle to the speech playback that ended
+        """
+        with self._lock:
+            if self._state != PLAYING or self._process is not p:
+                return
+            logger.info("speech {} finished after {}ms".format(self._token, self.get_offset()))
+            self._finish()
+            token = self._token
+        # a follow-up Recognize armed by ExpectSpeech starts before SpeechFinished is sent
+        self._avs._speech_finished(token)
+        # queued behind SpeechStarted, and sent without holding the lock
+        self._avs.send_event_async(event_templates.SPEECH_FINISHED.payload(token), connection.DIALOG)
+
+    def stop(self):
+        """
+        stop the speech being played without sending SpeechFinished, eg. when it is interrupted
+
+        :return: True if speech was stopped
+        """
+        with self._lock:
+            if self._state == PLAYING:
+                self._avs.audio_device.stop(self._process)
+                logger.info("speech {} stopped after {}ms".format(self._token, self.get_offset()))
+                self._finish()
+                return True
+            return False
@@ -0,0 +1,300 @@
+import concurrent.futures
+import datetime
+import logging
+import threading
+import time
+
+import mpeg_audio
+import util
+
+logger = logging.getLogger(__name__)
+
+M3U_CONTENT_TYPES = ['audio/x-mpegurl', 'audio/mpegurl', 'application/x-mpegurl', 'application/vnd.apple.mpegurl']
+PLS_CONTENT_TYPES = ['audio/x-scpls']
+# bytes read from the start of an audio stream to find its first frame header
+_PROBE_SIZE = 16384
+
+
+class Resolution:
+    """
+    playable URL a stream URL resolved to. `playlist` is True if the device should load it as a playlist itself (an
+    HLS playlist, or a playlist nested deeper than the resolver follows). for MP3 streams, `header` is the first frame
+    header, used to start playback part way through.
+    """
+    __slots__ = ('url', 'playlist', 'chain', 'header', 'accepts_ranges')
+
+    def __init__(self, url, playlist=False, chain=None, header=None, accepts_ranges=False):
+        self.url = url
+        self.playlist = playlist
+        self.chain = chain or []
+        self.header = header
+        self.accepts_ranges = accepts_ranges
+
+    def byte_position(self, offset_in_milliseconds):
+        """
+        :param offset_in_milliseconds: int playback offset
+        :return: int byte position to request the stream from, or None if the server doesn't serve byte ranges or the
+            stream's bitrate is unknown
+        """
+        if not self.accepts_ranges or self.header is None:
+            return None
+        return self.header.byte_position(offset_in_milliseconds)
+
+    def __repr__(self):
+        return '<Resolution {} playlist={} via {}>'.format(self.url, self.playlist, self.chain)
+
+
+def _playlist_format(url, content_type):
+    """
+    :return: 'm3u', 'pls' or None, from the response content type or, failing that, the URL's extension
+    """
+    content_type = content_type.split(';')[0].strip().lower()
+    path = url.split('?')[0].lower()
+    if content_type in M3U_CONTENT_TYPES or path.endswith(('.m3u', '.m3u8')):
+        return 'm3u'
+    if content_type in PLS_CONTENT_TYPES or path.endswith('.pls'):
+        return 'pls'
+    return None
+
+
+def parse_m3u(text):
+    """
+    :param text: str M3U playlist
+    :return: list of str entries, or None if it is an HLS playlist, which is played as a whole
+    """
+    if '#EXT-X-' in text:
+        return None
+    return [line.strip() for line in text.splitlines() if line.strip() and not line.startswith('#')]
+
+
+def parse_pls(text):
+    """
+    :param text: str PLS playlist
+    :return: list of str entries, in FileN order
+    """
+    entries = []
+    for line in text.splitlines():
+        key, _, value = line.strip().partition('=')
+        if key.lower().startswith('file') and key[4:].isdigit() and value:
+            entries.append((int(key[4:]), value.strip()))
+    return [url for _, url in sorted(entries)]
+
+
+class ResolverStatistics:
+    """
+    cache hit rate and latency of resolutions. a miss is a resolution that went to the network, a hit a `resolve` that
+    was answered from the cache, including streams prefetched ahead of playback
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds):
+        self.misses += 1
+        self.total_seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+
+    def to_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "failures": self.failures,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "mean_ms": self.total_seconds * 1000 / self.misses if self.misses else 0.0,
+            "max_ms": self.max_seconds * 1000
+        }
+
+    def __repr__(self):
+        return '<ResolverStatistics {}>'.format(self.to_dict())
+
+
+class StreamResolver:
+    """
+    resolves AudioPlayer stream URLs (M3U and PLS playlists, possibly nested) to a playable URL on worker threads, so
+    playback doesn't wait on the network in the main loop.
+
+    `prefetch` starts resolving a stream as soon as its Play directive arrives; `resolve` returns the result, waiting
+    for it only if it isn't ready yet. results are cached for `ttl` seconds, but never past the stream's expiryTime,
+    and concurrent lookups of the same URL share one request.
+    """
+    def __init__(self, ttl=600, max_depth=3, timeout=10, workers=2, max_entries=256):
+        """
+        :param ttl: float seconds a resolution is cached at most
+        :param max_depth: int playlist nesting followed at most
+        :param timeout: float seconds allowed for each HTTP request
+        :param workers: int resolver threads
+        :param max_entries: int cached resolutions kept at most
+        """
+        self.ttl = ttl
+        self.max_depth = max_depth
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._session = None
+        self._lock = threading.Lock()
+        # url: (Resolution, monotonic expiry)
+        self._cache = {}
+        self._pending = {}
+        self.statistics = ResolverStatistics()
+
+    def _ttl(self, expiry_time):
+        """
+        :param expiry_time: str ISO 8601 expiryTime of the stream, or None
+        :return: float seconds the resolution may be cached
+        """
+        if not expiry_time:
+            return self.ttl
+        try:
+            expires = util.parse_iso8601(expiry_time)
+        except (ValueError, OverflowError):
+            logger.warning("unable to parse expiryTime {}".format(expiry_time))
+            return self.ttl
+        remaining = (expires - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+        return max(0, min(self.ttl, remaining))
+
+    def _cached(self, url):
+        entry = self._cache.get(url)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self._cache[url]
+            return None
+        return entry[0]
+
+    def prefetch(self, url, expiry_time=None):
+        """
+        start resolving `url` unless it is cached or already being resolved
+
+        :param url: str stream URL
+        :param expiry_time: str ISO 8601 time after which the URL is no longer valid
+        :return: concurrent.futures.Future of the Resolution
+        """
+        with self._lock:
+            resolution = self._cached(url)
+            if resolution is not None:
+                future = concurrent.futures.Future()
+                future.set_result(resolution)
+                return future
+            future = self._pending.get(url)
+            if future is None:
+                future = self._executor.submit(self._resolve, url, expiry_time)
+                self._pending[url] = future
+            return future
+
+    def resolve(self, url, expiry_time=None):
+        """
+        :param url: str stream URL
+        :param expiry_time: str ISO 8601 time after which the URL is no longer valid
+        :return: Resolution. if resolution fails, the URL is returned unchanged for the device to try
+        """
+        with self._lock:
+            resolution = self._cached(url)
+            if resolution is not None:
+                self.statistics.hits += 1
+                return resolution
+        try:
+            return self.prefetch(url, expiry_time).result()
+        except Exception:
+            logger.exception("unable to resolve {}".format(url))
+            return Resolution(url)
+
+    def _resolve(self, url, expiry_time):
+        start = time.monotonic()
+        try:
+            resolution = self._follow(url, 0, [])
+        except Exception:
+            with self._lock:
+                self.statistics.failures += 1
+                self._pending.pop(url, None)
+            raise
+        elapsed = time.monotonic() - start
+        logger.info("resolved {} in {:.0f}ms: {}".format(url, elapsed * 1000, resolution))
+        with self._lock:
+            self.statistics.add(elapsed)
+            if len(self._cache) >= self.max_entries:
+                # drop the entry closest to expiry
+                del self._cache[min(self._cache, key=lambda k: self._cache[k][1])]
+            self._cache[url] = (resolution, time.monotonic() + self._ttl(expiry_time))
+            self._pending.pop(url, None)
+        return resolution
+
+    def _get(self, url, **kwargs):
+        # requests is imported by the first lookup, on a resolver thread, rather than at startup
+        import requests
+        with self._lock:
+            if self._session is None:
+                self._session = requests.session()
+        return self._session.get(url, timeout=self.timeout, **kwargs)
+
+    def _follow(self, url, depth, chain):
+        """
+        :param url: str URL to resolve
+        :param depth: int playlists followed so far
+        :param chain: list of str playlist URLs followed so far
+        :return: Resolution
+        """
+        if depth >= self.max_depth:
+            return Resolution(url, True, chain)
+        # the body is only read for playlists, so audio streams are not downloaded
+        import requests
+        r = self._get(url, stream=True)
+        try:
+            r.raise_for_status()
+            playlist_format = _playlist_format(url, r.headers.get('Content-Type', ''))
+            if playlist_format is None:
+                accepts_ranges = 'bytes' in r.headers.get('Accept-Ranges', '')
+                header = self._probe(url, next(r.iter_content(_PROBE_SIZE), b''), accepts_ranges)
+                return Resolution(url, False, chain, header, accepts_ranges)
+            text = r.text
+        finally:
+            r.close()
+        entries = parse_m3u(text) if playlist_format == 'm3u' else parse_pls(text)
+        if entries is None:
+            return Resolution(url, True, chain)
+        for entry in entries:
+            try:
+                return self._follow(requests.compat.urljoin(url, entry), depth + 1, chain + [url])
+            except requests.exceptions.RequestException:
+                logger.warning("playlist {} entry {} unavailable".format(url, entry), exc_info=True)
+        raise ValueError("playlist {} has no playable entries".format(url))
+
+    def _probe(self, url, head, accepts_ranges):
+        """
+        :param url: str audio stream URL
+        :param head: bytes start of the stream
+        :param accepts_ranges: bool the server serves byte ranges of `url`
+        :return: mpeg_audio.FrameHeader of the stream, or None if it isn't MP3
+        """
+        import requests
+        tag_size = mpeg_audio.id3v2_size(head)
+        if tag_size + 4 <= len(head):
+            return mpeg_audio.parse_header(head)
+        if not accepts_ranges:
+            return None
+        # the ID3 tag (eg. cover art) is larger than the probe, so only the bytes after it are requested
+        try:
+            r = self._get(url, headers={'Range': 'bytes={}-{}'.format(tag_size, tag_size + _PROBE_SIZE - 1)})
+            if r.status_code != 206:
+                return None
+            return mpeg_audio.parse_header(r.content, tag_size)
+        except requests.exceptions.RequestException:
+            logger.warning("unable to probe {}".format(url), exc_info=True)
+            return None
+
+    def metrics(self):
+        """
+        :return: dict of cache and latency statistics
+        """
+        with self._lock:
+            metrics = self.statistics.to_dict()
+            metrics["cached"] = len(self._cache)
+            metrics["pending"] = len(self._pending)
+        return metrics
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -1,58 +1,17 @@
 import logging
 import sys
-import subprocess
 import json
 import queue
 import threading
-import shutil
+import time
 
 import pyaudio
 
 import snowboydecoder
 from speech_recognizer import AudioInputDevice
 import avs
-from audio_player import AudioDevice
-
-
-class MplayerAudioDevice(AudioDevice):
-    def __init__(self, binary_path, options=None):
-        self._binary_path = binary_path
-        self._paused = False
-        self._options = options or []
-
-    def check_exists(self):
-        return shutil.which(self._binary_path)
-
-    def play_once(self, file, playlist=False):
-        try:
-            return subprocess.Popen([self._binary_path] + self._options + (['-playlist'] if playlist else []) + [file],
-                                    stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT)
-        except Exception:
-            logger.exception("Couldn't play audio")
-
-    def play_infinite(self, file):
-        try:
-            return subprocess.Popen(
-                [self._binary_path] + self._options + ["-loop", "0", file],
-                stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT)
-        except:
-            logger.exception("Couldn't play audio")
-
-    def stop(self, p):
-        p.communicate(input=b'quit 0\n')
-
-    def pause(self, p):
-        if not self._paused:
-            p.communicate(input=b'pause\n')
-            self._paused = True
-
-    def resume(self, p):
-        if self._paused:
-            p.communicate(input=b'pause\n')
-            self._paused = False
-
-    def ended(self, p):
-        return p.poll() is not None
+from capture_hub import CaptureHub
+from mplayer_device import SlaveMplayerAudioDevice
 
 
 class PyAudioInputDevice(AudioInputDevice):
@@ -96,29 +55,30 @@ class PyAudioInputDevice(AudioInputDevice):
         self._event.set()
 
 
-def hotword_detect(logger, q, mic_stopped):
-    interrupted = False
-
-    def hotword_detected_callback():
-        snowboydecoder.play_audio_file()
-        nonlocal interrupted
-        interrupted = True
-
-    def interrupt_check_callback():
-        return interrupted
-
+def hotword_detect(logger, q, hub):
+    # snowboy is fed from the shared capture hub instead of opening its own microphone stream. no detection sound is
+    # played, as it would be captured in the Recognize pre-roll.
     detector = snowboydecoder.HotwordDetector('resources/alexa.umdl', sensitivity=0.5)
+    reader = hub.reader()
+    reader.start_recording()
     logger.info("waiting for hotword...")
-    detector.start(detected_callback=hotword_detected_callback,
-                   interrupt_check=interrupt_check_callback,
-                   sleep_time=0.03)
-    detector.terminate()
+    while True:
+        data = reader.read(hub.ms_to_bytes(30))
+        if not data:
+            logger.warning("capture stopped while waiting for hotword")
+            return
+        if detector.detector.RunDetection(data) > 0:
+            break
+    triggered_at = time.monotonic()
+    reader.stop_recording()
+    # silence Alexa straight from this thread, rather than waiting for the main loop to pick up the hotword
+    a.barge_in(triggered_at)
 
-    q.put(('hotword',))
+    q.put(('hotword', triggered_at))
 
 
 def start_hotword_detection_thread(q):
-    hdt = threading.Thread(target=hotword_detect, name='Hotword Detection Thread', args=(logger, q, mic_stopped))
+    hdt = threading.Thread(target=hotword_detect, name='Hotword Detection Thread', args=(logger, q, hub))
     hdt.setDaemon(False)
     hdt.start()
 
@@ -142,26 +102,30 @@ if __name__ == '__main__':
     tokens = json.load(open('tokens.txt'))
     secrets = json.load(open('secrets.txt'))
     q = queue.Queue()
-    audio_devices = [MplayerAudioDevice('mplayer', ["-ao", "alsa", "-really-quiet", "-noconsolecontrols", "-slave"]),
-                     MplayerAudioDevice('/Applications/MPlayer OSX Extended.app/Contents/Resources/Binaries/mpextended.mpBinaries/Contents/MacOS/mplayer', ["-really-quiet", "-noconsolecontrols", "-slave"])]
+    # a single microphone stream is shared by hotword detection and Recognize; Recognize starts with the last 300ms
+    hub = CaptureHub(PyAudioInputDevice())
+    hub.start()
+    # players are kept running in slave mode between clips, so playback starts without spawning a process
+    audio_devices = [SlaveMplayerAudioDevice('mplayer', ["-ao", "alsa"]),
+                     SlaveMplayerAudioDevice('/Applications/MPlayer OSX Extended.app/Contents/Resources/Binaries/mpextended.mpBinaries/Contents/MacOS/mplayer')]
+    audio_device = next(audio_device for audio_device in audio_devices if audio_device.check_exists())
+    audio_device.warm_up()
     a = avs.AVS('v20160207',
                 tokens.get('access_token'),
                 tokens.get('refresh_token'),
                 secrets.get('client_id'),
                 secrets.get('client_secret'),
-                next(audio_device for audio_device in audio_devices if audio_device.check_exists()),
-                PyAudioInputDevice(),
+                audio_device,
+                hub.reader(preroll_ms=300),
                 'NEAR_FIELD')
 
-    mic_stopped = threading.Event()
-
     start_hotword_detection_thread(q)
     while True:
         try:
             job = q.get(block=False)
             if job[0] == 'hotword':
                 logger.info("STARTING RECOGNIZE SPEECH")
-                a.recognize_speech()
+                a.recognize_speech(job[1])
                 logger.info("FINISHED RECOGNIZE SPEECH")
                 start_hotword_detection_thread(q)
             else:
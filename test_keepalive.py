@@ -0,0 +1,84 @@
+import contextlib
+import sched
+import unittest
+
+from keepalive import KeepAlive
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeConnection:
+    def __init__(self):
+        self.pings = []
+
+    @property
+    @contextlib.contextmanager
+    def _conn(self):
+        yield self
+
+    def receive_data(self, data):
+        return []
+
+    def ping(self, data):
+        self.pings.append(data)
+
+
+class ReconnectTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = sched.scheduler(self.clock.time, self.clock.sleep)
+        self.attempts = 0
+
+    def declare_dead(self, keepalive):
+        keepalive.attach(FakeConnection())
+        keepalive.dead_connections += 1
+        keepalive._generation += 1
+        keepalive._reconnect(keepalive._generation, 0)
+
+    def run_until_attempts(self, attempts, seconds=60):
+        # PINGs of an attached connection keep the scheduler busy, so it is run one virtual second at a time. the
+        # retries have to happen well before the first PING is due, rather than after it timed out
+        while self.attempts < attempts and not self.scheduler.empty() and self.clock.now < seconds:
+            self.scheduler.run(blocking=False)
+            self.clock.sleep(1)
+
+    def test_retries_until_reconnected(self):
+        def on_dead():
+            self.attempts += 1
+            if self.attempts < 3:
+                raise OSError("network unreachable")
+            keepalive.attach(FakeConnection())
+
+        keepalive = KeepAlive(self.scheduler, on_dead, min_interval=1000, max_interval=1000)
+        self.declare_dead(keepalive)
+        self.run_until_attempts(3)
+        self.assertEqual(3, self.attempts)
+        self.assertEqual(2, keepalive.reconnect_failures)
+
+    def test_retries_when_failing_after_attach(self):
+        def on_dead():
+            self.attempts += 1
+            # eg. the new connection was attached, but its downchannel or SynchronizeState failed
+            keepalive.attach(FakeConnection())
+            if self.attempts < 3:
+                raise OSError("SynchronizeState failed")
+
+        keepalive = KeepAlive(self.scheduler, on_dead, min_interval=1000, max_interval=1000)
+        self.declare_dead(keepalive)
+        self.run_until_attempts(3)
+        self.assertEqual(3, self.attempts)
+        self.assertEqual(2, keepalive.reconnect_failures)
+        self.assertEqual(0, keepalive.failures)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+from util import multipart_parse
+
+BOUNDARY = 'b0undary'
+CONTENT_TYPE = 'multipart/related; boundary={}; type="application/json"'.format(BOUNDARY)
+JSON_PART = b'--b0undary\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n{"directive": {}}'
+BINARY_PART = b'--b0undary\r\nContent-Type: application/octet-stream\r\nContent-ID: <audio>\r\n\r\nAUDIO'
+
+
+class MultipartParseTest(unittest.TestCase):
+    def assert_parts(self, parts):
+        self.assertEqual(2, len(parts))
+        self.assertEqual({'directive': {}}, parts[0][1])
+        self.assertEqual(b'<audio>', parts[1][0][b'Content-ID'])
+        self.assertEqual(b'AUDIO', bytes(parts[1][1]))
+
+    def test_close_delimiter(self):
+        self.assert_parts(multipart_parse(JSON_PART + b'\r\n' + BINARY_PART + b'\r\n--b0undary--\r\n', CONTENT_TYPE))
+
+    def test_trailing_open_delimiter(self):
+        self.assert_parts(multipart_parse(JSON_PART + b'\r\n' + BINARY_PART + b'\r\n--b0undary\r\n', CONTENT_TYPE))
+
+    def test_trailing_bare_delimiter(self):
+        self.assert_parts(multipart_parse(JSON_PART + b'\r\n' + BINARY_PART + b'\r\n--b0undary', CONTENT_TYPE))
+
+    def test_no_trailing_delimiter(self):
+        self.assert_parts(multipart_parse(JSON_PART + b'\r\n' + BINARY_PART, CONTENT_TYPE))
+
+    def test_part_without_headers(self):
+        parts = multipart_parse(b'--b0undary\r\n\r\nAUDIO\r\n--b0undary--\r\n', CONTENT_TYPE)
+        self.assertEqual(1, len(parts))
+        self.assertEqual({}, dict(parts[0][0]))
+        self.assertEqual(b'AUDIO', bytes(parts[0][1]))
+
+    def test_truncated_headers(self):
+        with self.assertRaises(ValueError):
+            multipart_parse(b'--b0undary\r\nContent-Type: application/js', CONTENT_TYPE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+import collections
+import os
+import threading
+import time
+
+import ujson as json
+
+
+class Span:
+    """
+    a timed section of the request/directive pipeline. created by `Tracer.span` and used as a context manager; the
+    span is reported to the tracer's hooks when the `with` block exits.
+
+    `args` carries correlation data, most importantly 'dialogRequestId' and 'messageId'.
+    """
+    __slots__ = ('name', 'category', 'args', 'start', 'end', 'thread_id', 'thread_name', '_hooks')
+
+    def __init__(self, hooks, name, category, args):
+        self._hooks = hooks
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+        self.end = None
+        current = threading.current_thread()
+        self.thread_id = current.ident
+        self.thread_name = current.name
+
+    @property
+    def duration(self):
+        """
+        :return: float seconds the span took, or None if it has not finished
+        """
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def is_instant(self):
+        return self.start == self.end
+
+    def annotate(self, **args):
+        """
+        add correlation data that only becomes known while the span is running (eg. a stream ID or messageId)
+        """
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        for hook in self._hooks:
+            hook.span_started(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.perf_counter()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        for hook in self._hooks:
+            hook.span_finished(self)
+        return False
+
+
+class _NullSpan:
+    """
+    shared span handed out while no hooks are registered, so that tracing costs a single method call when unused
+    """
+    __slots__ = ()
+
+    def annotate(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class TraceHook:
+    """
+    base-class for tracing hooks. hooks may be called from any thread.
+    """
+    def span_started(self, span):
+        pass
+
+    def span_finished(self, span):
+        pass
+
+
+class Tracer:
+    """
+    dispatches spans around the request and directive pipeline to registered `TraceHook`s.
+    """
+    def __init__(self):
+        # replaced (never mutated) so that threads iterating a snapshot are unaffected by add/remove
+        self._hooks = ()
+
+    @property
+    def enabled(self):
+        return bool(self._hooks)
+
+    def add_hook(self, hook):
+        """
+        :param hook: TraceHook
+        """
+        self._hooks = self._hooks + (hook,)
+
+    def remove_hook(self, hook):
+        """
+        :param hook: TraceHook previously added via `add_hook`
+        """
+        self._hooks = tuple(h for h in self._hooks if h is not hook)
+
+    def span(self, name, category, **args):
+        """
+        :param name: str span name, eg. 'make_request'
+        :param category: str span category, eg. 'http'
+        :param args: correlation data, eg. dialogRequestId and messageId
+        :return: context manager yielding a Span (or a no-op stand-in when no hooks are registered)
+        """
+        if not self._hooks:
+            return _NULL_SPAN
+        return Span(self._hooks, name, category, args)
+
+    def instant(self, name, category, **args):
+        """
+        record a zero-length span, eg. a state transition
+        """
+        hooks = self._hooks
+        if not hooks:
+            return
+        span = Span(hooks, name, category, args)
+        span.start = span.end = time.perf_counter()
+        for hook in hooks:
+            hook.span_finished(span)
+
+
+class ChromeTraceExporter(TraceHook):
+    """
+    collects finished spans and writes them as Chrome trace-event JSON (chrome://tracing, https://ui.perfetto.dev).
+
+    every span is shown on the lane of the thread that ran it. spans carrying a dialogRequestId are additionally
+    emitted as async events keyed by that ID, so a single interaction shows up as its own track across threads.
+    """
+    def __init__(self, max_spans=100000):
+        """
+        :param max_spans: int number of most recent spans to keep
+        """
+        self._spans = collections.deque(maxlen=max_spans)
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+
+    def span_finished(self, span):
+        self._spans.append(span)
+
+    def clear(self):
+        self._spans.clear()
+
+    def trace_events(self):
+        """
+        :return: list of trace-event dicts
+        """
+        events = []
+        threads = {}
+        for span in list(self._spans):
+            threads[span.thread_id] = span.thread_name
+            ts = (span.start - self._origin) * 1e6
+            event = {
+                "name": span.name,
+                "cat": span.category,
+                "ts": ts,
+                "pid": self._pid,
+                "tid": span.thread_id,
+                "args": span.args
+            }
+            if span.is_instant():
+                event["ph"] = "i"
+                event["s"] = "t"
+                events.append(event)
+                continue
+            event["ph"] = "X"
+            event["dur"] = (span.end - span.start) * 1e6
+            events.append(event)
+            dialog_request_id = span.args.get('dialogRequestId')
+            if dialog_request_id:
+                common = {"name": span.name, "cat": "dialog", "id": dialog_request_id, "pid": self._pid,
+                          "tid": span.thread_id}
+                events.append(dict(common, ph="b", ts=ts, args=span.args))
+                events.append(dict(common, ph="e", ts=(span.end - self._origin) * 1e6))
+        for thread_id, thread_name in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": self._pid, "tid": thread_id,
+                           "args": {"name": thread_name}})
+        return events
+
+    def write(self, path):
+        """
+        write collected spans to `path` as a Chrome trace-event JSON file
+
+        :param path: str output file path
+        """
+        with open(path, 'w') as f:
+            f.write(json.dumps({"traceEvents": self.trace_events(), "displayTimeUnit": "ms"}))
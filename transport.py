@@ -0,0 +1,358 @@
+import collections
+import logging
+import socket
+import ssl
+import threading
+import time
+
+from hyper import HTTP20Connection
+from hyper.common.bufsocket import BufferedSocket
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# phases of opening a connection, in order. the AVS client adds the downchannel and SynchronizeState phases
+DNS = 'dns'
+TCP = 'tcp'
+TLS = 'tls'
+PREFACE = 'preface'
+DOWNCHANNEL = 'downchannel'
+SYNCHRONIZE = 'synchronize'
+
+PHASES = [DNS, TCP, TLS, PREFACE, DOWNCHANNEL, SYNCHRONIZE]
+
+
+def _default_context():
+    context = ssl.create_default_context()
+    try:
+        context.set_alpn_protocols(['h2'])
+    except NotImplementedError:
+        # the protocol is forced to h2 anyway
+        pass
+    return context
+
+
+class DnsCache:
+    """
+    getaddrinfo results cached per host and port for `ttl` seconds. the stdlib resolver doesn't expose record TTLs, so
+    a fixed one is used. when a lookup fails, eg. while the network comes back after a blip, the expired result is used
+    instead. an address that failed to connect is moved to the back of its list.
+    """
+    def __init__(self, ttl=300):
+        """
+        :param ttl: float seconds a result is used for
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (host, port) to [float time.monotonic() resolved at, list of (family, type, proto, sockaddr)]
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def resolve(self, host, port):
+        """
+        :param host: str
+        :param port: int
+        :return: tuple of (list of (family, type, proto, sockaddr), bool True if it came from the cache)
+        """
+        with self._lock:
+            entry = self._entries.get((host, port))
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self.hits += 1
+                return list(entry[1]), True
+        try:
+            infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except socket.gaierror:
+            if entry is None:
+                raise
+            logger.warning("unable to resolve {}, using the addresses resolved {:.0f}s ago".format(
+                host, time.monotonic() - entry[0]))
+            with self._lock:
+                self.stale += 1
+            return list(entry[1]), True
+        addresses = [(family, socktype, proto, sockaddr) for family, socktype, proto, _, sockaddr in infos]
+        with self._lock:
+            self.misses += 1
+            self._entries[(host, port)] = [time.monotonic(), addresses]
+        return list(addresses), False
+
+    def demote(self, host, port, sockaddr):
+        """
+        move `sockaddr` to the back of the addresses of `host`, after connecting to it failed
+
+        :param host: str
+        :param port: int
+        :param sockaddr: tuple address as returned by `resolve`
+        """
+        with self._lock:
+            entry = self._entries.get((host, port))
+            if entry is not None:
+                entry[1] = [a for a in entry[1] if a[3] != sockaddr] + [a for a in entry[1] if a[3] == sockaddr]
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "entries": len(self._entries)
+            }
+
+
+class ConnectTimings:
+    """
+    seconds spent in each phase of opening one connection
+    """
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.address = None
+        self.dns_cached = False
+        self.session_reused = False
+        # True if the connection was opened ahead of time as a standby, so its DNS, TCP, TLS and preface phases were
+        # not waited for
+        self.standby = False
+        # seconds from the start of the (re)connect until the connection was usable, set by the AVS client
+        self.elapsed = None
+
+    def add(self, phase, seconds):
+        """
+        :param phase: str one of PHASES
+        :param seconds: float
+        """
+        self.phases[phase] = seconds
+
+    def to_dict(self):
+        ret = collections.OrderedDict(("{}_ms".format(phase), seconds * 1000) for phase, seconds in self.phases.items())
+        ret["elapsed_ms"] = self.elapsed * 1000 if self.elapsed is not None else None
+        ret["address"] = self.address
+        ret["dns_cached"] = self.dns_cached
+        ret["tls_session_reused"] = self.session_reused
+        ret["standby"] = self.standby
+        return ret
+
+    def __repr__(self):
+        return '<ConnectTimings {}>'.format(dict(self.to_dict()))
+
+
+class TransportConnection(HTTP20Connection):
+    """
+    hyper.HTTP20Connection whose socket is opened by a Transport. `timings` holds the phases of opening it once it
+    has connected.
+    """
+    def __init__(self, transport, host, port, **kwargs):
+        """
+        :param transport: Transport opening the socket
+        :param kwargs: passed to hyper.HTTP20Connection, eg. enable_push and window_manager
+        """
+        super().__init__(host, port, **kwargs)
+        self._transport = transport
+        self.timings = None
+
+    def connect(self):
+        with self._lock:
+            if self._sock is not None:
+                return
+            sock, timings = self._transport.open_socket(self.host, self.port)
+            self._sock = BufferedSocket(sock, self.network_buffer_size)
+            with self._transport.tracer.span(PREFACE, 'connect', host=self.host):
+                start = time.perf_counter()
+                self._send_preamble()
+                timings.add(PREFACE, time.perf_counter() - start)
+            self.timings = timings
+
+
+class Transport:
+    """
+    opens the sockets of AVS connections. DNS results are cached, and each TLS handshake resumes the session of the
+    connection before it, which saves a round trip and the certificate exchange. with `standby`, a second connection is
+    kept open that a reconnect takes over instead of opening one.
+
+    phases are traced as spans in the 'connect' category, and the timings of the most recent connection are kept in
+    `last_timings`.
+    """
+    def __init__(self, dns_ttl=300, connect_timeout=10, ssl_context=None, standby=False, standby_max_age=240,
+                 tracer=None):
+        """
+        :param dns_ttl: float seconds DNS results are cached for
+        :param connect_timeout: float seconds to wait for each TCP connect and the TLS handshake
+        :param ssl_context: ssl.SSLContext. defaults to one verifying against the system CAs
+        :param standby: bool keep a standby connection open, see `prewarm`
+        :param standby_max_age: float seconds after which a standby connection is assumed to have been closed by the
+            server for being idle, and is not used
+        :param tracer: tracing.Tracer
+        """
+        self.dns = DnsCache(dns_ttl)
+        self._connect_timeout = connect_timeout
+        self._context = ssl_context or _default_context()
+        self.standby = standby
+        self._standby_max_age = standby_max_age
+        self.tracer = tracer or tracing.Tracer()
+        self._lock = threading.Lock()
+        self._session = None
+        self._last_socket = None
+        # (TransportConnection, float time.monotonic() opened at)
+        self._standby = None
+        self._standby_thread = None
+        self.last_timings = None
+        self.connections = 0
+        self.sessions_reused = 0
+        self.standby_promotions = 0
+
+    def connection(self, host, port, **kwargs):
+        """
+        :param host: str
+        :param port: int
+        :param kwargs: passed to hyper.HTTP20Connection
+        :return: TransportConnection, connected when it is first used
+        """
+        return TransportConnection(self, host, port, **kwargs)
+
+    def save_session(self):
+        """
+        keep the TLS session of the most recent connection for the next handshake. with TLS 1.3 the session ticket
+        only arrives after the handshake, so call this before the connection is closed, eg. on reconnect.
+        """
+        with self._lock:
+            sock = self._last_socket
+        try:
+            session = sock.session if sock is not None else None
+        except (AttributeError, ValueError):
+            session = None
+        # a TLS 1.3 session has no ticket to resume until the server has sent one
+        if session is not None and getattr(session, 'has_ticket', True):
+            with self._lock:
+                self._session = session
+
+    def open_socket(self, host, port):
+        """
+        :param host: str
+        :param port: int
+        :return: tuple of (ssl.SSLSocket connected to `host`, ConnectTimings)
+        """
+        self.save_session()
+        timings = ConnectTimings()
+        with self.tracer.span(DNS, 'connect', host=host) as span:
+            start = time.perf_counter()
+            addresses, timings.dns_cached = self.dns.resolve(host, port)
+            timings.add(DNS, time.perf_counter() - start)
+            span.annotate(cached=timings.dns_cached)
+        with self.tracer.span(TCP, 'connect', host=host) as span:
+            start = time.perf_counter()
+            sock = None
+            error = OSError("no addresses for {}".format(host))
+            for family, socktype, proto, sockaddr in addresses:
+                try:
+                    sock = socket.socket(family, socktype, proto)
+                    sock.settimeout(self._connect_timeout)
+                    sock.connect(sockaddr)
+                    timings.address = sockaddr[0]
+                    break
+                except OSError as e:
+                    logger.warning("unable to connect to {} at {}: {}".format(host, sockaddr[0], e))
+                    error = e
+                    if sock is not None:
+                        sock.close()
+                        sock = None
+                    self.dns.demote(host, port, sockaddr)
+            if sock is None:
+                raise error
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            timings.add(TCP, time.perf_counter() - start)
+            span.annotate(address=timings.address)
+        with self.tracer.span(TLS, 'connect', host=host) as span:
+            start = time.perf_counter()
+            kwargs = {'server_hostname': host}
+            with self._lock:
+                # sessions can only be passed to wrap_socket as of python 3.6
+                if self._session is not None and hasattr(ssl, 'SSLSession'):
+                    kwargs['session'] = self._session
+            try:
+                sock = self._context.wrap_socket(sock, **kwargs)
+            except Exception:
+                sock.close()
+                raise
+            sock.settimeout(None)
+            timings.session_reused = getattr(sock, 'session_reused', False)
+            timings.add(TLS, time.perf_counter() - start)
+            span.annotate(session_reused=timings.session_reused)
+        with self._lock:
+            self._last_socket = sock
+            self.connections += 1
+            if timings.session_reused:
+                self.sessions_reused += 1
+        # with TLS 1.2 the session is available straight away
+        self.save_session()
+        self.last_timings = timings
+        logger.info("opened socket to {}: {}".format(host, timings))
+        return sock, timings
+
+    def prewarm(self, host, port, **kwargs):
+        """
+        open a standby connection in the background, unless there is one already or one is being opened. a reconnect
+        takes it over with `take_standby`, paying only for the HTTP/2 settings, downchannel and SynchronizeState.
+
+        :param host: str
+        :param port: int
+        :param kwargs: passed to hyper.HTTP20Connection
+        """
+        def open_standby():
+            try:
+                connection = self.connection(host, port, **kwargs)
+                connection.connect()
+                connection.timings.standby = True
+            except Exception:
+                logger.warning("unable to open standby connection", exc_info=True)
+                return
+            with self._lock:
+                self._standby = (connection, time.monotonic())
+            logger.info("standby connection ready: {}".format(connection.timings))
+
+        with self._lock:
+            if self._standby is not None or (self._standby_thread is not None and self._standby_thread.is_alive()):
+                return
+            self._standby_thread = threading.Thread(target=open_standby, name='Standby Connection Thread')
+            self._standby_thread.daemon = True
+            self._standby_thread.start()
+
+    def take_standby(self):
+        """
+        :return: the standby TransportConnection, connected, or None if there is none or it is older than
+            `standby_max_age`
+        """
+        with self._lock:
+            standby, self._standby = self._standby, None
+        if standby is None:
+            return None
+        connection, opened_at = standby
+        if time.monotonic() - opened_at > self._standby_max_age:
+            logger.info("discarding standby connection idle for {:.0f}s".format(time.monotonic() - opened_at))
+            connection.close()
+            return None
+        self.standby_promotions += 1
+        return connection
+
+    def metrics(self):
+        """
+        :return: dict of connection counters, DNS cache counters and the timings of the most recent connection
+        """
+        with self._lock:
+            ret = {
+                "connections": self.connections,
+                "tls_sessions_reused": self.sessions_reused,
+                "standby_promotions": self.standby_promotions,
+                "standby_ready": self._standby is not None
+            }
+        ret["dns"] = self.dns.metrics()
+        ret["last_timings"] = dict(self.last_timings.to_dict()) if self.last_timings is not None else None
+        return ret
+
+    def close(self):
+        """
+        close the standby connection
+        """
+        with self._lock:
+            standby, self._standby = self._standby, None
+        if standby is not None:
+            standby[0].close()
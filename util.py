@@ -1,6 +1,13 @@
+import datetime
+import io
+import os
+import re
+
 import ujson as json
-import requests
-from requests_toolbelt import MultipartDecoder
+
+# ISO 8601 date and time in extended format, eg. 2017-03-01T21:40:00.000Z or 2017-03-01T21:40:00+0100
+_ISO8601 = re.compile(r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d+))?)?'
+                      r'\s*(Z|[+-]\d{2}(?::?\d{2})?)?$', re.IGNORECASE)
 
 
 def request_new_tokens(refresh_token, client_id, client_secret, write_out=None):
@@ -13,6 +20,8 @@ def request_new_tokens(refresh_token, client_id, client_secret, write_out=None):
     :param write_out: callable taking dict argument matching 'tokens.txt' schema
     :return: access_token, refresh_token
     """
+    # requests is only needed when the tokens expire, so it is not imported at startup
+    import requests
     s = requests.session()
     params_dict = {
         'grant_type': 'refresh_token',
@@ -31,6 +40,63 @@ def request_new_tokens(refresh_token, client_id, client_secret, write_out=None):
         raise Exception("Failed to request new tokens: {} {}".format(res.status_code, res.content.decode()))
 
 
+def parse_iso8601(value):
+    """
+    parse an ISO 8601 date and time, as used for Alerts scheduledTime and AudioPlayer expiryTime
+
+    :param value: str ISO 8601 date and time in extended format, with an optional fraction of a second and UTC offset
+    :return: timezone-aware datetime.datetime. times without an offset are taken to be UTC
+    :raises ValueError: if `value` is not in that format
+    """
+    match = _ISO8601.match(value.strip())
+    if match is None:
+        raise ValueError("not an ISO 8601 date and time: {}".format(value))
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    tz = datetime.timezone.utc
+    if offset and offset.upper() != 'Z':
+        digits = offset[1:].replace(':', '')
+        delta = datetime.timedelta(hours=int(digits[:2]), minutes=int(digits[2:] or 0))
+        tz = datetime.timezone(-delta if offset[0] == '-' else delta)
+    return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second or 0),
+                             int((fraction or '0')[:6].ljust(6, '0')), tz)
+
+
+def total_len(o):
+    """
+    :param o: file-like or bytes-like request body
+    :return: int length of `o`, or None if it is a stream of unknown length
+    """
+    if hasattr(o, '__len__'):
+        return len(o)
+    if hasattr(o, 'len'):
+        return o.len
+    if hasattr(o, 'fileno'):
+        try:
+            return os.fstat(o.fileno()).st_size - (o.tell() if hasattr(o, 'tell') else 0)
+        except (io.UnsupportedOperation, OSError):
+            pass
+    if hasattr(o, 'getvalue'):
+        return len(o.getvalue())
+    return None
+
+
+class PartHeaders(dict):
+    """
+    headers of a multipart part: bytes header names to bytes values, looked up case-insensitively
+    """
+    def __setitem__(self, name, value):
+        super().__setitem__(name.lower(), value)
+
+    def __getitem__(self, name):
+        return super().__getitem__(name.lower())
+
+    def __contains__(self, name):
+        return super().__contains__(name.lower())
+
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+
+
 def is_directive(headers, data):
     """
     checks if a part (of multi-part body) looks like a directive
@@ -43,27 +109,72 @@ def is_directive(headers, data):
     return b'application/json' in headers[b'Content-Type'] and 'directive' in data
 
 
-def body_part_to_headers_and_data(part):
+def _parse_part_headers(data):
+    """
+    :param data: bytes part header block, without the blank line ending it
+    :return: PartHeaders
     """
-    convert part (of multi-part body) to headers dict and content. de-serializes json if content-type is
-    application/json.
+    headers = PartHeaders()
+    for line in data.split(b'\r\n'):
+        if line:
+            name, _, value = line.partition(b':')
+            headers[name.strip()] = value.strip()
+    return headers
 
-    :param part: BodyPart decoded by MultipartDecoder
-    :return: tuple pair of headers dict and content
+
+def _boundary(content_type):
+    """
+    :param content_type: str multipart content-type
+    :return: bytes boundary parameter of `content_type`
     """
-    if b'application/json' in part.headers[b'Content-Type'].lower():
-        return part.headers, json.loads(part.text)
-    return part.headers, part.text
+    for parameter in content_type.split(';')[1:]:
+        name, _, value = parameter.strip().partition('=')
+        if name.lower() == 'boundary':
+            return value.strip('"').encode()
+    raise ValueError("no boundary in content-type {}".format(content_type))
 
 
-def multipart_parse(data, content_type, encoding='latin1'):
+def multipart_parse(data, content_type):
     """
-    parse multipart http response into headers, content tuples
+    parse multipart http response into headers, content tuples. application/json parts are de-serialized; the content
+    of any other part is a memoryview into `data`, so no part is copied until its consumer decides where it goes (see
+    `attachments.AttachmentStore`)
 
     :param data: bytes http multipart response body
     :param content_type: str http response content-type
-    :param encoding: str encoding to use when decoding content
-    :return:
+    :return: list of tuple pairs of headers dict (bytes keys/values) and content
     """
-    decoder = MultipartDecoder(data, content_type, encoding)
-    return [body_part_to_headers_and_data(part) for part in decoder.parts]
+    delimiter = b'--' + _boundary(content_type)
+    view = memoryview(data)
+    parts = []
+    position = data.find(delimiter)
+    while position != -1:
+        position += len(delimiter)
+        if data[position:position + 2] == b'--':
+            # close delimiter
+            break
+        line_end = data.find(b'\r\n', position)
+        if line_end == -1 or line_end + 2 == len(data):
+            # the body ends on an open delimiter, as downchannel chunks usually do
+            break
+        header_start = line_end + 2
+        if data[header_start:header_start + 2] == b'\r\n':
+            # part without headers
+            header_end = header_start
+            content_start = header_start + 2
+        else:
+            header_end = data.find(b'\r\n\r\n', header_start)
+            if header_end == -1:
+                raise ValueError("truncated multipart part headers")
+            content_start = header_end + 4
+        end = data.find(b'\r\n' + delimiter, content_start)
+        if end == -1:
+            # no delimiter after the last part, its content runs to the end of the body
+            end = len(data)
+        headers = _parse_part_headers(data[header_start:header_end])
+        content = view[content_start:end]
+        if b'application/json' in headers.get(b'Content-Type', b'').lower():
+            content = json.loads(bytes(content).decode())
+        parts.append((headers, content))
+        position = data.find(delimiter, end)
+    return parts
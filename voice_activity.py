@@ -0,0 +1,215 @@
+import collections
+import logging
+
+import numpy
+
+from speech_recognizer import AudioInputDevice
+
+logger = logging.getLogger(__name__)
+
+# AVS speech input is 16 bit little-endian PCM, 16 kHz, mono
+_SAMPLE_RATE = 16000
+_SAMPLE_WIDTH = 2
+
+
+class VoiceActivityDetector:
+    """
+    frame classifier based on short-term energy and zero-crossing rate.
+
+    a frame is speech when its energy is above `energy_threshold_db` and either its zero-crossing rate is below
+    `zero_crossing_threshold` (voiced speech) or its energy is `strong_margin_db` above the threshold (loud unvoiced
+    speech). broadband background noise has a high zero-crossing rate and is rejected unless it is loud.
+    """
+    def __init__(self, energy_threshold_db=-45.0, zero_crossing_threshold=0.3, strong_margin_db=15.0):
+        """
+        :param energy_threshold_db: float frame energy threshold in dBFS
+        :param zero_crossing_threshold: float fraction of adjacent samples with a sign change
+        :param strong_margin_db: float energy above the threshold at which the zero-crossing test is skipped
+        """
+        self.energy_threshold_db = energy_threshold_db
+        self.zero_crossing_threshold = zero_crossing_threshold
+        self.strong_margin_db = strong_margin_db
+
+    def classify(self, frames):
+        """
+        :param frames: numpy.ndarray of int16 samples with shape (number of frames, samples per frame)
+        :return: numpy.ndarray of bool, True for each speech frame
+        """
+        samples = frames.astype(numpy.float32) / 32768.0
+        energy_db = 10.0 * numpy.log10(numpy.mean(samples * samples, axis=1) + 1e-10)
+        signs = numpy.signbit(frames)
+        zero_crossing_rate = numpy.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (frames.shape[1] - 1)
+        loud = energy_db > self.energy_threshold_db
+        return loud & ((zero_crossing_rate < self.zero_crossing_threshold) |
+                       (energy_db > self.energy_threshold_db + self.strong_margin_db))
+
+
+class UtteranceStatistics:
+    """
+    speech and silence accounting for one utterance, from `start_recording` to the end of the stream
+    """
+    def __init__(self, frame_ms):
+        self.frame_ms = frame_ms
+        self.frames = 0
+        self.speech_frames = 0
+        self.trimmed_frames = 0
+        self.endpointed = False
+
+    @property
+    def speech_ms(self):
+        return self.speech_frames * self.frame_ms
+
+    @property
+    def silence_ms(self):
+        return (self.frames - self.speech_frames) * self.frame_ms
+
+    @property
+    def trimmed_ms(self):
+        """
+        leading silence that was not uploaded
+        """
+        return self.trimmed_frames * self.frame_ms
+
+    def to_dict(self):
+        return {
+            "speech_ms": self.speech_ms,
+            "silence_ms": self.silence_ms,
+            "trimmed_ms": self.trimmed_ms,
+            "endpointed": self.endpointed
+        }
+
+    def __repr__(self):
+        return '<UtteranceStatistics {}>'.format(self.to_dict())
+
+
+class EndpointingAudioInputDevice(AudioInputDevice):
+    """
+    AudioInputDevice wrapper that runs voice activity detection on the 16 kHz mono L16 stream of another
+    AudioInputDevice. leading silence is trimmed (keeping `leading_padding_ms` before the first speech frame) and the
+    stream is ended locally once `trailing_silence_ms` of silence follows speech, without waiting for StopCapture.
+
+    statistics for the current or most recent utterance are available as `statistics`.
+    """
+    def __init__(self,
+                 device,
+                 detector=None,
+                 frame_ms=20,
+                 leading_padding_ms=200,
+                 trailing_silence_ms=800,
+                 max_leading_silence_ms=None):
+        """
+        :param device: AudioInputDevice providing 16 kHz mono L16 audio
+        :param detector: VoiceActivityDetector. a default-configured detector is used if not given
+        :param frame_ms: int analysis frame length in milliseconds
+        :param leading_padding_ms: int audio kept ahead of the first speech frame
+        :param trailing_silence_ms: int silence after speech that ends the stream
+        :param max_leading_silence_ms: int silence before any speech that ends the stream. None waits indefinitely
+            (or until StopCapture)
+        """
+        self._device = device
+        self._detector = detector or VoiceActivityDetector()
+        self._frame_ms = frame_ms
+        self._frame_samples = _SAMPLE_RATE * frame_ms // 1000
+        self._frame_bytes = self._frame_samples * _SAMPLE_WIDTH
+        self._padding_frames = leading_padding_ms // frame_ms
+        self._trailing_frames = max(1, trailing_silence_ms // frame_ms)
+        self._max_leading_frames = max_leading_silence_ms // frame_ms if max_leading_silence_ms is not None else None
+        self.statistics = None
+        self._reset()
+
+    def _reset(self):
+        self._pending = b''
+        self._output = bytearray()
+        self._padding = collections.deque(maxlen=self._padding_frames)
+        self._leading_frames = 0
+        self._triggered = False
+        self._silence_run = 0
+        self._ended = False
+
+    def start_recording(self):
+        self._reset()
+        self.statistics = UtteranceStatistics(self._frame_ms)
+        self._device.start_recording()
+
+    def stop_recording(self):
+        self._device.stop_recording()
+
+    def _finish(self, endpointed, stop_device=None):
+        """
+        :param endpointed: bool True if the utterance ended at an endpoint
+        :param stop_device: bool stop recording on the wrapped device. defaults to `endpointed`; False when the device
+            has already run out of audio
+        """
+        if stop_device is None:
+            stop_device = endpointed
+        self._ended = True
+        self.statistics.endpointed = endpointed
+        if not self._triggered:
+            self.statistics.trimmed_frames = self._leading_frames
+        if stop_device:
+            self._device.stop_recording()
+            # one more read lets devices that release their capture stream on read (eg. pyaudio) do so
+            self._device.read(self._frame_bytes)
+        logger.info("utterance finished: {}".format(self.statistics))
+
+    def _analyse(self, data):
+        """
+        classify all complete frames in the pending audio plus `data` and move the audio to be uploaded to the output
+        buffer
+
+        :param data: bytes audio read from the wrapped device
+        """
+        fb = self._frame_bytes
+        buf = self._pending + data
+        n = len(buf) // fb
+        self._pending = buf[n * fb:]
+        if not n:
+            return
+        frames = numpy.frombuffer(buf, dtype='<i2', count=n * self._frame_samples).reshape(n, self._frame_samples)
+        speech = self._detector.classify(frames)
+        self.statistics.frames += n
+        self.statistics.speech_frames += int(numpy.count_nonzero(speech))
+
+        start = 0
+        if not self._triggered:
+            onsets = numpy.flatnonzero(speech)
+            leading = int(onsets[0]) if len(onsets) else n
+            for i in range(max(0, leading - self._padding_frames), leading):
+                self._padding.append(buf[i * fb:(i + 1) * fb])
+            self._leading_frames += leading
+            if not len(onsets):
+                if self._max_leading_frames is not None and self._leading_frames >= self._max_leading_frames:
+                    self._finish(False, stop_device=True)
+                return
+            self._triggered = True
+            self.statistics.trimmed_frames = self._leading_frames - len(self._padding)
+            self._output.extend(b''.join(self._padding))
+            self._padding.clear()
+            start = leading
+
+        # length of the silence run ending at each frame, carrying over the run from the previous block
+        index = numpy.arange(start, n)
+        last_speech = numpy.maximum.accumulate(numpy.where(speech[start:], index, start - 1 - self._silence_run))
+        silence_run = index - last_speech
+        endpoints = numpy.flatnonzero(silence_run >= self._trailing_frames)
+        if len(endpoints):
+            end = start + int(endpoints[0]) + 1
+            self._output.extend(buf[start * fb:end * fb])
+            self._finish(True)
+        else:
+            self._output.extend(buf[start * fb:n * fb])
+            self._silence_run = int(silence_run[-1])
+
+    def read(self, size=-1):
+        while not self._ended and (size < 0 or len(self._output) < size):
+            data = self._device.read(self._frame_bytes)
+            self._analyse(data)
+            if len(data) < self._frame_bytes and not self._ended:
+                if self._triggered:
+                    self._output.extend(self._pending)
+                self._finish(False)
+        if size < 0:
+            size = len(self._output)
+        ret = bytes(self._output[:size])
+        del self._output[:size]
+        return ret